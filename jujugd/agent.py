@@ -0,0 +1,377 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy background agent.
+
+The agent keeps environment information, logged in API connections, HTTPS
+connections and downloaded archives warm across deployments. The juju
+git-deploy command forwards its requests to the agent over a Unix socket.
+"""
+
+import argparse
+import collections
+from contextlib import (
+    contextmanager,
+    redirect_stdout,
+)
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from . import (
+    api,
+    app,
+    bundle,
+    cleanup,
+    env,
+    metrics,
+    settings,
+    utils,
+)
+
+
+class WarmSession(app.Session):
+    """A session keeping deployment resources warm across requests."""
+
+    def __init__(self, max_archives=settings.AGENT_MAX_ARCHIVES):
+        self.pool = utils.ConnectionPool()
+        self.max_archives = max_archives
+        self._facts = {}
+        self._archives = collections.OrderedDict()
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def discover(self, env_name, series):
+        """Return the cached environment information.
+
+        The information is retrieved again if the jenv file changed.
+        """
+        try:
+            mtime = os.stat(env.get_jenv_path(env_name)).st_mtime
+        except OSError:
+            mtime = None
+        key = (env_name, series)
+        with self._lock:
+            cached = self._facts.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if cached is not None:
+            # The environment changed: also discard its API connection.
+            logging.info('environment {} changed'.format(env_name))
+            self._drop_connection(cached[1][0])
+        facts = super().discover(env_name, series)
+        with self._lock:
+            self._facts[key] = (mtime, facts)
+        return facts
+
+    def fetch(self, zip_url, commit=None, output=None):
+        """Return the charm contents, reusing previously downloaded archives.
+
+        Github archives are cached by commit. Local charm directories are
+        always built again, only compressing changed files.
+        """
+        if os.path.isdir(zip_url):
+            return super().fetch(zip_url, output=output)
+        if commit is None:
+            commit = app.get_commit(zip_url, output=output)
+        key = (zip_url.rsplit('/zipball/', 1)[0], commit)
+        with self._lock:
+            contents = self._archives.get(key)
+            if contents is not None:
+                self._archives.move_to_end(key)
+                if output is None:
+                    output = print
+                output('using cached archive for {}'.format(commit))
+                return contents
+        contents = app.fetch(zip_url, commit=commit, output=output)
+        with self._lock:
+            self._archives[key] = contents
+            while len(self._archives) > self.max_archives:
+                self._archives.popitem(last=False)
+        return contents
+
+    def _drop_connection(self, api_address):
+        """Close and discard the cached connection to the given address."""
+        with self._lock:
+            entry = self._connections.pop(api_address, None)
+        if entry is not None:
+            entry[0].close()
+
+    @contextmanager
+    def connect(self, api_address, password):
+        """Return a cached logged in API connection in the context block.
+
+        The connection is checked before being reused, and a new one is
+        established if required.
+        """
+        with self._lock:
+            connection, lock = self._connections.get(
+                api_address, (None, threading.Lock()))
+        with lock:
+            if connection is not None:
+                try:
+                    api.ping(connection)
+                except api.JujuError:
+                    connection.close()
+                    connection = None
+            if connection is None:
+                connection = api.JujuWebSocketConnection(
+                    'wss://{}'.format(api_address))
+                try:
+                    connection.connect()
+                    api.login(connection, password)
+                except Exception as err:
+                    connection.close()
+                    if isinstance(err, api.JujuError):
+                        raise
+                    msg = 'unable to connect to {}: {}'.format(
+                        connection.ws_address, err)
+                    raise api.JujuError(msg)
+                with self._lock:
+                    self._connections[api_address] = (connection, lock)
+            try:
+                yield connection
+            except api.JujuError:
+                # The connection may be in an inconsistent state.
+                self._drop_connection(api_address)
+                raise
+
+    def close(self):
+        """Release all the resources held by the session."""
+        self.pool.close()
+        for api_address in list(self._connections):
+            self._drop_connection(api_address)
+
+
+class _Output:
+    """A file-like object sending printed lines to the agent client."""
+
+    def __init__(self, send):
+        self._send = send
+        self._local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', '') + text
+        *lines, self._local.buffer = buffer.split('\n')
+        for line in lines:
+            self._send({'Output': line})
+
+    def flush(self):
+        pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handle a deployment request sent by the agent client."""
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def deploy(self, options):
+        """Deploy the charm or bundle described by the given options."""
+        session = self.server.session
+        env_names = options.env_names or [None]
+        series_list = options.series or [None]
+        annotations = None
+        if options.ephemeral:
+            annotations = {cleanup.ANNOTATION: options.ephemeral}
+        if os.path.isfile(options.repo):
+            for env_name in env_names:
+                bundle.deploy(
+                    options.repo, env_name, series_list[0], options.jobs,
+                    session=session, annotations=annotations)
+            return
+        setup = app.ServiceSetup(
+            options.config, options.constraints, options.expose,
+            options.relations or (), annotations)
+        recorder = metrics.Recorder(options.repo)
+        deploy = app.fan_out
+        if app.get_charm_path(options.repo):
+            deploy = app.deploy_charms
+        elif len(app.get_zip_urls(options.repo)) > 1:
+            deploy = app.deploy_refs
+        try:
+            deploy(
+                options.repo, env_names, series_list, options.service,
+                options.num_units, options.machines, options.jobs,
+                session=session, recorder=recorder, setup=setup)
+        finally:
+            recorder.save()
+
+    def handle(self):
+        try:
+            options = argparse.Namespace(**json.loads(
+                self.rfile.readline().decode('utf-8')))
+        except ValueError as err:
+            self.send({'Error': 'invalid request: {}'.format(err)})
+            return
+        logging.info('deploying {}'.format(options.repo))
+        lock = threading.Lock()
+
+        def send(message):
+            with lock:
+                self.send(message)
+
+        try:
+            with redirect_stdout(_Output(send)):
+                self.deploy(options)
+        except app.ProgramExit as err:
+            send({'Error': err.message})
+        except Exception as err:
+            logging.exception('unexpected error')
+            send({'Error': 'unexpected agent error: {}'.format(err)})
+        else:
+            send({'Done': True})
+
+
+@contextmanager
+def _startup_lock(path):
+    """Hold the lock serializing the agents listening on the given path.
+
+    The lock file is stored next to the socket, e.g. agent.lock for
+    agent.sock.
+    """
+    lock_path = os.path.splitext(path)[0] + '.lock'
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def serve(path, idle_timeout):
+    """Run the agent listening on the Unix socket at the given path.
+
+    Return immediately if another agent is already listening on the path.
+    The agent exits if no requests are received for idle_timeout seconds.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _startup_lock(path):
+        sock = _connect(path)
+        if sock is not None:
+            sock.close()
+            logging.info('agent already listening on {}'.format(path))
+            return
+        if os.path.exists(path):
+            # The socket has been left behind by a crashed agent.
+            os.remove(path)
+        server = socketserver.UnixStreamServer(path, _Handler)
+        inode = os.stat(path).st_ino
+    server.session = WarmSession()
+    server.timeout = idle_timeout
+    server.idle = False
+
+    def handle_timeout():
+        server.idle = True
+
+    server.handle_timeout = handle_timeout
+    logging.info('agent listening on {}'.format(path))
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        logging.info('agent shutting down')
+        server.server_close()
+        server.session.close()
+        with _startup_lock(path):
+            # Only remove the socket if not replaced by another agent.
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _connect(path):
+    """Return a socket connected to the agent, or None if not running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def start(path, wait=settings.AGENT_START_TIMEOUT):
+    """Start the agent in the background, and return a socket connected to it.
+
+    Raise an IOError if the agent does not start in the given wait seconds.
+    """
+    log_path = os.path.join(settings.CACHE_DIR, 'agent.log')
+    os.makedirs(settings.CACHE_DIR, exist_ok=True)
+    # Run the agent from the directory including this package, so that the
+    # module can be imported even if the package is not installed.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(log_path, 'a') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'jujugd.agent', path], cwd=root,
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        sock = _connect(path)
+        if sock is not None:
+            return sock
+        time.sleep(0.05)
+    raise IOError('unable to start the agent: see {}'.format(log_path))
+
+
+def forward(options, path=settings.AGENT_SOCKET):
+    """Forward the deployment request to the agent, starting it if required.
+
+    Print the output sent by the agent.
+    Raise a ProgramExit if the deployment fails.
+    """
+    request = dict(vars(options))
+    if os.path.exists(request['repo']):
+        request['repo'] = os.path.abspath(request['repo'])
+    sock = _connect(path)
+    try:
+        if sock is None:
+            print('starting the agent')
+            sock = start(path)
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            stream.flush()
+            for line in stream:
+                message = json.loads(line.decode('utf-8'))
+                if 'Output' in message:
+                    print(message['Output'])
+                elif 'Error' in message:
+                    raise app.ProgramExit(message['Error'])
+                else:
+                    return
+    except (IOError, ValueError) as err:
+        raise app.ProgramExit('agent failure: {}'.format(err))
+    finally:
+        if sock is not None:
+            sock.close()
+    raise app.ProgramExit('agent failure: connection closed')
+
+
+def main():
+    """Run the agent: this is called when executing the module."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    path = sys.argv[1] if len(sys.argv) > 1 else settings.AGENT_SOCKET
+    serve(path, settings.AGENT_IDLE_TIMEOUT)
+
+
+if __name__ == '__main__':
+    main()
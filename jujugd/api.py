@@ -12,18 +12,53 @@
 
 """Juju Git Deploy API management."""
 
+import codecs
 from contextlib import contextmanager
 import itertools
 import json
 import logging
+import socket
+import struct
+import zlib
 
 import websocket
+import yaml
 
-from . import utils
+from . import (
+    settings,
+    utils,
+)
 
 
 # Define the user name used for authenticating to the Juju API.
 JUJU_USER = 'user-admin'
+# Define the maximum number of requests sent before waiting for responses.
+PIPELINE_SIZE = 20
+# Define the maximum number of unplaced units added by a single request.
+UNITS_CHUNK_SIZE = 20
+# Define the WebSocket extension negotiated to receive compressed responses.
+DEFLATE_EXTENSION = 'permessage-deflate'
+
+# Define the WebSocket frame opcodes.
+_OPCODE_CLOSE = 0x8
+_OPCODE_PING = 0x9
+# Define the bytes removed by the server from the end of compressed messages.
+_DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+# Define the supported constraints and their kinds.
+_CONSTRAINTS = {
+    'arch': 'str',
+    'container': 'str',
+    'cpu-cores': 'int',
+    'cpu-power': 'int',
+    'instance-type': 'str',
+    'mem': 'size',
+    'networks': 'list',
+    'root-disk': 'size',
+    'tags': 'list',
+}
+# Define the multipliers converting size suffixes to megabytes.
+_SIZE_MULTIPLIERS = {'M': 1, 'G': 1024, 'T': 1024 ** 2, 'P': 1024 ** 3}
 
 
 def get_api_address(env_name):
@@ -41,12 +76,13 @@ def get_api_address(env_name):
     return addresses[0]
 
 
-def upload_charm(api_address, stream, password, series):
+def upload_charm(api_address, stream, password, series, pool=None):
     """Upload a local charm to the given Juju API address.
 
     Receive the file-like object stream representing the zip contents of the
     charm. Authenticate with the given password and use the given OS series
-    to store the local charm.
+    to store the local charm. If a utils.ConnectionPool is provided, it is used
+    to reuse the HTTPS connections to the Juju API server.
 
     Raise an IOError if an error occurs while uploading the charm.
 
@@ -62,7 +98,7 @@ def upload_charm(api_address, stream, password, series):
     host, port = api_address.split(':')
     path = '/charms?series={}'.format(series)
     data, status, reason = utils.urlpost(
-        host, port, path, stream, JUJU_USER, password)
+        host, port, path, stream, JUJU_USER, password, pool=pool)
     try:
         contents = json.loads(data)
     except Exception as err:
@@ -76,33 +112,238 @@ class JujuError(Exception):
     """An error occurred while using the Juju WebSocket client."""
 
 
+class JujuTimeout(JujuError):
+    """A Juju API response was not received in time."""
+
+
+def _log_payload(prefix, payload, size=None):
+    """Log the given Juju API message at debug level.
+
+    Only the first API_LOG_SIZE characters of long messages are logged,
+    together with their size. If the payload only includes the head of the
+    message, the message size must be provided.
+    """
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    if size is None:
+        size = len(payload)
+    if size > settings.API_LOG_SIZE:
+        payload = '{}... ({} characters)'.format(
+            payload[:settings.API_LOG_SIZE], size)
+    logging.debug('{} {}'.format(prefix, payload))
+
+
+def _accepts_deflate(headers):
+    """Report whether the handshake response headers enable compression."""
+    value = headers.get('sec-websocket-extensions') or ''
+    return any(
+        extension.split(';')[0].strip() == DEFLATE_EXTENSION
+        for extension in value.split(','))
+
+
 class JujuWebSocketConnection:
-    """A simple Juju WebSocket client."""
+    """A simple Juju WebSocket client.
+
+    Compressed responses are requested when connecting, and used if the
+    server supports the permessage-deflate extension. As the WebSocket client
+    library does not decode compressed frames, they are read from the socket
+    and inflated in chunks here. Requests are never compressed.
+    """
 
     def __init__(self, ws_address):
         self.ws_address = ws_address
         self._connection = None
         self._counter = itertools.count()
+        self._inflater = None
 
     def connect(self):
-        """Connect to the Juju WebSocket API."""
-        self._connection = websocket.create_connection(self.ws_address)
-
-    def send(self, request):
-        """Send a request to Juju."""
+        """Connect to the Juju WebSocket API.
+
+        Compression is not requested if the WebSocket client library does
+        not expose the handshake response headers (e.g. the pinned
+        websocket-client-py3 0.12.0), as it could not be detected.
+        """
+        options = {}
+        deflate = hasattr(websocket.WebSocket, 'getheaders')
+        if deflate:
+            options['header'] = [
+                'Sec-WebSocket-Extensions: {}'.format(DEFLATE_EXTENSION)]
+        self._connection = websocket.create_connection(
+            self.ws_address, **options)
+        if deflate and _accepts_deflate(self._connection.getheaders() or {}):
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def send(self, request, path=None, callback=None, timeout=None):
+        """Send a request to Juju. Return the response.
+
+        If a path and a callback are provided, the items of the response
+        array or object found at the given path are decoded incrementally and
+        passed to the callback, and left out of the returned response (see
+        utils.JSONStreamDecoder).
+        If a timeout is provided, a JujuTimeout is raised if the response is
+        not received within timeout seconds. The connection is then closed,
+        as the late response would be read in place of the next one.
+        """
         connection = self._connection
         request['RequestId'] = next(self._counter)
         outgoing = json.dumps(request)
-        logging.debug('ws -> {}'.format(outgoing))
+        _log_payload('ws ->', outgoing)
+        if timeout is not None:
+            previous_timeout = connection.gettimeout()
+            connection.settimeout(timeout)
         try:
             connection.send(outgoing)
-            incoming = connection.recv()
+            return self._recv(path, callback)
+        except (socket.timeout, websocket.WebSocketTimeoutException):
+            self.close()
+            msg = 'timed out waiting for the Juju API {}:{} response'.format(
+                request['Type'], request['Request'])
+            raise JujuTimeout(msg)
+        except Exception as err:
+            msg = 'error processing the Juju API {}:{} request: {}'.format(
+                request['Type'], request['Request'], err)
+            raise JujuError(msg)
+        finally:
+            if timeout is not None and self._connection is not None:
+                connection.settimeout(previous_timeout)
+
+    def send_many(self, requests):
+        """Send multiple requests to Juju without waiting for each response.
+
+        All the requests are sent before reading the responses, which are
+        returned in the same order as the corresponding requests.
+        """
+        connection = self._connection
+        pending = {}
+        for request in requests:
+            request['RequestId'] = next(self._counter)
+            pending[request['RequestId']] = request
+        responses = {}
+        request = None
+        try:
+            for request in requests:
+                outgoing = json.dumps(request)
+                _log_payload('ws ->', outgoing)
+                connection.send(outgoing)
+            while len(responses) < len(requests):
+                response = self._recv()
+                request_id = response.get('RequestId')
+                if request_id in pending:
+                    request = pending[request_id]
+                    responses[request_id] = response
         except Exception as err:
             msg = 'error processing the Juju API {}:{} request: {}'.format(
                 request['Type'], request['Request'], err)
             raise JujuError(msg)
-        logging.debug('ws <- {}'.format(incoming))
-        return json.loads(incoming)
+        return [responses[request['RequestId']] for request in requests]
+
+    def _recv(self, path=None, callback=None):
+        """Receive and decode the next response.
+
+        See send for a description of the arguments.
+        """
+        decoder = None
+        if path is not None:
+            decoder = utils.JSONStreamDecoder(path, callback)
+        chunks, head, size = [], '', 0
+        for chunk in self._recv_chunks():
+            if len(head) < settings.API_LOG_SIZE:
+                head += chunk[:settings.API_LOG_SIZE]
+            size += len(chunk)
+            if decoder is None:
+                chunks.append(chunk)
+            else:
+                decoder.feed(chunk)
+        _log_payload('ws <-', head, size=size)
+        if decoder is None:
+            return json.loads(''.join(chunks))
+        return decoder.close()
+
+    def _recv_chunks(self):
+        """Yield the text of the next message received from Juju in chunks.
+
+        Without compression, the message is received as a whole by the
+        WebSocket client library.
+        """
+        if self._inflater is None:
+            yield self._connection.recv()
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        compressed = None
+        while True:
+            final, rsv1, opcode, length = self._recv_frame_header()
+            if opcode >= _OPCODE_CLOSE:
+                self._handle_control_frame(opcode, self._recv_exactly(length))
+                continue
+            if compressed is None:
+                # Only the first frame of a message marks it as compressed.
+                compressed = bool(rsv1)
+            while length:
+                data = self._recv_exactly(min(length, settings.API_CHUNK_SIZE))
+                length -= len(data)
+                if compressed:
+                    for chunk in self._inflate(data):
+                        yield decoder.decode(chunk)
+                else:
+                    yield decoder.decode(data)
+            if final:
+                break
+        if compressed:
+            for chunk in self._inflate(_DEFLATE_TAIL):
+                yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+
+    def _recv_exactly(self, size):
+        """Return the given number of bytes read from the socket."""
+        sock = self._connection.sock
+        chunks = []
+        while size:
+            data = sock.recv(size)
+            if not data:
+                raise IOError('connection closed by the server')
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def _recv_frame_header(self):
+        """Read the header of the next WebSocket frame.
+
+        Return whether the frame is the last one of the message, its RSV1 bit
+        (marking compressed messages), its opcode and its payload length.
+        """
+        first, second = self._recv_exactly(2)
+        if second & 0x80:
+            raise IOError('masked frame received from the server')
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', self._recv_exactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self._recv_exactly(8))
+        return first & 0x80, first & 0x40, first & 0x0f, length
+
+    def _handle_control_frame(self, opcode, payload):
+        """Handle the given control frame received while reading a message."""
+        if opcode == _OPCODE_CLOSE:
+            raise IOError('connection closed by the server')
+        if opcode == _OPCODE_PING:
+            self._connection.pong(payload)
+
+    def _inflate(self, data):
+        """Inflate the given compressed data, yielding bounded chunks.
+
+        The compression context is kept across messages, unless the server
+        ends the compressed stream.
+        """
+        while True:
+            chunk = self._inflater.decompress(data, settings.API_CHUNK_SIZE)
+            data = self._inflater.unconsumed_tail
+            if self._inflater.eof:
+                data = self._inflater.unused_data
+                self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            if chunk:
+                yield chunk
+            if not data and len(chunk) < settings.API_CHUNK_SIZE:
+                return
 
     def close(self):
         """Close the WebSocket connection."""
@@ -156,9 +397,59 @@ def login(connection, password):
     _check_reponse(response, 'error authenticating to Juju: {}')
 
 
-def deploy(connection, charm_url, service=None, num_units=None, machine=None):
+def ping(connection):
+    """Check that the Juju WebSocket API connection is still alive."""
+    request = {'Type': 'Pinger', 'Request': 'Ping'}
+    response = connection.send(request)
+    _check_reponse(response, 'error pinging Juju: {}')
+
+
+def parse_constraints(value):
+    """Parse the given constraints string, e.g. "mem=4G cpu-cores=2".
+
+    Return the constraints as a dict suitable for the Juju WebSocket API.
+    Sizes (mem and root-disk) are converted to megabytes, and can include an
+    M, G, T or P suffix. Tags and networks are comma separated lists.
+    Raise a ValueError if the constraints are not valid.
+    """
+    constraints = {}
+    for item in value.split():
+        name, sep, data = item.partition('=')
+        if not (sep and name in _CONSTRAINTS):
+            raise ValueError('invalid constraint: {}'.format(item))
+        kind = _CONSTRAINTS[name]
+        if kind == 'size':
+            multiplier = _SIZE_MULTIPLIERS.get(data[-1:].upper())
+            number = data[:-1] if multiplier else data
+            try:
+                size = float(number)
+            except ValueError:
+                size = -1
+            if size < 0:
+                raise ValueError('invalid {} constraint: {}'.format(
+                    name, data))
+            constraints[name] = int(round(size * (multiplier or 1)))
+        elif kind == 'int':
+            if not data.isdigit():
+                raise ValueError('invalid {} constraint: {}'.format(
+                    name, data))
+            constraints[name] = int(data)
+        elif kind == 'list':
+            constraints[name] = [i for i in data.split(',') if i]
+        else:
+            constraints[name] = data
+    return constraints
+
+
+def deploy(
+        connection, charm_url, service=None, num_units=None, machine=None,
+        config=None, config_yaml=None, constraints=None):
     """Deploy a charm using the Juju WebSocket API.
 
+    If provided, config is a dict of service options. Alternatively, options
+    can be provided as config_yaml, a YAML string in the "juju deploy
+    --config" format, i.e. mapping service names to their options.
+    If provided, constraints is a dict as returned by parse_constraints.
     Return the deployed service name.
     """
     if service is None:
@@ -173,10 +464,263 @@ def deploy(connection, charm_url, service=None, num_units=None, machine=None):
             'ServiceName': service,
             'NumUnits': num_units,
             'Config': {},
-            'Constraints': {},
+            'Constraints': constraints or {},
             'ToMachineSpec': machine,
         }
     }
+    if config_yaml:
+        request['Params']['ConfigYAML'] = config_yaml
+    elif config:
+        request['Params']['ConfigYAML'] = yaml.safe_dump({service: config})
     response = connection.send(request)
     _check_reponse(response, 'error deploying the charm: {}')
     return service
+
+
+def _add_units_requests(service, placements):
+    """Return the requests adding units with the given placements."""
+    requests = []
+    for machine, group in itertools.groupby(placements):
+        num_units = len(list(group))
+        chunk_size = 1 if machine is not None else UNITS_CHUNK_SIZE
+        while num_units:
+            chunk = min(num_units, chunk_size)
+            num_units -= chunk
+            requests.append({
+                'Type': 'Client',
+                'Request': 'AddServiceUnits',
+                'Params': {
+                    'ServiceName': service,
+                    'NumUnits': chunk,
+                    'ToMachineSpec': machine,
+                },
+            })
+    return requests
+
+
+def _get_units(responses):
+    """Return the unit names included in the given responses."""
+    units = []
+    for response in responses:
+        units.extend(response.get('Response', {}).get('Units') or [])
+    return units
+
+
+def add_units(connection, service, placements):
+    """Add units to the given service using the Juju WebSocket API.
+
+    Receive the list of placements for the new units: each placement is
+    either a machine/container specification or None. Unplaced units are
+    added in chunks, placed ones are added one by one, and requests are
+    pipelined on the connection.
+
+    Return the list of new unit names.
+    """
+    requests = _add_units_requests(service, placements)
+    return _get_units(_send_pipelined(
+        connection, requests, 'error adding units: {}'))
+
+
+def setup_service(
+        connection, service, placements=(), expose=False, relations=(),
+        annotations=None):
+    """Complete the set up of the given deployed service.
+
+    Add units with the given placements (see add_units), expose the service
+    if requested, relate it to the given endpoints, e.g. "mysql:db", and set
+    the given annotations dict on the service.
+    All the requests are pipelined on the connection.
+
+    Return the list of new unit names.
+    """
+    requests = _add_units_requests(service, placements)
+    if annotations:
+        requests.append({
+            'Type': 'Client',
+            'Request': 'SetAnnotations',
+            'Params': {
+                'Tag': 'service-{}'.format(service),
+                'Pairs': annotations,
+            },
+        })
+    if expose:
+        requests.append({
+            'Type': 'Client',
+            'Request': 'ServiceExpose',
+            'Params': {'ServiceName': service},
+        })
+    for endpoint in relations:
+        requests.append({
+            'Type': 'Client',
+            'Request': 'AddRelation',
+            'Params': {'Endpoints': [service, endpoint]},
+        })
+    if not requests:
+        return []
+    return _get_units(_send_pipelined(
+        connection, requests, 'error setting up {}: {{}}'.format(service)))
+
+
+def add_relations(connection, relations):
+    """Add the given relations using the Juju WebSocket API.
+
+    Receive a list of relations, each one being a pair of endpoints, e.g.
+    ('wordpress', 'mysql:db'). Requests are pipelined on the connection.
+    """
+    requests = [{
+        'Type': 'Client',
+        'Request': 'AddRelation',
+        'Params': {'Endpoints': list(endpoints)},
+    } for endpoints in relations]
+    _send_pipelined(connection, requests, 'error adding relation: {}')
+
+
+def get_annotations(connection, tags):
+    """Return the annotations set on the given entities, e.g. "service-ghost".
+
+    Requests are pipelined on the connection. Return a list of annotation
+    dicts, in the same order as tags: entities that do not exist have no
+    annotations.
+    Raise a JujuError if an API error occurs.
+    """
+    requests = [{
+        'Type': 'Client',
+        'Request': 'GetAnnotations',
+        'Params': {'Tag': tag},
+    } for tag in tags]
+    responses = []
+    for start in range(0, len(requests), PIPELINE_SIZE):
+        responses.extend(connection.send_many(
+            requests[start:start + PIPELINE_SIZE]))
+    annotations_list = []
+    for response in responses:
+        if response.get('ErrorCode') == 'not found':
+            annotations_list.append({})
+            continue
+        _check_reponse(response, 'error retrieving annotations: {}')
+        annotations_list.append(
+            response.get('Response', {}).get('Annotations') or {})
+    return annotations_list
+
+
+def set_annotations(connection, tags, annotations):
+    """Set the given annotations dict on the given entities.
+
+    Requests are pipelined on the connection.
+    """
+    requests = [{
+        'Type': 'Client',
+        'Request': 'SetAnnotations',
+        'Params': {'Tag': tag, 'Pairs': annotations},
+    } for tag in tags]
+    _send_pipelined(connection, requests, 'error setting annotations: {}')
+
+
+def destroy_services(connection, services, units=()):
+    """Destroy the given services and units using the Juju WebSocket API.
+
+    The units are destroyed explicitly, so that they start being removed
+    right away. Requests are pipelined on the connection.
+    """
+    requests = []
+    if units:
+        requests.append({
+            'Type': 'Client',
+            'Request': 'DestroyServiceUnits',
+            'Params': {'UnitNames': list(units)},
+        })
+    requests.extend({
+        'Type': 'Client',
+        'Request': 'ServiceDestroy',
+        'Params': {'ServiceName': service},
+    } for service in services)
+    _send_pipelined(connection, requests, 'error destroying services: {}')
+
+
+def destroy_machines(connection, machines):
+    """Destroy the given machines using the Juju WebSocket API."""
+    request = {
+        'Type': 'Client',
+        'Request': 'DestroyMachines',
+        'Params': {'MachineNames': list(machines), 'Force': False},
+    }
+    response = connection.send(request)
+    _check_reponse(response, 'error destroying machines: {}')
+
+
+def watch_all(connection):
+    """Start watching all the environment changes.
+
+    Return the AllWatcher identifier.
+    """
+    request = {'Type': 'Client', 'Request': 'WatchAll'}
+    response = connection.send(request)
+    _check_reponse(response, 'error watching the environment: {}')
+    return response['Response']['AllWatcherId']
+
+
+def next_deltas(connection, watcher_id, callback=None, timeout=None):
+    """Return the next changes notified by the given AllWatcher.
+
+    The first call returns the whole environment state. Each delta is a list
+    including the entity kind (e.g. "service"), the operation ("change" or
+    "remove") and the entity data. Block until changes are available, or
+    until the given timeout in seconds expires: in the latter case, a
+    JujuTimeout is raised and the connection is closed.
+    If a callback is provided, each delta is passed to it as soon as it is
+    decoded, and an empty list is returned: this way large environments are
+    never decoded as a whole.
+    """
+    request = {'Type': 'AllWatcher', 'Request': 'Next', 'Id': watcher_id}
+    options = {}
+    if callback is not None:
+        options.update(path=['Response', 'Deltas'], callback=callback)
+    if timeout is not None:
+        options['timeout'] = timeout
+    response = connection.send(request, **options)
+    _check_reponse(response, 'error watching the environment: {}')
+    return response['Response']['Deltas']
+
+
+def stop_watcher(connection, watcher_id):
+    """Stop the given AllWatcher."""
+    request = {'Type': 'AllWatcher', 'Request': 'Stop', 'Id': watcher_id}
+    response = connection.send(request)
+    _check_reponse(response, 'error stopping the watcher: {}')
+
+
+def count_units(connection):
+    """Return the number of units in the environment.
+
+    The count is used to estimate the environment load. The services are
+    decoded one at a time, and discarded once their units are counted.
+    """
+    request = {
+        'Type': 'Client',
+        'Request': 'FullStatus',
+        'Params': {'Patterns': []},
+    }
+    counts = []
+
+    def count(item):
+        name, service = item
+        counts.append(len(service.get('Units') or {}))
+    response = connection.send(
+        request, path=['Response', 'Services'], callback=count)
+    _check_reponse(response, 'error retrieving the status: {}')
+    return sum(counts)
+
+
+def _send_pipelined(connection, requests, message):
+    """Send the given requests in pipelined batches.
+
+    Return the responses. Raise a JujuError with the given error message if
+    any response is an API error.
+    """
+    responses = []
+    for start in range(0, len(requests), PIPELINE_SIZE):
+        responses.extend(connection.send_many(
+            requests[start:start + PIPELINE_SIZE]))
+    for response in responses:
+        _check_reponse(response, message)
+    return responses
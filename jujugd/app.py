@@ -12,11 +12,29 @@
 
 """Juju Git Deploy base application function."""
 
+from collections import namedtuple
+from concurrent import futures
+from contextlib import contextmanager
+import hashlib
+import io
+import logging
+import os
 import re
+import threading
+
+import yaml
 
 from . import (
     api,
+    archive,
+    cache,
     env,
+    github,
+    leases,
+    metrics,
+    progress,
+    settings,
+    transform,
     utils,
 )
 
@@ -29,11 +47,36 @@ _repo_expression = re.compile(r"""
     (?:github.com/)?  # Optional Domain.
     ([-\w]+)/  # User name.
     ([-\w]+)  # Repository name.
+    ((?:/[-\w.*?\[\]]+)*)  # Optional path to the charms, with wildcards.
     /?  # Optional trailing slash.
-    (?::([-\w]+))?$  # Optional branch/reference name.
+    (?::([-\w]+(?:,[-\w]+)*))?$  # Optional branch/reference names.
 """, re.VERBOSE)
 
 
+# The set up applied to services when deploying them: the service options as
+# YAML in the "juju deploy --config" format, the constraints dict as returned
+# by api.parse_constraints, whether to expose the services, the endpoints to
+# relate them to and the annotations dict to set on them.
+ServiceSetup = namedtuple(
+    'ServiceSetup', 'config_yaml constraints expose relations annotations',
+    defaults=(None, None, False, (), None))
+
+# The origin of a charm: the Github repository in the {user}/{repo} form, the
+# reference (empty for the default branch) and the commit SHA. All the fields
+# are None for local charm directories.
+Provenance = namedtuple('Provenance', 'repo ref commit')
+
+# A charm stored in a subdirectory of a repository: its path, the zip
+# contents, the hash of the charm relevant files and its Provenance.
+_Charm = namedtuple('_Charm', 'path contents tree provenance')
+
+# Define the annotation keys recording the origin of the deployed services.
+REPO_ANNOTATION = 'juju-git-deploy-repo'
+REF_ANNOTATION = 'juju-git-deploy-ref'
+COMMIT_ANNOTATION = 'juju-git-deploy-commit'
+TREE_ANNOTATION = 'juju-git-deploy-tree'
+
+
 class ProgramExit(Exception):
     """An error occurred in the application.
 
@@ -48,65 +91,1092 @@ class ProgramExit(Exception):
         return 'juju-git-deploy: error: {}'.format(self.message)
 
 
-def prepare(repo, env_name, series):
-    """Prepare the Juju environment.
+def get_zip_urls(repo):
+    """Return the Github zip URLs for the given repository.
 
-    Return the Github zip URL, the Juju API address and password.
+    A zip URL is returned for each one of the comma separated references
+    included in repo, e.g. "hatched/ghost-charm:master,develop".
+    If a charm archive proxy is configured, the returned URLs point to the
+    proxy rather than to Github.
+    If repo is a local directory, return a list including its absolute path
+    instead.
+    Raise a ProgramExit if the repository is not valid.
+    """
+    if os.path.isdir(repo):
+        # The charm is in a local working tree.
+        return [os.path.abspath(repo)]
+    match = _repo_expression.match(repo)
+    if match is None:
+        raise ProgramExit('invalid repository: {}'.format(repo))
+    user, repo_name, _, branches = match.groups()
+    if branches is None:
+        branches = ''
+    proxy = github.get_proxy()
+    base = GITHUB_API if proxy is None else '{}/repos'.format(proxy)
+    return [
+        '{}/{}/{}/zipball/{}'.format(base, user, repo_name, branch)
+        for branch in branches.split(',')]
+
+
+def get_zip_url(repo):
+    """Return the Github zip URL for the given repository.
+
+    See get_zip_urls above.
+    Raise a ProgramExit if the repository is not valid or includes multiple
+    references.
+    """
+    zip_urls = get_zip_urls(repo)
+    if len(zip_urls) > 1:
+        msg = 'multiple references not supported: {}'.format(repo)
+        raise ProgramExit(msg)
+    return zip_urls[0]
+
+
+def get_charm_path(repo):
+    """Return the path to the charms within the given Github repository.
+
+    The path follows the repository name, e.g. "frankban/charms/charms/mysql",
+    and can include shell-style wildcards selecting multiple charms, e.g.
+    "frankban/charms/charms/*". Return an empty string if the charm is the
+    repository itself, or if repo is a local directory.
+    Raise a ProgramExit if the repository is not valid.
+    """
+    if os.path.isdir(repo):
+        return ''
+    match = _repo_expression.match(repo)
+    if match is None:
+        raise ProgramExit('invalid repository: {}'.format(repo))
+    return match.group(3).strip('/')
+
+
+def discover(env_name, series):
+    """Retrieve information about the given Juju environment.
+
+    If series is None, look up the default environment series. The juju
+    commands required to retrieve the API address and the bootstrap node
+    series are run in parallel.
+    Return the Juju API address, password and OS series.
     """
-    # Retrieve the Juju API address, password and, if required, OS series.
     try:
-        api_address = api.get_api_address(env_name)
         password = env.parse_jenv(env_name, env.get_password)
         if series is None:
             series = env.parse_jenv(env_name, env.get_default_series)
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            api_address = executor.submit(api.get_api_address, env_name)
             if not series:
-                series = env.get_bootstrap_node_series(env_name)
+                series = executor.submit(
+                    env.get_bootstrap_node_series, env_name).result()
+            api_address = api_address.result()
     except ValueError as err:
         raise ProgramExit(str(err))
-    # Generate the Github zip URL.
-    match = _repo_expression.match(repo)
-    if match is None:
-        raise ProgramExit('invalid repository: {}'.format(repo))
-    user, repo_name, branch = match.groups()
-    if branch is None:
-        branch = ''
-    zip_url = '{}/{}/{}/zipball/{}'.format(GITHUB_API, user, repo_name, branch)
-    return zip_url, api_address, password, series
+    return api_address, password, series
 
 
-def process(zip_url, api_address, password, series):
-    """Upload the charm represented by the given zip URL and OS series.
+def prepare(repo, env_name, series):
+    """Prepare the Juju environment.
 
-    If series is None, use the default Juju environment series.
+    Return the Github zip URL, the Juju API address and password.
+    If repo is a local directory, its absolute path is returned in place of
+    the Github zip URL.
+    """
+    api_address, password, series = discover(env_name, series)
+    return get_zip_url(repo), api_address, password, series
 
-    Use the given API address and password to upload the charm to Juju.
-    Return the resulting charm URL
+
+def _open(zip_url, output=None):
+    """Return a file-like object with the contents of the charm.
+
+    Progress messages are printed, or passed to output if provided.
     """
-    print('connecting to github')
+    if output is None:
+        output = print
+    if os.path.isdir(zip_url):
+        output('building charm archive')
+        cache = archive.MemberCache(
+            os.path.join(settings.CACHE_DIR, 'members'))
+        try:
+            return archive.build(zip_url, cache=cache)
+        except (IOError, ValueError) as err:
+            msg = 'unable to build charm archive: {}'.format(err)
+            raise ProgramExit(msg)
+    output('connecting to github')
     try:
-        response = utils.urlget(zip_url)
+        response = github.urlget(zip_url, output=output)
     except IOError as err:
         msg = 'unable to retrieve charm contents: {}'.format(err)
         raise ProgramExit(msg)
-    print('uploading charm')
+    length = response.headers.get('Content-Length')
+    return progress.ProgressStream(response, progress.Progress(
+        'downloading charm', total=int(length) if length else None,
+        output=output))
+
+
+def _upload(stream, api_address, password, series):
+    """Upload the charm in the given stream. Return the charm URL."""
+    stream = progress.ProgressStream(
+        stream, progress.Progress('uploading charm', total=stream.length))
     try:
-        charm_url = api.upload_charm(api_address, response, password, series)
+        return api.upload_charm(api_address, stream, password, series)
     except IOError as err:
         msg = 'charm upload failed: {}'.format(err)
         raise ProgramExit(msg)
-    return charm_url
 
 
-def deploy(charm_url, service, num_units, machine, api_address, password):
-    """Deploy a charm using the Juju API."""
-    print('deploying {}'.format(charm_url))
+def get_commit(zip_url, output=None):
+    """Return the commit SHA the given Github zip URL currently points to.
+
+    Progress messages are printed, or passed to output if provided.
+    Raise a ProgramExit if the commit cannot be retrieved.
+    """
+    base, ref = zip_url.rsplit('/zipball/', 1)
+    url = '{}/commits/{}'.format(base, ref or 'HEAD')
+    headers = {'Accept': 'application/vnd.github.v3.sha'}
+    try:
+        response = github.urlget(url, headers=headers, output=output)
+        return response.read().decode('utf-8')
+    except IOError as err:
+        msg = 'unable to retrieve the repository commit: {}'.format(err)
+        raise ProgramExit(msg)
+
+
+def get_provenance(zip_url, session=None, output=None):
+    """Return the Provenance of the charm represented by the given zip URL.
+
+    The commit is retrieved using the given Session, if provided, passing
+    progress messages to output (see get_commit).
+    Raise a ProgramExit if the commit cannot be retrieved.
+    """
+    if os.path.isdir(zip_url):
+        return Provenance(None, None, None)
+    if session is None:
+        session = Session()
+    base, ref = zip_url.rsplit('/zipball/', 1)
+    repo = '/'.join(base.split('/')[-2:])
+    return Provenance(
+        repo, ref, session.get_commit(zip_url, output=output))
+
+
+def _get_provenance_annotations(provenance, tree=None):
+    """Return the annotations recording the given Provenance and tree hash."""
+    annotations = {
+        REPO_ANNOTATION: provenance.repo,
+        REF_ANNOTATION: provenance.ref,
+        COMMIT_ANNOTATION: provenance.commit,
+    }
+    if tree is not None:
+        annotations[TREE_ANNOTATION] = tree
+    return annotations
+
+
+def add_provenance(setup, provenance, tree=None):
+    """Return the given ServiceSetup also recording the given Provenance.
+
+    The provenance and, if provided, the hash of the charm relevant files (see
+    get_tree) are stored in the service annotations. Return the setup
+    unchanged for local charm directories.
+    """
+    if setup is None:
+        setup = ServiceSetup()
+    if provenance.commit is None:
+        return setup
+    annotations = dict(setup.annotations or {})
+    annotations.update(_get_provenance_annotations(provenance, tree=tree))
+    return setup._replace(annotations=annotations)
+
+
+def get_tree(contents, transforms=()):
+    """Return the hash of the charm relevant files in the given zip contents.
+
+    If transforms are provided, the hash also changes with their versions.
+    Return None if the contents are not a valid zip archive.
+    """
+    return get_stream_tree(io.BytesIO(contents), transforms)
+
+
+def get_stream_tree(stream, transforms=()):
+    """Return the hash of the charm relevant files in the given zip stream.
+
+    The stream must be seekable: only the archive central directory is read,
+    and the stream is rewound afterwards, so that it can be uploaded.
+    See get_tree for a description of the transforms and the return value.
+    """
+    try:
+        tree = archive.get_tree_hash(stream)
+    except ValueError as err:
+        logging.debug('unable to hash the charm tree: {}'.format(err))
+        return None
+    finally:
+        stream.seek(0)
+    if transforms:
+        key = '{}\0{}'.format(tree, transform.get_fingerprint(transforms))
+        tree = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return tree
+
+
+def get_transforms(zip_url, path=''):
+    """Return the transforms to apply to the charm in the given zip URL.
+
+    If a path is provided, return the transforms to apply to the charm in
+    that subdirectory of the repository.
+    Raise a ProgramExit if the transforms are not valid.
+    """
+    name = zip_url
+    if not os.path.isdir(zip_url):
+        base = zip_url.rsplit('/zipball/', 1)[0]
+        name = '/'.join(base.split('/')[-2:] + ([path] if path else []))
+    try:
+        return transform.get_transforms(name)
+    except ValueError as err:
+        raise ProgramExit(str(err))
+
+
+def apply_transforms(contents, transforms, output=None):
+    """Return the given charm zip contents after applying the transforms.
+
+    Progress messages are printed, or passed to output if provided.
+    Raise a ProgramExit if the charm cannot be transformed.
+    """
+    if not transforms:
+        return contents
+    if output is None:
+        output = print
+    output('transforming charm')
+    try:
+        return transform.apply(contents, transforms)
+    except (OSError, ValueError) as err:
+        msg = 'unable to transform charm: {}'.format(err)
+        raise ProgramExit(msg)
+
+
+def split_charms(contents, pattern):
+    """Split the given repository zip contents into charm archives.
+
+    Only include the charms whose path matches the given pattern (see
+    get_charm_path). Return a list of (charm path, zip contents) tuples.
+    Raise a ProgramExit if no charms are found.
+    """
+    try:
+        charms = archive.split(io.BytesIO(contents), pattern)
+    except ValueError as err:
+        msg = 'unable to split charm archive: {}'.format(err)
+        raise ProgramExit(msg)
+    if not charms:
+        raise ProgramExit('no charms found in {}'.format(pattern))
+    return charms
+
+
+def get_service_names(service, series_list):
+    """Return the names of the services deployed for the given series.
+
+    This mirrors get_services before the charm URLs are known: return None
+    in place of the names if they must be derived from the charm name.
+    """
+    if len(series_list) == 1:
+        return [service]
+    if service is None:
+        return [None] * len(series_list)
+    return ['{}-{}'.format(service, series) for series in series_list]
+
+
+def get_ref_service(service, ref):
+    """Return the name of the service deployed for the given reference.
+
+    The reference is appended to the service name, e.g. "ghost-develop".
+    """
+    suffix = re.sub('[^a-z0-9]+', '-', ref.lower()).strip('-')
+    return '{}-{}'.format(service, suffix)
+
+
+def get_deployed(services, provenance, api_address, password, session=None):
+    """Return the annotations of the given deployed services.
+
+    The annotations of all the services are retrieved in a single pipelined
+    round trip, using an API connection retrieved from the given Session, if
+    provided. Services not deployed have no annotations. Return None if the
+    charm is local or any of the service names is unknown.
+    Raise a ProgramExit if an API error occurs.
+    """
+    if provenance.commit is None or None in services:
+        return None
+    if session is None:
+        session = Session()
+    tags = ['service-{}'.format(service) for service in services]
+    try:
+        with session.connect(api_address, password) as connection:
+            return api.get_annotations(connection, tags)
+    except api.JujuError as err:
+        msg = 'API failure: {}'.format(err)
+        raise ProgramExit(msg)
+
+
+def is_current(deployed, provenance):
+    """Return whether the deployed services already run the charm commit.
+
+    Receive the annotations returned by get_deployed.
+    """
+    if not deployed:
+        return False
+    return all(
+        annotations.get(REPO_ANNOTATION) == provenance.repo and
+        annotations.get(COMMIT_ANNOTATION) == provenance.commit
+        for annotations in deployed)
+
+
+def is_unchanged(deployed, provenance, tree):
+    """Return whether the deployed services already run the charm files.
+
+    Receive the annotations returned by get_deployed and the hash of the
+    charm relevant files returned by get_tree: the services are unchanged if
+    they have been deployed from the same repository with the same hash,
+    even if at a different commit.
+    """
+    if not deployed or tree is None:
+        return False
+    return all(
+        annotations.get(REPO_ANNOTATION) == provenance.repo and
+        annotations.get(TREE_ANNOTATION) == tree
+        for annotations in deployed)
+
+
+def record_provenance(
+        services, provenance, tree, api_address, password, session=None):
+    """Record the given Provenance and tree hash on the deployed services.
+
+    This is used when a new commit does not change the charm relevant files,
+    so that the services are recognized as current by later deployments.
+    Raise a ProgramExit if an API error occurs.
+    """
+    if session is None:
+        session = Session()
+    tags = ['service-{}'.format(service) for service in services]
+    annotations = _get_provenance_annotations(provenance, tree=tree)
+    try:
+        with session.connect(api_address, password) as connection:
+            api.set_annotations(connection, tags, annotations)
+    except api.JujuError as err:
+        msg = 'API failure: {}'.format(err)
+        raise ProgramExit(msg)
+
+
+def acquire_lease(env_name, service, provenance, zip_url, output=None):
+    """Take the deployment lease on the given service, waiting for it.
+
+    If the service name is None, the lease is taken on the repository (or
+    the local charm), as the service name is derived from the charm.
+    Waiting is printed, or reported to output if provided.
+    Return the leases.Lease.
+    Raise leases.Superseded if a newer deployment of the service has been
+    requested in the meanwhile.
+    Raise a ProgramExit if the lease cannot be taken.
+    """
+    key = service or provenance.repo or zip_url
+    try:
+        return leases.acquire(
+            env_name, key, provenance.commit, output=output)
+    except IOError as err:
+        msg = 'unable to take the deployment lease: {}'.format(err)
+        raise ProgramExit(msg)
+
+
+def _read(zip_url, output=None):
+    """Return the contents of the charm represented by the given zip URL.
+
+    Progress messages are printed, or passed to output if provided.
+    """
+    stream = _open(zip_url, output=output)
     try:
+        # Read in chunks, so that the download progress is reported.
+        return b''.join(iter(lambda: stream.read(progress.CHUNK_SIZE), b''))
+    except IOError as err:
+        msg = 'unable to retrieve charm contents: {}'.format(err)
+        raise ProgramExit(msg)
+
+
+def fetch(zip_url, commit=None, output=None):
+    """Return the contents of the charm represented by the given zip URL.
+
+    Github archives are stored in a cache shared by all the plugin processes,
+    keyed by repository and commit. If commit is None, the commit the zip URL
+    currently points to is retrieved from Github.
+    See process for a description of how local directories are handled.
+    Progress messages are printed, or passed to output if provided.
+    """
+    if os.path.isdir(zip_url):
+        return _read(zip_url, output=output)
+    if commit is None:
+        commit = get_commit(zip_url, output=output)
+    base = zip_url.rsplit('/zipball/', 1)[0]
+    archive_cache = cache.ArchiveCache(
+        os.path.join(settings.CACHE_DIR, 'archives'))
+    return archive_cache.get(
+        '{}@{}'.format(base, commit),
+        lambda: _read('{}/zipball/{}'.format(base, commit), output=output))
+
+
+def process(
+        zip_url, api_address, password, series, session=None, stats=None,
+        commit=None):
+    """Upload the charm represented by the given zip URL and OS series.
+
+    If series is None, use the default Juju environment series.
+    If zip_url is a local charm directory, the zip archive is built in process,
+    compressing again only the files changed since the last build.
+    Otherwise the archive is retrieved through the shared archive cache.
+    The charm contents are opened using the given Session, if provided.
+    If a stats dict is provided, the number of uploaded bytes is stored in it
+    under the "bytes" key. If commit is provided, the archive for that commit
+    is used. The configured transforms are applied before the upload.
+
+    Use the given API address and password to upload the charm to Juju.
+    Return the resulting charm URL
+    """
+    if session is None:
+        session = Session()
+    transforms = get_transforms(zip_url)
+    with session.open(zip_url, commit=commit) as stream:
+        return process_stream(
+            stream, api_address, password, series, transforms=transforms,
+            stats=stats)
+
+
+def process_stream(
+        stream, api_address, password, series, transforms=(), stats=None):
+    """Upload the charm in the given stream, applying the given transforms.
+
+    See process for a description of the other arguments.
+    Return the resulting charm URL.
+    """
+    if transforms:
+        stream = utils.BytesStream(
+            apply_transforms(stream.read(), transforms))
+    if stats is not None:
+        stats['bytes'] = stream.length
+    print('uploading charm')
+    return _upload(stream, api_address, password, series)
+
+
+def upload_series(
+        contents, api_address, password, series_list, jobs, pool=None,
+        slots=None):
+    """Upload the charm zip contents once for each of the given OS series.
+
+    Uploads are performed in parallel, using at most the given number of jobs,
+    reusing the HTTPS connections to the Juju API server. If a
+    utils.ConnectionPool is provided, connections are kept alive in the pool,
+    otherwise they are closed when done. If a semaphore is provided as slots,
+    each upload also holds one of its slots, so that the parallel uploads to
+    multiple environments share the same jobs budget.
+    Return the list of resulting charm URLs, in the same order as series_list.
+    """
+    close_pool = pool is None
+    if close_pool:
+        pool = utils.ConnectionPool()
+    if slots is None:
+        slots = threading.BoundedSemaphore(jobs)
+
+    def upload(series):
+        # Uploads run in parallel: always report progress in separate lines.
+        stream = progress.ProgressStream(
+            utils.BytesStream(contents), progress.Progress(
+                'uploading charm to {} for {}'.format(api_address, series),
+                total=len(contents), tty=False))
+        with slots:
+            return api.upload_charm(
+                api_address, stream, password, series, pool=pool)
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(upload, series_list))
+    except IOError as err:
+        msg = 'charm upload failed: {}'.format(err)
+        raise ProgramExit(msg)
+    finally:
+        if close_pool:
+            pool.close()
+
+
+def get_services(charm_urls, service):
+    """Return the service names to use when deploying the given charm URLs.
+
+    If multiple charm URLs are provided, the charm series is appended to each
+    service name, so that a service is deployed for each series.
+    """
+    if len(charm_urls) == 1:
+        return [service]
+    services = []
+    for charm_url in charm_urls:
+        name = service or utils.get_service_from_charm(charm_url)
+        series = charm_url.split(':', 1)[1].split('/')[0]
+        services.append('{}-{}'.format(name, series))
+    return services
+
+
+def get_service_config(options, service):
+    """Return the options for the given service from the given mapping.
+
+    The mapping is the parsed "juju deploy --config" YAML, keyed by service
+    name. Services deployed for multiple series or references are named after
+    the requested service with a suffix (see get_services and
+    get_ref_service): their options are the ones of the longest name the
+    service name starts with, followed by a dash.
+    Return None if no options are found for the service.
+    """
+    if service in options:
+        return options[service]
+    names = [
+        name for name in options
+        if service.startswith('{}-'.format(name))]
+    if names:
+        return options[max(names, key=len)]
+    return None
+
+
+def get_placements(num_units, machines):
+    """Return the placement of each one of the given number of units.
+
+    Units are spread across the given list of machines/containers. If machines
+    is None, all the units are unplaced.
+    """
+    if not machines:
+        return [None] * num_units
+    return [machines[i % len(machines)] for i in range(num_units)]
+
+
+def deploy_services(
+        connection, charm_urls, services, num_units, machines, config=None,
+        setup=None):
+    """Deploy the charms using the given logged in API connection.
+
+    A service is deployed for each charm URL, optionally using the given dict
+    of service options, or the options found for the service in the YAML of
+    the given ServiceSetup (see get_service_config). The first units are
+    created when the service is deployed. The remaining ones are then added
+    in batches, pipelined with the requests exposing and relating the service
+    as described by the given ServiceSetup, if provided.
+    Return the list of deployed service names.
+    Raise an api.JujuError if an API error occurs.
+    """
+    if setup is None:
+        setup = ServiceSetup()
+    placements = get_placements(num_units or 1, machines)
+    # Unplaced units can be created together with the service.
+    first = 1 if machines else min(len(placements), api.UNITS_CHUNK_SIZE)
+    options = None
+    if setup.config_yaml:
+        options = yaml.safe_load(setup.config_yaml)
+    deployed_services = []
+    for charm_url, service in zip(charm_urls, services):
+        config_yaml = None
+        if options is not None:
+            # The options are keyed by the requested service name, which
+            # does not include the series or reference suffixes.
+            name = service or utils.get_service_from_charm(charm_url)
+            config = get_service_config(options, name)
+            if config is None:
+                # Let Juju report the missing options.
+                config_yaml = setup.config_yaml
+        service = api.deploy(
+            connection, charm_url, service=service, num_units=first,
+            machine=placements[0], config=config, config_yaml=config_yaml,
+            constraints=setup.constraints)
+        api.setup_service(
+            connection, service, placements[first:], expose=setup.expose,
+            relations=setup.relations, annotations=setup.annotations)
+        deployed_services.append(service)
+    return deployed_services
+
+
+class Session:
+    """Provide the resources used to deploy charms.
+
+    This implementation does not keep anything across deployments: subclasses
+    can override the methods below to keep environment information, archives
+    and connections warm.
+    """
+
+    # The utils.ConnectionPool used to upload charms.
+    pool = None
+
+    def discover(self, env_name, series):
+        """See the discover function above."""
+        return discover(env_name, series)
+
+    def get_commit(self, zip_url, output=None):
+        """See the get_commit function above."""
+        return get_commit(zip_url, output=output)
+
+    def fetch(self, zip_url, commit=None, output=None):
+        """See the fetch function above."""
+        return fetch(zip_url, commit=commit, output=output)
+
+    def open(self, zip_url, commit=None, output=None):
+        """Return a file-like object with the charm contents.
+
+        The returned object also exposes the contents length. If commit is
+        provided, the archive for that commit is used. Progress is reported
+        as described in fetch.
+        """
+        if os.path.isdir(zip_url):
+            return _open(zip_url, output=output)
+        return utils.BytesStream(
+            self.fetch(zip_url, commit=commit, output=output))
+
+    @contextmanager
+    def connect(self, api_address, password):
+        """Return a logged in API connection in the context block.
+
+        Raise an api.JujuError if the connection cannot be established.
+        """
         with api.connect(api_address) as connection:
             api.login(connection, password)
-            deployed_service = api.deploy(
-                connection, charm_url, service=service, num_units=num_units,
-                machine=machine)
+            yield connection
+
+
+def _deploy(
+        charm_urls, services, num_units, machines, api_address, password,
+        session=None, setup=None):
+    """Deploy the charms using the Juju API.
+
+    A service is deployed for each charm URL, using a single API connection
+    retrieved from the given session, and set up as described by the given
+    ServiceSetup, if provided.
+    Return the list of deployed service names.
+    """
+    if session is None:
+        session = Session()
+    try:
+        with session.connect(api_address, password) as connection:
+            return deploy_services(
+                connection, charm_urls, services, num_units, machines,
+                setup=setup)
     except api.JujuError as err:
         msg = 'API failure: {}'.format(err)
         raise ProgramExit(msg)
-    print('deployed as service {}'.format(deployed_service))
+
+
+def deploy(
+        charm_url, service, num_units, machines, api_address, password,
+        setup=None):
+    """Deploy a charm using the Juju API.
+
+    Units are spread across the given list of machines/containers, if
+    provided. The service is set up as described by the given ServiceSetup,
+    if provided.
+    Return the deployed service name.
+    """
+    print('deploying {}'.format(charm_url))
+    deployed_services = _deploy(
+        [charm_url], [service], num_units, machines, api_address, password,
+        setup=setup)
+    print('deployed as service {}'.format(deployed_services[0]))
+    return deployed_services[0]
+
+
+def fan_out(
+        repo, env_names, series_list, service, num_units, machines, jobs,
+        session=None, recorder=None, setup=None):
+    """Deploy the charm in the given repo to multiple environments and series.
+
+    The charm is retrieved only once. Then, for each environment, the charm
+    is uploaded for each series and deployed, using at most the given number
+    of parallel jobs. Environments where the services already run the current
+    commit of the charm are skipped, and the charm is not retrieved at all if
+    all the environments are skipped. Environments where the services run
+    another commit with the same charm relevant files are skipped as well.
+    The deployment lease on the service is held while uploading and
+    deploying: concurrent deployments of the same commit are reused, and
+    environments where a newer commit has been requested are skipped.
+    If series_list is [None], the default environment series is used.
+    Resources are retrieved using the given Session, if provided. The
+    duration of each phase is recorded in the given metrics.Recorder, if
+    provided. Services are set up as described by the given ServiceSetup, if
+    provided, and annotated with the charm provenance. See the functions
+    above for a description of the other arguments.
+
+    Return a dict mapping environment names to deployed service names.
+    Raise a ProgramExit including the errors occurred in each environment if
+    the deployment failed in any of them.
+    """
+    if session is None:
+        session = Session()
+    if recorder is None:
+        recorder = metrics.Recorder(repo)
+    zip_url = get_zip_url(repo)
+    provenance = get_provenance(zip_url, session=session)
+    transforms = get_transforms(zip_url)
+    # Limit the number of uploads across all the environments.
+    slots = threading.BoundedSemaphore(jobs)
+    # The charm contents and tree hash, and the transformed contents, or the
+    # errors occurred retrieving them.
+    fetched, transformed = [], []
+    fetch_lock = threading.Lock()
+
+    def get_once(results, func):
+        with fetch_lock:
+            if not results:
+                try:
+                    results.append(func())
+                except ProgramExit as err:
+                    results.append(err)
+        if isinstance(results[0], ProgramExit):
+            raise results[0]
+        return results[0]
+
+    def fetch_contents():
+        contents = session.fetch(zip_url, commit=provenance.commit)
+        tree = None
+        if provenance.commit is not None:
+            tree = get_tree(contents, transforms)
+        return contents, tree
+
+    def get_contents():
+        return get_once(fetched, fetch_contents)
+
+    def get_transformed():
+        # Transforms only run once a service needs the upload.
+        contents, _ = get_contents()
+        return get_once(
+            transformed, lambda: apply_transforms(contents, transforms))
+
+    def run(env_name):
+        # Only the first series can be None, in which case the default series
+        # for the environment is returned.
+        with recorder.measure('prepare', env_name):
+            api_address, password, series = session.discover(
+                env_name, series_list[0])
+        env_series_list = [series] + series_list[1:]
+        try:
+            lease = acquire_lease(env_name, service, provenance, zip_url)
+        except leases.Superseded as err:
+            print('{}: deployment {}'.format(env_name, err))
+            return []
+        with lease:
+            services = lease.get_result(provenance.commit)
+            if services is not None:
+                print('{}: {} deployed concurrently at {}'.format(
+                    env_name, ', '.join(services), provenance.commit))
+                return services
+            services = update(
+                env_name, api_address, password, env_series_list)
+            lease.record(provenance.commit, services)
+            return services
+
+    def update(env_name, api_address, password, env_series_list):
+        names = get_service_names(service, env_series_list)
+        deployed = get_deployed(
+            names, provenance, api_address, password, session=session)
+        if is_current(deployed, provenance):
+            print('{}: {} already at {}'.format(
+                env_name, ', '.join(names), provenance.commit))
+            return names
+        contents, tree = get_contents()
+        if is_unchanged(deployed, provenance, tree):
+            record_provenance(
+                names, provenance, tree, api_address, password,
+                session=session)
+            print('{}: {} unchanged at {}'.format(
+                env_name, ', '.join(names), provenance.commit))
+            return names
+        print('{}: uploading charm for {}'.format(
+            env_name, ', '.join(env_series_list)))
+        with recorder.measure('process', env_name) as stats:
+            contents = get_transformed()
+            charm_urls = upload_series(
+                contents, api_address, password, env_series_list, jobs,
+                pool=session.pool, slots=slots)
+            stats['bytes'] = len(contents) * len(charm_urls)
+        print('{}: deploying {}'.format(env_name, ', '.join(charm_urls)))
+        with recorder.measure('deploy', env_name):
+            services = _deploy(
+                charm_urls, get_services(charm_urls, service), num_units,
+                machines, api_address, password, session=session,
+                setup=add_provenance(setup, provenance, tree=tree))
+        print('{}: deployed as {} {}'.format(
+            env_name, 'service' if len(services) == 1 else 'services',
+            ', '.join(services)))
+        return services
+
+    return _run_all(run, env_names, jobs)
+
+
+def deploy_charms(
+        repo, env_names, series_list, service, num_units, machines, jobs,
+        session=None, recorder=None, setup=None):
+    """Deploy the charms stored in a subdirectory of the given repo.
+
+    The repository includes the path to the charms (see get_charm_path). The
+    repository archive is retrieved only once and split into an archive for
+    each charm. Then, for each environment, all the charms are uploaded in
+    parallel, and a service named after each charm directory is deployed.
+    A service name can be provided only if a single charm is selected.
+    Services are skipped if they already run the same commit or the same
+    charm relevant files, as in fan_out. See fan_out for a description of
+    the other arguments.
+
+    Return a dict mapping environment names to deployed service names.
+    Raise a ProgramExit if the charms cannot be retrieved, or including the
+    errors occurred in each environment if the deployment failed in any of
+    them.
+    """
+    if session is None:
+        session = Session()
+    if recorder is None:
+        recorder = metrics.Recorder(repo)
+    zip_url = get_zip_url(repo)
+    provenance = get_provenance(zip_url, session=session)
+    charms = split_charms(
+        session.fetch(zip_url, commit=provenance.commit),
+        get_charm_path(repo))
+    if service is not None and len(charms) > 1:
+        raise ProgramExit('cannot use a service name with {} charms'.format(
+            len(charms)))
+    print('found {} charms: {}'.format(
+        len(charms), ', '.join(path for path, _ in charms)))
+
+    def prepare_charm(charm):
+        path, contents = charm
+        transforms = get_transforms(zip_url, path)
+        # Each charm is recorded as coming from its path in the repository.
+        return _Charm(
+            path, apply_transforms(contents, transforms),
+            get_tree(contents, transforms),
+            provenance._replace(repo='{}/{}'.format(provenance.repo, path)))
+
+    # Charms are transformed in parallel.
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        charms = list(executor.map(prepare_charm, charms))
+    # Limit the number of uploads across all the environments.
+    slots = threading.BoundedSemaphore(jobs)
+
+    def run(env_name):
+        # Only the first series can be None, in which case the default series
+        # for the environment is returned.
+        with recorder.measure('prepare', env_name):
+            api_address, password, series = session.discover(
+                env_name, series_list[0])
+        env_series_list = [series] + series_list[1:]
+        names_list = [
+            get_service_names(
+                service or charm.path.rsplit('/', 1)[-1], env_series_list)
+            for charm in charms]
+        deployed = get_deployed(
+            sum(names_list, []), provenance, api_address, password,
+            session=session)
+        services, pending = [], []
+        for index, (charm, names) in enumerate(zip(charms, names_list)):
+            charm_deployed = None
+            if deployed is not None:
+                start = index * len(names)
+                charm_deployed = deployed[start:start + len(names)]
+            if is_current(charm_deployed, charm.provenance):
+                print('{}: {} already at {}'.format(
+                    env_name, ', '.join(names), provenance.commit))
+            elif is_unchanged(charm_deployed, charm.provenance, charm.tree):
+                record_provenance(
+                    names, charm.provenance, charm.tree, api_address,
+                    password, session=session)
+                print('{}: {} unchanged at {}'.format(
+                    env_name, ', '.join(names), provenance.commit))
+            else:
+                pending.append((charm, names))
+                continue
+            services.extend(names)
+        if not pending:
+            return services
+        print('{}: uploading {} charms for {}'.format(
+            env_name, len(pending), ', '.join(env_series_list)))
+
+        def upload(charm):
+            return upload_series(
+                charm.contents, api_address, password, env_series_list, jobs,
+                pool=session.pool, slots=slots)
+
+        with recorder.measure('process', env_name) as stats:
+            with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                uploads = list(executor.map(upload, [i for i, _ in pending]))
+            stats['bytes'] = len(env_series_list) * sum(
+                len(charm.contents) for charm, _ in pending)
+        with recorder.measure('deploy', env_name):
+            try:
+                with session.connect(api_address, password) as connection:
+                    for (charm, names), charm_urls in zip(pending, uploads):
+                        print('{}: deploying {}'.format(
+                            env_name, ', '.join(charm_urls)))
+                        services.extend(deploy_services(
+                            connection, charm_urls, names, num_units,
+                            machines, setup=add_provenance(
+                                setup, charm.provenance, tree=charm.tree)))
+            except api.JujuError as err:
+                msg = 'API failure: {}'.format(err)
+                raise ProgramExit(msg)
+        print('{}: deployed as services {}'.format(
+            env_name, ', '.join(services)))
+        return services
+
+    return _run_all(run, env_names, jobs)
+
+
+def deploy_refs(
+        repo, env_names, series_list, service, num_units, machines, jobs,
+        session=None, recorder=None, setup=None):
+    """Deploy multiple references of the given repo side by side.
+
+    The repository includes comma separated references (see get_zip_urls),
+    which are all resolved to commits before retrieving anything. Then, for
+    each environment, a service is deployed for each reference, appending
+    the reference to the service name (see get_ref_service). Archives are
+    downloaded in parallel, only once for all the environments, and charms
+    with the same relevant files are only uploaded once. The services are
+    deployed using a single API connection. Services are skipped if they
+    already run the same commit or the same charm relevant files, as in
+    fan_out: this requires a service name to be provided. See fan_out for a
+    description of the other arguments.
+
+    Return a dict mapping environment names to deployed service names.
+    Raise a ProgramExit if the references cannot be resolved, or including
+    the errors occurred in each environment if the deployment failed in any
+    of them.
+    """
+    if session is None:
+        session = Session()
+    if recorder is None:
+        recorder = metrics.Recorder(repo)
+    zip_urls = get_zip_urls(repo)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        provenances = list(executor.map(
+            lambda zip_url: get_provenance(zip_url, session=session),
+            zip_urls))
+    for provenance in provenances:
+        print('{} at {}'.format(provenance.ref, provenance.commit))
+    transforms = get_transforms(zip_urls[0])
+    # Limit the number of uploads across all the environments.
+    slots = threading.BoundedSemaphore(jobs)
+    # Map commits to the tasks retrieving their contents and tree hash.
+    downloads = futures.ThreadPoolExecutor(max_workers=jobs)
+    fetched = {}
+    fetch_lock = threading.Lock()
+
+    def download(zip_url, commit):
+        contents = session.fetch(zip_url, commit=commit)
+        return (
+            apply_transforms(contents, transforms),
+            get_tree(contents, transforms))
+
+    def get_contents(index):
+        zip_url, commit = zip_urls[index], provenances[index].commit
+        with fetch_lock:
+            if commit not in fetched:
+                fetched[commit] = downloads.submit(download, zip_url, commit)
+        return fetched[commit]
+
+    def run(env_name):
+        # Only the first series can be None, in which case the default series
+        # for the environment is returned.
+        with recorder.measure('prepare', env_name):
+            api_address, password, series = session.discover(
+                env_name, series_list[0])
+        env_series_list = [series] + series_list[1:]
+        names_list = [
+            get_service_names(
+                service and get_ref_service(service, provenance.ref),
+                env_series_list)
+            for provenance in provenances]
+        deployed = get_deployed(
+            sum(names_list, []), provenances[0], api_address, password,
+            session=session)
+        charm_deployed, pending = [None] * len(provenances), []
+        for index, (provenance, names) in enumerate(
+                zip(provenances, names_list)):
+            if deployed is not None:
+                start = index * len(names)
+                charm_deployed[index] = deployed[start:start + len(names)]
+            if is_current(charm_deployed[index], provenance):
+                print('{}: {} already at {}'.format(
+                    env_name, ', '.join(names), provenance.commit))
+            else:
+                pending.append(index)
+        # Start all the downloads before waiting for any of them.
+        tasks = [(i, get_contents(i)) for i in pending]
+        trees, uploads = {}, {}
+        for index, task in tasks:
+            contents, trees[index] = task.result()
+            provenance, names = provenances[index], names_list[index]
+            if is_unchanged(charm_deployed[index], provenance, trees[index]):
+                record_provenance(
+                    names, provenance, trees[index], api_address, password,
+                    session=session)
+                print('{}: {} unchanged at {}'.format(
+                    env_name, ', '.join(names), provenance.commit))
+                continue
+            # Charms with the same relevant files are uploaded only once.
+            uploads.setdefault(
+                trees[index] or provenance.commit, (contents, []))[1].append(
+                index)
+        charm_urls = {}
+        if uploads:
+            print('{}: uploading {} charms for {}'.format(
+                env_name, len(uploads), ', '.join(env_series_list)))
+
+            def upload(contents):
+                return upload_series(
+                    contents, api_address, password, env_series_list, jobs,
+                    pool=session.pool, slots=slots)
+
+            with recorder.measure('process', env_name) as stats:
+                with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                    results = executor.map(upload, [
+                        contents for contents, _ in uploads.values()])
+                    for (_, indexes), urls in zip(uploads.values(), results):
+                        charm_urls.update((i, urls) for i in indexes)
+                stats['bytes'] = len(env_series_list) * sum(
+                    len(contents) for contents, _ in uploads.values())
+        with recorder.measure('deploy', env_name):
+            try:
+                with session.connect(api_address, password) as connection:
+                    for index in sorted(charm_urls):
+                        provenance = provenances[index]
+                        urls = charm_urls[index]
+                        if names_list[index][0] is None:
+                            names_list[index] = get_service_names(
+                                get_ref_service(
+                                    utils.get_service_from_charm(urls[0]),
+                                    provenance.ref),
+                                env_series_list)
+                        print('{}: deploying {} as {}'.format(
+                            env_name, provenance.ref,
+                            ', '.join(names_list[index])))
+                        deploy_services(
+                            connection, urls, names_list[index], num_units,
+                            machines, setup=add_provenance(
+                                setup, provenance, tree=trees[index]))
+            except api.JujuError as err:
+                msg = 'API failure: {}'.format(err)
+                raise ProgramExit(msg)
+        return sum(names_list, [])
+
+    try:
+        return _run_all(run, env_names, jobs)
+    finally:
+        downloads.shutdown()
+
+
+def _run_all(run, env_names, jobs):
+    """Call run for each environment, using at most the given parallel jobs.
+
+    Return a dict mapping environment names to the results of run.
+    Raise a ProgramExit including the errors occurred in each environment if
+    run failed in any of them.
+    """
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        tasks = [(i, executor.submit(run, i)) for i in env_names]
+    results, errors = {}, []
+    for env_name, task in tasks:
+        try:
+            results[env_name] = task.result()
+        except ProgramExit as err:
+            errors.append('{}: {}'.format(env_name, err.message))
+    if errors:
+        msg = 'deployment failed in {} of {} environments:\n{}'.format(
+            len(errors), len(env_names), '\n'.join(errors))
+        raise ProgramExit(msg)
+    return results
@@ -0,0 +1,426 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy charm archives management."""
+
+from collections import namedtuple
+import fnmatch
+import hashlib
+import io
+import logging
+import os
+import stat
+import struct
+import time
+import zipfile
+import zlib
+
+from . import utils
+
+
+# Define the zip compression methods used when building archives.
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Define the zip structures used when writing archives.
+_local_header = struct.Struct('<IHHHHHIIIHH')
+_central_header = struct.Struct('<IHHHHHHIIIHHHHHII')
+_end_record = struct.Struct('<IHHHHIIH')
+_cache_header = struct.Struct('<qqIIH')
+
+# Define the patterns of the files not affecting the deployed charm. Patterns
+# are matched against each component of the file paths. Root patterns are
+# only matched against the files and directories at the top level of the
+# charm, as documentation files can be part of the charm payload elsewhere,
+# e.g. templates/motd.md.
+IGNORED_PATTERNS = ('.*', '__pycache__', '*.pyc')
+IGNORED_ROOT_PATTERNS = (
+    'README*', '*.md', '*.rst', 'docs', 'tests', 'unit_tests', 'Makefile',
+    'tox.ini',
+)
+# Define the name of the file including additional ignore patterns.
+IGNORE_FILE = '.jujuignore'
+# Define the name of the file identifying charm directories.
+METADATA_FILE = 'metadata.yaml'
+
+# A compressed archive member, ready to be written in a zip file.
+Member = namedtuple(
+    'Member',
+    'name mode date_time crc file_size compress_type data')
+
+
+def compress(name, contents, mode=0o100644, date_time=None):
+    """Compress the given contents.
+
+    Receive the member name, its bytes contents, the file mode and an optional
+    date_time tuple (year, month, day, hour, minute, second). If date_time is
+    None, the current local time is used.
+
+    Return a Member instance.
+    """
+    if date_time is None:
+        date_time = time.localtime()[:6]
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(contents) + compressor.flush()
+    return Member(
+        name, mode, tuple(date_time), zlib.crc32(contents) & 0xffffffff,
+        len(contents), ZIP_DEFLATED, data)
+
+
+def write_zip(stream, members):
+    """Write a zip archive including the given members to the stream.
+
+    The members are already compressed, so that their data is just copied
+    to the file-like object stream.
+    """
+    offset = 0
+    central_directory = []
+    for member in members:
+        name = member.name.encode('utf-8')
+        year, month, day, hour, minute, second = member.date_time
+        dostime = hour << 11 | minute << 5 | second // 2
+        dosdate = (max(year, 1980) - 1980) << 9 | month << 5 | day
+        header = _local_header.pack(
+            0x04034b50, 20, 0x800, member.compress_type, dostime, dosdate,
+            member.crc, len(member.data), member.file_size, len(name), 0)
+        stream.write(header)
+        stream.write(name)
+        stream.write(member.data)
+        central_directory.append(_central_header.pack(
+            0x02014b50, 0x0314, 20, 0x800, member.compress_type, dostime,
+            dosdate, member.crc, len(member.data), member.file_size,
+            len(name), 0, 0, 0, 0, (member.mode & 0xffff) << 16, offset,
+        ) + name)
+        offset += len(header) + len(name) + len(member.data)
+    directory = b''.join(central_directory)
+    stream.write(directory)
+    stream.write(_end_record.pack(
+        0x06054b50, 0, 0, len(central_directory), len(central_directory),
+        len(directory), offset, 0))
+
+
+class MemberCache:
+    """An on-disk cache of compressed archive members.
+
+    Members are stored in the given directory, and are keyed by their path,
+    modification time and size, so that only changed files are compressed
+    again when the archive is rebuilt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _entry_path(self, path):
+        """Return the cache file path for the given file path."""
+        key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key)
+
+    def get(self, path, info):
+        """Return the cached compressed data for the given file path.
+
+        Receive the os.stat_result for the file. Return a tuple (crc,
+        file_size, data), or None if the entry is missing or stale.
+        """
+        try:
+            with open(self._entry_path(path), 'rb') as stream:
+                contents = stream.read()
+        except IOError:
+            return None
+        if len(contents) < _cache_header.size:
+            return None
+        mtime, size, crc, file_size, mode = _cache_header.unpack_from(contents)
+        if (mtime, size, mode) != (info.st_mtime_ns, info.st_size,
+                                   info.st_mode & 0xffff):
+            return None
+        return crc, file_size, contents[_cache_header.size:]
+
+    def set(self, path, info, member):
+        """Store the given compressed member for the given file path."""
+        header = _cache_header.pack(
+            info.st_mtime_ns, info.st_size, member.crc, member.file_size,
+            info.st_mode & 0xffff)
+        entry_path = self._entry_path(path)
+        temp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, 'wb') as stream:
+                stream.write(header + member.data)
+            os.rename(temp_path, entry_path)
+        except (IOError, OSError) as err:
+            # Failing to populate the cache is not fatal.
+            logging.debug('unable to cache {}: {}'.format(path, err))
+
+
+def _iter_files(path):
+    """Yield the (relative name, full path) of the files in the given path.
+
+    Hidden directories (e.g. the VCS ones) are ignored.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(i for i in dirnames if not i.startswith('.'))
+        for filename in sorted(filenames):
+            fullpath = os.path.join(dirpath, filename)
+            name = os.path.relpath(fullpath, path).replace(os.sep, '/')
+            yield name, fullpath
+        # Symbolic links to directories are not followed by os.walk: they are
+        # stored as links, like files.
+        for dirname in dirnames[:]:
+            fullpath = os.path.join(dirpath, dirname)
+            if os.path.islink(fullpath):
+                dirnames.remove(dirname)
+                name = os.path.relpath(fullpath, path).replace(os.sep, '/')
+                yield name, fullpath
+
+
+def get_members(path, cache=None):
+    """Return the compressed members for the charm directory in path.
+
+    If a MemberCache is provided, it is used to avoid compressing again files
+    whose modification time and size did not change.
+
+    Raise a ValueError if the given path is not a charm directory.
+    """
+    if not os.path.isfile(os.path.join(path, METADATA_FILE)):
+        raise ValueError('not a charm directory: {}'.format(path))
+    members = []
+    for name, fullpath in _iter_files(path):
+        info = os.lstat(fullpath)
+        date_time = time.localtime(info.st_mtime)[:6]
+        cached = None if cache is None else cache.get(fullpath, info)
+        if cached is not None:
+            crc, file_size, data = cached
+            members.append(Member(
+                name, info.st_mode, date_time, crc, file_size,
+                ZIP_DEFLATED, data))
+            continue
+        if stat.S_ISLNK(info.st_mode):
+            contents = os.readlink(fullpath).encode('utf-8')
+        else:
+            with open(fullpath, 'rb') as stream:
+                contents = stream.read()
+        logging.debug('compressing {}'.format(name))
+        member = compress(name, contents, info.st_mode, date_time)
+        if cache is not None:
+            cache.set(fullpath, info, member)
+        members.append(member)
+    return members
+
+
+def build(path, cache=None):
+    """Build the zip archive of the charm directory in path.
+
+    Return a file-like object (also exposing the archive length) containing
+    the zip contents. See get_members for a description of the arguments.
+
+    Raise a ValueError if the given path is not a charm directory.
+    """
+    stream = utils.BytesStream()
+    write_zip(stream, get_members(path, cache=cache))
+    stream.seek(0)
+    return stream
+
+
+def extract(stream, path):
+    """Extract the given zip archive to the directory at path.
+
+    The top level directory of Github archives is not included. File modes
+    and symbolic links are restored.
+
+    Raise a ValueError if the stream is not a valid zip archive, or if it
+    includes files outside the archive root.
+    """
+    root = os.path.realpath(path)
+    try:
+        with zipfile.ZipFile(stream) as zip_archive:
+            infos = [i for i in zip_archive.infolist() if not i.is_dir()]
+            if not infos:
+                raise ValueError('empty archive')
+            prefix = _get_prefix([i.filename for i in infos])
+            for info in infos:
+                parts = info.filename[len(prefix):].split('/')
+                target = os.path.join(root, *parts)
+                directory = os.path.dirname(target)
+                inside = os.path.join(os.path.realpath(directory), '')
+                if '..' in info.filename.split('/') or not inside.startswith(
+                        os.path.join(root, '')):
+                    raise ValueError('invalid file name: {}'.format(
+                        info.filename))
+                os.makedirs(directory, exist_ok=True)
+                contents = zip_archive.read(info)
+                mode = info.external_attr >> 16
+                if stat.S_ISLNK(mode):
+                    os.symlink(contents.decode('utf-8'), target)
+                    continue
+                with open(target, 'wb') as output:
+                    output.write(contents)
+                if mode:
+                    os.chmod(target, stat.S_IMODE(mode))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error) as err:
+        raise ValueError('invalid archive: {}'.format(err))
+
+
+def is_ignored(
+        name, patterns=IGNORED_PATTERNS, root_patterns=IGNORED_ROOT_PATTERNS):
+    """Return whether the given member name matches any of the patterns.
+
+    Patterns are matched against the whole name and each one of its
+    components, root patterns only against its first component.
+    """
+    parts = name.split('/')
+    if any(fnmatch.fnmatch(parts[0], i) for i in root_patterns):
+        return True
+    return any(
+        fnmatch.fnmatch(name, pattern) or
+        any(fnmatch.fnmatch(part, pattern) for part in parts)
+        for pattern in patterns)
+
+
+def _get_prefix(names):
+    """Return the directory prefixing all the given member names, if any.
+
+    Github archives include the repository files in a top level directory
+    named after the commit.
+    """
+    first = names[0].split('/', 1)
+    if len(first) == 1:
+        return ''
+    prefix = first[0] + '/'
+    return prefix if all(i.startswith(prefix) for i in names) else ''
+
+
+def get_tree_hash(stream):
+    """Return a hash of the charm relevant files in the given zip archive.
+
+    Only the archive central directory is read: each file is identified by
+    its name, CRC32, size and kind (regular, executable or link), so that
+    the hash only changes if the charm contents change. The top level
+    directory of Github archives is ignored, together with the files
+    matching IGNORED_PATTERNS, IGNORED_ROOT_PATTERNS at the top level of the
+    charm, or any of the patterns listed in the charm .jujuignore file.
+
+    Raise a ValueError if the stream is not a valid zip archive.
+    """
+    try:
+        with zipfile.ZipFile(stream) as archive:
+            infos = [i for i in archive.infolist() if not i.is_dir()]
+            if not infos:
+                raise ValueError('empty archive')
+            prefix = _get_prefix([i.filename for i in infos])
+            patterns = IGNORED_PATTERNS
+            try:
+                contents = archive.read(prefix + IGNORE_FILE)
+            except KeyError:
+                pass
+            else:
+                lines = contents.decode('utf-8', 'replace').splitlines()
+                patterns += tuple(
+                    i.strip().strip('/') for i in lines
+                    if i.strip() and not i.startswith('#'))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error) as err:
+        raise ValueError('invalid archive: {}'.format(err))
+    entries = []
+    for info in infos:
+        name = info.filename[len(prefix):]
+        if is_ignored(name, patterns):
+            continue
+        mode = info.external_attr >> 16
+        kind = 'l' if stat.S_ISLNK(mode) else 'x' if mode & 0o111 else 'f'
+        entries.append('{}\0{:08x}\0{}\0{}\n'.format(
+            name, info.CRC, info.file_size, kind))
+    checksum = hashlib.sha256()
+    for entry in sorted(entries):
+        checksum.update(entry.encode('utf-8'))
+    return checksum.hexdigest()
+
+
+def _read_raw(stream, info):
+    """Return the compressed data of the given zip member in stream.
+
+    Raise a ValueError if the member cannot be read.
+    """
+    stream.seek(info.header_offset)
+    header = stream.read(_local_header.size)
+    if len(header) != _local_header.size or header[:4] != b'PK\x03\x04':
+        raise ValueError('invalid archive: bad header for {}'.format(
+            info.filename))
+    name_length, extra_length = _local_header.unpack(header)[-2:]
+    stream.seek(name_length + extra_length, os.SEEK_CUR)
+    data = stream.read(info.compress_size)
+    if len(data) != info.compress_size:
+        raise ValueError('invalid archive: truncated {}'.format(
+            info.filename))
+    return data
+
+
+def _copy_member(stream, info, name):
+    """Return the given zip member in stream as a Member with the given name.
+
+    The member data is not decompressed.
+    Raise a ValueError if the member cannot be copied.
+    """
+    if info.flag_bits & 0x1:
+        raise ValueError('encrypted file: {}'.format(info.filename))
+    if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+        raise ValueError('unsupported compression for {}'.format(
+            info.filename))
+    return Member(
+        name, info.external_attr >> 16 or 0o100644, info.date_time,
+        info.CRC, info.file_size, info.compress_type,
+        _read_raw(stream, info))
+
+
+def _matches(path, pattern):
+    """Return whether the given path matches the given path pattern.
+
+    Shell-style wildcards in the pattern only match within a path component.
+    """
+    parts, pattern_parts = path.split('/'), pattern.split('/')
+    return len(parts) == len(pattern_parts) and all(
+        fnmatch.fnmatch(part, pattern_part)
+        for part, pattern_part in zip(parts, pattern_parts))
+
+
+def split(stream, pattern):
+    """Split the given repository zip archive into charm archives.
+
+    Charms are the directories including a metadata.yaml file whose path,
+    relative to the repository root, matches the given pattern, e.g.
+    "charms/*". The compressed data of each file is copied as is to the
+    charm archive, without being decompressed and compressed again.
+
+    Return a list of (charm path, zip contents) tuples sorted by path.
+    Raise a ValueError if the stream is not a valid zip archive.
+    """
+    try:
+        with zipfile.ZipFile(stream) as repo_archive:
+            infos = [i for i in repo_archive.infolist() if not i.is_dir()]
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as err:
+        raise ValueError('invalid archive: {}'.format(err))
+    if not infos:
+        raise ValueError('empty archive')
+    prefix = _get_prefix([i.filename for i in infos])
+    suffix = '/' + METADATA_FILE
+    names = [i.filename[len(prefix):] for i in infos]
+    paths = sorted(
+        name[:-len(suffix)] for name in names
+        if name.endswith(suffix) and _matches(name[:-len(suffix)], pattern))
+    charms = []
+    for path in paths:
+        charm_prefix = '{}{}/'.format(prefix, path)
+        members = (
+            _copy_member(stream, info, info.filename[len(charm_prefix):])
+            for info in infos if info.filename.startswith(charm_prefix))
+        output = io.BytesIO()
+        write_zip(output, members)
+        charms.append((path, output.getvalue()))
+    return charms
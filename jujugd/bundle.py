@@ -0,0 +1,181 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy bundles management.
+
+A bundle is a YAML file describing a set of services deployed from charms
+hosted on Github, and the relations between them, e.g.:
+
+    services:
+      blog:
+        repo: hatched/ghost-charm:develop
+        num_units: 2
+        options:
+          port: 8080
+      db:
+        repo: frankban/mysql-charm
+        series: precise
+        to: lxc:1
+    relations:
+      - [blog, db:db]
+"""
+
+from collections import namedtuple
+from collections.abc import Mapping
+from concurrent import futures
+import os
+
+import yaml
+
+from . import (
+    api,
+    app,
+)
+
+
+# A service described in the bundle.
+Service = namedtuple('Service', 'repo series num_units machines options')
+
+
+def _validate_service(name, data, base_dir):
+    """Validate the given service data, and return a Service instance.
+
+    Relative paths to local charm directories are resolved from base_dir.
+    Raise a ValueError if the data is not valid.
+    """
+    if not isinstance(data, Mapping):
+        raise ValueError('invalid service {}'.format(name))
+    repo = data.get('repo')
+    if not isinstance(repo, str):
+        raise ValueError('service {}: missing repo'.format(name))
+    local_repo = os.path.join(base_dir, os.path.expanduser(repo))
+    if os.path.isdir(local_repo):
+        repo = local_repo
+    num_units = data.get('num_units', 1)
+    if not isinstance(num_units, int) or num_units < 1:
+        raise ValueError('service {}: invalid num_units'.format(name))
+    machines = data.get('to')
+    if machines is not None:
+        if not isinstance(machines, list):
+            machines = [machines]
+        machines = [str(machine) for machine in machines]
+        if len(machines) > num_units:
+            msg = 'service {}: more placement targets than units'
+            raise ValueError(msg.format(name))
+    options = data.get('options', {})
+    if not isinstance(options, Mapping):
+        raise ValueError('service {}: invalid options'.format(name))
+    return Service(repo, data.get('series'), num_units, machines, options)
+
+
+def load(path):
+    """Load the bundle file at the given path.
+
+    Return a tuple (services, relations), in which services is a dict mapping
+    service names to Service instances, and relations is a list of endpoint
+    pairs.
+
+    Raise a ValueError if the bundle is not valid.
+    """
+    try:
+        with open(path) as stream:
+            contents = yaml.safe_load(stream)
+    except Exception as err:
+        raise ValueError(str(err))
+    if not isinstance(contents, Mapping):
+        raise ValueError('invalid bundle contents')
+    data = contents.get('services')
+    if not isinstance(data, Mapping) or not data:
+        raise ValueError('no services found')
+    base_dir = os.path.dirname(os.path.abspath(path))
+    services = dict(
+        (name, _validate_service(name, service_data, base_dir))
+        for name, service_data in data.items())
+    relations = []
+    for relation in contents.get('relations', []):
+        if not (isinstance(relation, list) and len(relation) == 2):
+            raise ValueError('invalid relation: {}'.format(relation))
+        for endpoint in relation:
+            if str(endpoint).split(':')[0] not in services:
+                msg = 'relation to unknown service: {}'.format(endpoint)
+                raise ValueError(msg)
+        relations.append(tuple(map(str, relation)))
+    return services, relations
+
+
+def deploy(path, env_name, series, jobs, session=None, annotations=None):
+    """Deploy the bundle at the given path to the given environment.
+
+    If series is None, use the default environment series for the services
+    not specifying a series.
+
+    All the charms are retrieved and uploaded in parallel, using at most the
+    given number of parallel jobs. Each service is deployed as soon as its
+    charm is uploaded, and then the relations are added in a single batch.
+    Resources are retrieved using the given app.Session, if provided.
+    If an annotations dict is provided, it is set on all the services.
+
+    Raise an app.ProgramExit if an error occurs.
+    """
+    try:
+        services, relations = load(path)
+    except ValueError as err:
+        raise app.ProgramExit('invalid bundle {}: {}'.format(path, err))
+    if session is None:
+        session = app.Session()
+    api_address, password, series = session.discover(env_name, series)
+    # Upload each charm only once, even if used by multiple services.
+    charms = {}
+    for name, service in sorted(services.items()):
+        key = (service.repo, service.series or series)
+        charms.setdefault(key, []).append(name)
+
+    def upload(key):
+        repo, charm_series = key
+        zip_url = app.get_zip_url(repo)
+        contents = session.fetch(zip_url)
+        path = app.get_charm_path(repo)
+        if path:
+            charms = app.split_charms(contents, path)
+            if len(charms) > 1:
+                raise app.ProgramExit('multiple charms found in {}'.format(
+                    repo))
+            contents = charms[0][1]
+        contents = app.apply_transforms(
+            contents, app.get_transforms(zip_url, path))
+        charm_url = app.upload_series(
+            contents, api_address, password, [charm_series], 1,
+            pool=session.pool)[0]
+        print('uploaded {}'.format(charm_url))
+        return charm_url
+
+    print('deploying {} services'.format(len(services)))
+    try:
+        with session.connect(api_address, password) as connection:
+            with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                tasks = dict(
+                    (executor.submit(upload, key), key) for key in charms)
+                for task in futures.as_completed(tasks):
+                    charm_url = task.result()
+                    for name in charms[tasks[task]]:
+                        service = services[name]
+                        app.deploy_services(
+                            connection, [charm_url], [name],
+                            service.num_units, service.machines,
+                            config=service.options,
+                            setup=app.ServiceSetup(annotations=annotations))
+                        print('deployed service {}'.format(name))
+            if relations:
+                api.add_relations(connection, relations)
+                print('added {} relations'.format(len(relations)))
+    except api.JujuError as err:
+        raise app.ProgramExit('API failure: {}'.format(err))
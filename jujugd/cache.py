@@ -0,0 +1,156 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy archive cache shared by concurrent processes."""
+
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+
+from . import settings
+
+
+class ArchiveCache:
+    """An on-disk cache of charm archives, safe to use from many processes.
+
+    Each entry is protected by a lock file. The first process requesting a
+    missing entry retrieves it while holding the lock, and concurrent
+    requesters wait for the lock to be released and then reuse the result,
+    so that the same archive is never downloaded twice at the same time.
+    Entries are written to partial files and then atomically renamed, so
+    that readers never see incomplete archives. Partial files left by
+    crashed processes are discarded by the next process holding the lock.
+    """
+
+    def __init__(self, path, max_entries=settings.ARCHIVE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    def _entry_path(self, key):
+        """Return the cache file path for the given key."""
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.zip')
+
+    def _read(self, entry_path):
+        """Return the contents of the given entry, or None if missing."""
+        try:
+            with open(entry_path, 'rb') as stream:
+                contents = stream.read()
+            # Mark the entry as recently used.
+            os.utime(entry_path)
+        except (IOError, OSError):
+            return None
+        return contents
+
+    def _publish(self, entry_path, contents):
+        """Atomically store the given contents in the given entry.
+
+        Must be called holding the entry lock.
+        """
+        for partial_path in glob.glob(entry_path + '.*.partial'):
+            # The process writing this file crashed while holding the lock.
+            logging.debug('discarding partial file {}'.format(partial_path))
+            os.remove(partial_path)
+        partial_path = '{}.{}.partial'.format(entry_path, os.getpid())
+        with open(partial_path, 'wb') as stream:
+            stream.write(contents)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(partial_path, entry_path)
+
+    def _lock(self, entry_path):
+        """Return the lock file of the given entry, once locked.
+
+        Wait for other processes holding the lock. Lock files are removed when
+        pruning entries: if the file has been removed while waiting, lock the
+        new one, so that all the requesters keep excluding each other.
+        """
+        lock_path = entry_path + '.lock'
+        while True:
+            lock = open(lock_path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _remove(self, lock_path, *paths):
+        """Remove the given paths and then the given lock file.
+
+        Nothing is removed if the lock is held by another process, e.g.
+        because the entry is being retrieved.
+        """
+        try:
+            with open(lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                for path in paths:
+                    os.remove(path)
+                os.remove(lock_path)
+        except OSError:
+            pass
+
+    def _prune(self):
+        """Remove the least recently used entries exceeding the limit.
+
+        The lock files of the removed entries are removed as well, together
+        with the lock files left by failed retrievals.
+        """
+        entries = []
+        for entry_path in glob.glob(os.path.join(self.path, '*.zip')):
+            try:
+                entries.append((os.stat(entry_path).st_mtime, entry_path))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+        for _, entry_path in entries[self.max_entries:]:
+            self._remove(entry_path + '.lock', entry_path)
+        for lock_path in glob.glob(os.path.join(self.path, '*.zip.lock')):
+            if not os.path.exists(lock_path[:-len('.lock')]):
+                self._remove(lock_path)
+
+    def get(self, key, retrieve):
+        """Return the contents stored with the given key.
+
+        If the entry is missing, call retrieve to obtain and store its
+        contents. If another process is already retrieving the entry, wait
+        for it to finish and return its result. Errors raised by retrieve are
+        propagated, in which case the entry is not stored.
+        """
+        entry_path = self._entry_path(key)
+        contents = self._read(entry_path)
+        if contents is not None:
+            logging.debug('archive cache hit: {}'.format(key))
+            return contents
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Wait for other processes retrieving the same entry.
+            lock = self._lock(entry_path)
+        except (IOError, OSError) as err:
+            # Failing to use the cache is not fatal.
+            logging.debug('unable to use the archive cache: {}'.format(err))
+            return retrieve()
+        with lock:
+            contents = self._read(entry_path)
+            if contents is not None:
+                logging.debug('archive retrieved concurrently: {}'.format(key))
+                return contents
+            contents = retrieve()
+            try:
+                self._publish(entry_path, contents)
+            except (IOError, OSError) as err:
+                logging.debug('unable to cache {}: {}'.format(key, err))
+        self._prune()
+        return contents
@@ -0,0 +1,221 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy ephemeral services teardown.
+
+Services deployed with "juju git-deploy --ephemeral LABEL" are annotated
+with the given label. They can then be destroyed at once, together with the
+machines only hosting their units, e.g.:
+
+    python -m jujugd.cleanup -e ci LABEL
+
+If the label is omitted, all the ephemeral services are destroyed.
+"""
+
+import argparse
+import logging
+import time
+
+from . import (
+    api,
+    app,
+    env,
+    settings,
+)
+
+
+# Define the annotation key used to mark ephemeral services.
+ANNOTATION = 'juju-git-deploy-ephemeral'
+
+
+class Model:
+    """The environment state, built from the AllWatcher deltas."""
+
+    def __init__(self):
+        self.services = {}
+        self.units = {}
+        self.machines = {}
+        self.annotations = {}
+
+    def update(self, deltas):
+        """Apply the given AllWatcher deltas."""
+        for delta in deltas:
+            self.apply(delta)
+
+    def apply(self, delta):
+        """Apply the given AllWatcher delta."""
+        kind, operation, data = delta
+        if kind == 'service':
+            entities, key = self.services, data['Name']
+        elif kind == 'unit':
+            entities, key = self.units, data['Name']
+        elif kind == 'machine':
+            entities, key = self.machines, data['Id']
+        elif kind == 'annotation':
+            entities, key = self.annotations, data['Tag']
+        else:
+            return
+        if operation == 'remove':
+            entities.pop(key, None)
+        else:
+            entities[key] = data
+
+    def get_ephemeral_services(self, label=None):
+        """Return the names of the ephemeral services.
+
+        If a label is provided, only return the services deployed with it.
+        """
+        services = []
+        for name in self.services:
+            annotations = self.annotations.get('service-{}'.format(name), {})
+            value = (annotations.get('Annotations') or {}).get(ANNOTATION)
+            if value and (label is None or value == label):
+                services.append(name)
+        return sorted(services)
+
+    def get_units(self, services):
+        """Return the names of the units of the given services."""
+        return sorted(
+            name for name, unit in self.units.items()
+            if unit['Service'] in services)
+
+    def get_machines(self, services):
+        """Return the machines that can be destroyed with the given services.
+
+        Only include machines hosting units of the given services, and no
+        other principal units or containers. Machines managing the
+        environment are never included.
+        """
+        hosts, excluded = set(), set()
+        for unit in self.units.values():
+            machine = unit.get('MachineId')
+            if not machine:
+                continue
+            if unit['Service'] in services:
+                hosts.add(machine)
+            elif not unit.get('Subordinate'):
+                excluded.add(machine)
+        for machine_id, machine in self.machines.items():
+            if 'JobManageEnviron' in (machine.get('Jobs') or []):
+                excluded.add(machine_id)
+            if '/' in machine_id:
+                # Containers are not destroyed with their host.
+                excluded.add(machine_id.rsplit('/', 2)[0])
+        return sorted(hosts - excluded)
+
+
+def cleanup(
+        api_address, password, label=None, dry_run=False,
+        timeout=settings.CLEANUP_TIMEOUT, session=None):
+    """Destroy the ephemeral services, and the machines hosting them.
+
+    If a label is provided, only destroy the services deployed with it. If
+    dry_run is True, only list the services. The environment state is
+    retrieved using an AllWatcher, which is then used to wait, for at most
+    timeout seconds, for the units to be removed before destroying their
+    machines. The API connection is retrieved from the given app.Session, if
+    provided.
+
+    Return the list of destroyed services.
+    Raise a ProgramExit if an error occurs.
+    """
+    if session is None:
+        session = app.Session()
+    try:
+        with session.connect(api_address, password) as connection:
+            watcher_id = api.watch_all(connection)
+            try:
+                return _cleanup(
+                    connection, watcher_id, label, dry_run, timeout)
+            except api.JujuTimeout:
+                # The connection is closed when the deltas are not received
+                # in time, and the watcher is stopped together with it.
+                watcher_id = None
+                raise app.ProgramExit(
+                    'timed out waiting for the units to be removed')
+            finally:
+                if watcher_id is not None:
+                    api.stop_watcher(connection, watcher_id)
+    except api.JujuError as err:
+        raise app.ProgramExit('API failure: {}'.format(err))
+
+
+def _cleanup(connection, watcher_id, label, dry_run, timeout):
+    """Destroy the ephemeral services using the given watcher.
+
+    See cleanup for a description of the arguments.
+    """
+    model = Model()
+    # Deltas are applied as soon as they are decoded.
+    api.next_deltas(connection, watcher_id, callback=model.apply)
+    services = model.get_ephemeral_services(label)
+    if not services:
+        print('no ephemeral services found')
+        return []
+    print('ephemeral services: {}'.format(', '.join(services)))
+    if dry_run:
+        return services
+    machines = model.get_machines(services)
+    api.destroy_services(connection, services, model.get_units(services))
+    print('destroying {} services'.format(len(services)))
+    if not machines:
+        return services
+    deadline = time.time() + timeout
+    while any(unit.get('MachineId') in machines
+              for unit in model.units.values()):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise app.ProgramExit(
+                'timed out waiting for the units to be removed')
+        # The watcher blocks until changes are available: bound the wait to
+        # the remaining time.
+        api.next_deltas(
+            connection, watcher_id, callback=model.apply, timeout=remaining)
+    api.destroy_machines(connection, machines)
+    print('destroying machines {}'.format(', '.join(machines)))
+    return services
+
+
+def main():
+    """Destroy ephemeral services: this is called when executing the module."""
+    parser = argparse.ArgumentParser(
+        description='Destroy the ephemeral services deployed with '
+                    'juju git-deploy --ephemeral')
+    parser.add_argument(
+        'label', nargs='?',
+        help='Only destroy the services deployed with this label')
+    parser.add_argument(
+        '-e', '--environment', dest='env_name',
+        default=env.get_default_env_name(),
+        help='The name of the Juju environment to use (%(default)s)')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Only list the ephemeral services')
+    options = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        try:
+            api_address = api.get_api_address(options.env_name)
+            password = env.parse_jenv(options.env_name, env.get_password)
+        except ValueError as err:
+            raise app.ProgramExit(str(err))
+        cleanup(
+            api_address, password, label=options.label,
+            dry_run=options.dry_run)
+    except app.ProgramExit as err:
+        parser.exit(1, '{}\n'.format(err))
+
+
+if __name__ == '__main__':
+    main()
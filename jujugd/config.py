@@ -0,0 +1,44 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy configuration file management."""
+
+from collections.abc import Mapping
+
+import yaml
+
+from . import settings
+
+
+def load(path=None):
+    """Load the YAML configuration file at the given path.
+
+    If path is None, use the default configuration path.
+    Return the configuration as a dict, or an empty dict if the file does not
+    exist.
+
+    Raise a ValueError if the configuration file is not valid.
+    """
+    if path is None:
+        path = settings.CONFIG_PATH
+    try:
+        with open(path) as stream:
+            contents = yaml.safe_load(stream)
+    except FileNotFoundError:
+        return {}
+    except Exception as err:
+        raise ValueError(str(err))
+    if contents is None:
+        return {}
+    if not isinstance(contents, Mapping):
+        raise ValueError('invalid configuration file: {}'.format(path))
+    return contents
@@ -0,0 +1,250 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy Python API.
+
+Charms can be deployed from long running Python processes, without starting
+the plugin for each deployment, e.g.:
+
+    from jujugd.deployer import Deployer
+
+    with Deployer() as deployer:
+        result = deployer.deploy('hatched/ghost-charm:develop', 'ec2')
+        print(result.service, result.timings)
+
+The deployer keeps environment information, API connections and archives
+warm across deployments, and can be used by multiple threads at once.
+Nothing is printed: the deployment progress is logged at debug level.
+"""
+
+from collections import namedtuple
+import logging
+
+from . import (
+    agent,
+    api,
+    app,
+    leases,
+    metrics,
+    utils,
+)
+
+
+# The result of a deployment: the uploaded charm URL, the deployed service
+# name, the environment name, a dict mapping the phases (prepare, process and
+# deploy) to their duration in seconds, the number of uploaded bytes and
+# whether the deployment has been skipped because the service already runs
+# the requested commit. The charm URL is None for skipped deployments.
+Result = namedtuple(
+    'Result', 'charm_url service env_name timings bytes skipped')
+
+
+class DeployError(Exception):
+    """A deployment failed.
+
+    The phase attribute holds the name of the failed phase.
+    """
+
+    phase = None
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class DiscoveryError(DeployError):
+    """The repository or the Juju environment are not valid."""
+
+    phase = 'prepare'
+
+
+class FetchError(DeployError):
+    """The charm contents cannot be retrieved."""
+
+    phase = 'process'
+
+
+class UploadError(DeployError):
+    """The charm cannot be uploaded to the Juju environment."""
+
+    phase = 'process'
+
+
+class TransformError(DeployError):
+    """The charm cannot be transformed before the upload."""
+
+    phase = 'process'
+
+
+class APIError(DeployError):
+    """The Juju API failed while deploying the service."""
+
+    phase = 'deploy'
+
+
+def _report(message):
+    """Log the given deployment progress message at debug level."""
+    logging.debug(message)
+
+
+class Deployer:
+    """Deploy charms, keeping resources warm across deployments.
+
+    The deployer is thread safe. Call close, or use the deployer as a context
+    manager, to release its resources.
+    """
+
+    def __init__(self, session=None):
+        self.session = agent.WarmSession() if session is None else session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the connections held by the deployer."""
+        self.session.close()
+
+    def deploy(
+            self, repo, env_name=None, service=None, series=None,
+            num_units=1, machines=None, setup=None):
+        """Deploy the charm in the given repository to a Juju environment.
+
+        The repository is in any of the forms accepted by the plugin, or a
+        path to a local charm directory. If env_name or series are None, the
+        default ones are used. The service is set up as described by the
+        given app.ServiceSetup, if provided. See app.deploy for a description
+        of the other arguments.
+
+        Return a Result. Raise a DeployError subclass if the deployment fails.
+        """
+        recorder = metrics.Recorder(repo)
+        try:
+            charm_url, service, skipped = self._deploy(
+                recorder, repo, env_name, service, series, num_units,
+                machines, setup)
+            timings, size = {}, 0
+            for phase, _, _, seconds, phase_size in recorder.samples:
+                timings[phase] = seconds
+                size += phase_size or 0
+        finally:
+            recorder.save()
+        return Result(charm_url, service, env_name, timings, size, skipped)
+
+    def _deploy(
+            self, recorder, repo, env_name, service, series, num_units,
+            machines, setup):
+        """Run the deployment phases, measuring them with the given recorder.
+
+        The deployment lease on the service is held while uploading and
+        deploying: the deployment is skipped if the same commit has been
+        deployed concurrently, or if a newer commit has been requested.
+        Return the charm URL, the service name and whether the deployment has
+        been skipped.
+        """
+        with recorder.measure('prepare', env_name):
+            try:
+                zip_url = app.get_zip_url(repo)
+                if app.get_charm_path(repo):
+                    raise app.ProgramExit(
+                        'charm paths are not supported: {}'.format(repo))
+                api_address, password, series = self.session.discover(
+                    env_name, series)
+                provenance = app.get_provenance(
+                    zip_url, session=self.session, output=_report)
+            except app.ProgramExit as err:
+                raise DiscoveryError(err.message)
+        try:
+            lease = app.acquire_lease(
+                env_name, service, provenance, zip_url, output=_report)
+        except leases.Superseded as err:
+            logging.debug('{}: deployment {}'.format(service, err))
+            return None, service, True
+        except app.ProgramExit as err:
+            raise DiscoveryError(err.message)
+        with lease:
+            services = lease.get_result(provenance.commit)
+            if services is not None:
+                return None, services[0], True
+            charm_url, service, skipped = self._update(
+                recorder, zip_url, env_name, service, api_address, password,
+                series, provenance, num_units, machines, setup)
+            lease.record(provenance.commit, [service])
+        return charm_url, service, skipped
+
+    def _update(
+            self, recorder, zip_url, env_name, service, api_address, password,
+            series, provenance, num_units, machines, setup):
+        """Upload and deploy the charm, holding the service lease.
+
+        Nothing is retrieved or deployed if the service already runs the
+        current commit of the charm, and nothing is uploaded or deployed if
+        the service runs another commit with the same charm relevant files.
+        See _deploy for a description of the return value.
+        """
+        try:
+            deployed = app.get_deployed(
+                [service], provenance, api_address, password,
+                session=self.session)
+        except app.ProgramExit as err:
+            raise APIError(err.message)
+        if app.is_current(deployed, provenance):
+            return None, service, True
+        with recorder.measure('process', env_name) as stats:
+            tree = None
+            try:
+                transforms = app.get_transforms(zip_url)
+                if provenance.commit is None:
+                    with self.session.open(zip_url, output=_report) as stream:
+                        contents = stream.read()
+                else:
+                    contents = self.session.fetch(
+                        zip_url, commit=provenance.commit, output=_report)
+                    tree = app.get_tree(contents, transforms)
+            except app.ProgramExit as err:
+                raise FetchError(err.message)
+            if app.is_unchanged(deployed, provenance, tree):
+                try:
+                    app.record_provenance(
+                        [service], provenance, tree, api_address, password,
+                        session=self.session)
+                except app.ProgramExit as err:
+                    raise APIError(err.message)
+                return None, service, True
+            try:
+                stream = utils.BytesStream(
+                    app.apply_transforms(
+                        contents, transforms, output=_report))
+            except app.ProgramExit as err:
+                raise TransformError(err.message)
+            with stream:
+                stats['bytes'] = stream.length
+                try:
+                    charm_url = api.upload_charm(
+                        api_address, stream, password, series,
+                        pool=self.session.pool)
+                except IOError as err:
+                    raise UploadError('charm upload failed: {}'.format(err))
+        with recorder.measure('deploy', env_name):
+            try:
+                with self.session.connect(api_address, password) as conn:
+                    [service] = app.deploy_services(
+                        conn, [charm_url], [service], num_units, machines,
+                        setup=app.add_provenance(
+                            setup, provenance, tree=tree))
+            except api.JujuError as err:
+                raise APIError('API failure: {}'.format(err))
+        return charm_url, service, False
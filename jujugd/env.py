@@ -40,6 +40,12 @@ def get_default_env_name():
     return output.strip()
 
 
+def get_jenv_path(env_name):
+    """Return the path to the jenv file for the given environment name."""
+    juju_home = os.path.expanduser('~/.juju')
+    return os.path.join(juju_home, 'environments', '{}.jenv'.format(env_name))
+
+
 def parse_jenv(env_name, parser):
     """Parse the jenv file corresponding to the given environment name.
 
@@ -48,8 +54,7 @@ def parse_jenv(env_name, parser):
 
     Raise a ValueError if the jenv file is not parsable.
     """
-    juju_home = os.path.expanduser('~/.juju')
-    jenv = os.path.join(juju_home, 'environments', '{}.jenv'.format(env_name))
+    jenv = get_jenv_path(env_name)
     try:
         with open(jenv) as stream:
             contents = yaml.safe_load(stream)
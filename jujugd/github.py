@@ -0,0 +1,164 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy Github API client."""
+
+import logging
+import os
+import threading
+import time
+
+from . import (
+    config,
+    settings,
+    utils,
+)
+
+
+# Define the URL prefix of the requests authenticated with the token.
+_AUTHENTICATED_URL = 'https://api.github.com/'
+
+
+def get_proxy():
+    """Return the URL of the charm archive proxy, or None if not configured.
+
+    The URL is retrieved from the JUJU_GIT_DEPLOY_PROXY environment variable
+    or, if not set, from the "github-proxy" key of the configuration file.
+    """
+    proxy = os.getenv('JUJU_GIT_DEPLOY_PROXY', '').strip()
+    if not proxy:
+        try:
+            proxy = config.load().get('github-proxy') or ''
+        except ValueError as err:
+            logging.debug('unable to read the configuration: {}'.format(err))
+    return proxy.rstrip('/') or None
+
+
+def get_token():
+    """Return the Github API token, or None if no token is configured.
+
+    The token is retrieved from the GITHUB_TOKEN environment variable or,
+    if not set, from the "github-token" key of the configuration file.
+    """
+    token = os.getenv('GITHUB_TOKEN', '').strip()
+    if token:
+        return token
+    try:
+        return config.load().get('github-token') or None
+    except ValueError as err:
+        logging.debug('unable to read the configuration: {}'.format(err))
+        return None
+
+
+class RateLimit:
+    """Track the Github API rate limit, and throttle requests accordingly.
+
+    The rate limit is updated parsing the X-RateLimit-* headers included in
+    Github responses. When only a few requests are left, the following ones
+    are spread over the time remaining before the limit is reset. When no
+    requests are left, requests are suspended until the reset time.
+    """
+
+    def __init__(self, reserve=settings.GITHUB_RATE_LIMIT_RESERVE):
+        self.reserve = reserve
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        if self.remaining is None:
+            return 'unknown'
+        return '{}/{} requests left, reset at {}'.format(
+            self.remaining, self.limit,
+            time.strftime('%H:%M:%S', time.localtime(self.reset)))
+
+    def update(self, headers):
+        """Update the rate limit using the given response headers."""
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self.limit, self.remaining, self.reset = limit, remaining, reset
+        logging.debug('github rate limit: {}'.format(self))
+
+    def get_delay(self):
+        """Reserve a request and return the seconds to wait for sending it."""
+        with self._lock:
+            if self.remaining is None or self.remaining > self.reserve:
+                if self.remaining is not None:
+                    self.remaining -= 1
+                return 0
+            left = self.reset - time.time()
+            if left <= 0:
+                # The rate limit has been reset in the meanwhile.
+                self.remaining = None
+                return 0
+            if self.remaining <= 0:
+                return left + 1
+            delay = left / self.remaining
+            self.remaining -= 1
+            return delay
+
+    def wait(self, output=None):
+        """Wait until a request can be sent without exceeding the limit.
+
+        Long waits are printed, or reported to output if provided.
+        """
+        delay = self.get_delay()
+        if delay <= 0:
+            return
+        if delay >= 1:
+            if output is None:
+                output = print
+            output('github rate limit almost exhausted ({}): '
+                   'waiting {} seconds'.format(self, int(delay)))
+        time.sleep(delay)
+
+
+# The rate limit shared by all the Github requests performed in the process.
+rate_limit = RateLimit()
+
+
+def urlget(url, headers=None, output=None):
+    """Open the given Github URL, authenticating if a token is available.
+
+    The URL can also point to a charm archive proxy, in which case no token
+    is sent.
+    The request is throttled to respect the Github rate limit. If the limit
+    is exceeded anyway, the request is retried once after the reset time.
+    Waits are printed, or reported to output if provided.
+
+    Return the HTTP response file-like object.
+    Raise an IOError if the URL is unreachable or in the case an invalid
+    response is returned.
+    """
+    headers = dict(headers or {})
+    # Only send the token to Github, and not for instance to the proxy.
+    token = get_token() if url.startswith(_AUTHENTICATED_URL) else None
+    if token:
+        headers['Authorization'] = 'token {}'.format(token)
+    for attempt in range(2):
+        rate_limit.wait(output=output)
+        try:
+            response = utils.urlget(url, headers=headers)
+        except utils.ResponseError as err:
+            rate_limit.update(err.headers or {})
+            exhausted = err.status == 403 and rate_limit.remaining == 0
+            if attempt or not exhausted:
+                raise
+            continue
+        rate_limit.update(response.headers)
+        return response
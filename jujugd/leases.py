@@ -0,0 +1,200 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy per service deployment leases.
+
+Deployments of the same service in the same environment are serialized
+across all the plugin processes: a lease on the service is held while the
+charm is uploaded and deployed. Requesters waiting for the lease are queued:
+requesters for the same commit reuse the result of the deployment they
+waited for, while a requester for another commit supersedes all the older
+queued ones, so that they do not transfer charms only to be replaced.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from . import settings
+
+
+class Superseded(Exception):
+    """A newer deployment of the service has been requested.
+
+    The commit requested by the newer deployment, or None for local charms,
+    is stored in the exception.
+    """
+
+    def __init__(self, commit):
+        self.commit = commit
+
+    def __str__(self):
+        return 'superseded by {}'.format(self.commit or 'a newer request')
+
+
+class Lease:
+    """A lease on a service, held until released."""
+
+    def __init__(self, directory, ticket_path, ticket, lock):
+        self.directory = directory
+        self.ticket_path = ticket_path
+        self.ticket = ticket
+        self.lock = lock
+
+    @property
+    def _result_path(self):
+        return os.path.join(self.directory, 'result.json')
+
+    def get_result(self, commit):
+        """Return the services deployed at the given commit while waiting.
+
+        Return None if no deployments for the given commit completed while
+        the lease was requested.
+        """
+        if commit is None:
+            return None
+        try:
+            with open(self._result_path) as stream:
+                result = json.load(stream)
+        except (IOError, ValueError):
+            return None
+        requested = os.path.basename(self.ticket_path).split('-', 1)[0]
+        if result.get('commit') != commit or (
+                result.get('time', '') < requested):
+            return None
+        return result.get('services')
+
+    def record(self, commit, services):
+        """Record the services deployed at the given commit.
+
+        Requesters waiting for the lease reuse them.
+        """
+        if commit is None:
+            return
+        result = {
+            'commit': commit, 'services': services,
+            'time': '{:020d}'.format(time.time_ns()),
+        }
+        temp_path = '{}.{}.tmp'.format(self._result_path, os.getpid())
+        with open(temp_path, 'w') as stream:
+            json.dump(result, stream)
+        os.rename(temp_path, self._result_path)
+
+    def release(self):
+        """Release the lease."""
+        try:
+            os.remove(self.ticket_path)
+        except FileNotFoundError:
+            pass
+        self.ticket.close()
+        if self.lock is not None:
+            self.lock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def get_newer_commit(directory, ticket_path, commit):
+    """Return the commit of a request superseding the given ticket.
+
+    A request supersedes the ticket if it has been queued later for another
+    commit, or if the commit is empty (i.e. local charms). Return the newer
+    commit (possibly empty), or None if the ticket is not superseded.
+    Tickets of requesters which exited without releasing them are removed.
+    """
+    name = os.path.basename(ticket_path)
+    for path in sorted(glob.glob(os.path.join(directory, '*.ticket'))):
+        if os.path.basename(path) <= name:
+            continue
+        try:
+            with open(path) as stream:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # The requester exited.
+                os.remove(path)
+                continue
+        except BlockingIOError:
+            with open(path) as stream:
+                other = stream.read().strip()
+        except OSError:
+            # The ticket has been released in the meanwhile.
+            continue
+        if other != commit or not commit:
+            return other
+    return None
+
+
+def acquire(
+        env_name, key, commit, timeout=settings.LEASE_TIMEOUT,
+        poll_interval=settings.LEASE_POLL_INTERVAL, output=None):
+    """Take the lease on the given service in the given environment.
+
+    The key identifies the service, e.g. its name. Wait for the lease to be
+    released by other requesters, at most for the given timeout seconds.
+    Requests are queued, and stop waiting as soon as they are superseded by
+    a newer one (see get_newer_commit). The commit is None for local charms.
+    Waiting is printed, or reported to output if provided.
+
+    Return the Lease.
+    Raise Superseded if a newer request is queued.
+    Raise an IOError if the lease cannot be taken.
+    """
+    commit = commit or ''
+    directory = os.path.join(
+        settings.CACHE_DIR, 'services', env_name or 'default',
+        hashlib.sha1(key.encode('utf-8')).hexdigest())
+    os.makedirs(directory, exist_ok=True)
+    # Ticket names sort in request order.
+    ticket_path = os.path.join(directory, '{:020d}-{}-{}.ticket'.format(
+        time.time_ns(), os.getpid(), uuid.uuid4().hex))
+    # Only publish the ticket once locked and written.
+    temp_path = ticket_path + '.tmp'
+    lease = Lease(directory, temp_path, open(temp_path, 'w'), None)
+    try:
+        fcntl.flock(lease.ticket, fcntl.LOCK_EX)
+        lease.ticket.write(commit)
+        lease.ticket.flush()
+        os.rename(temp_path, ticket_path)
+        lease.ticket_path = ticket_path
+        lease.lock = open(os.path.join(directory, 'lease.lock'), 'a')
+        deadline = time.monotonic() + timeout
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(lease.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                locked = False
+            newer = get_newer_commit(directory, ticket_path, commit)
+            if newer is not None:
+                raise Superseded(newer or None)
+            if locked:
+                return lease
+            if time.monotonic() > deadline:
+                raise IOError('timed out waiting for the deployment of {} '
+                              'in progress'.format(key))
+            if not waiting:
+                if output is None:
+                    output = print
+                output('waiting for the deployment of {} in progress'.format(
+                    key))
+                waiting = True
+            time.sleep(poll_interval)
+    except BaseException:
+        lease.release()
+        raise
@@ -13,13 +13,25 @@
 """Juju Git Deploy application management."""
 
 import argparse
+from collections.abc import Mapping
 import logging
+import os
+
+import yaml
 
 from . import (
     __doc__ as app_doc,
+    agent,
+    api,
     app,
+    bundle,
+    cleanup,
     env,
     get_version,
+    leases,
+    metrics,
+    offline,
+    pools,
 )
 
 
@@ -58,32 +70,102 @@ def _positive_integer(value):
     if value < 1:
         msg = '{!r} is not a positive number'.format(value)
         raise argparse.ArgumentTypeError(msg)
+    return value
+
+
+def _names_list(value):
+    """An argparse type for comma separated lists of names."""
+    names = [i.strip() for i in value.split(',') if i.strip()]
+    if not names:
+        msg = '{!r} is not a valid list of names'.format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return names
+
+
+def _config_file(value):
+    """An argparse type for YAML service options files.
+
+    Return the file contents.
+    """
+    try:
+        with open(os.path.expanduser(value)) as stream:
+            contents = stream.read()
+        data = yaml.safe_load(contents)
+    except Exception as err:
+        msg = 'invalid config file {}: {}'.format(value, err)
+        raise argparse.ArgumentTypeError(msg)
+    if not isinstance(data, Mapping):
+        msg = 'invalid config file {}: not a mapping'.format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return contents
+
+
+def _constraints(value):
+    """An argparse type for service constraints."""
+    try:
+        return api.parse_constraints(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
 
 
 def _validate_placement(options, parser):
-    """Ensure one unit has been requested if machine is not None."""
-    if (options.machine is not None) and (options.num_units != 1):
-        parser.error('cannot use --num-units > 1 with --to')
+    """Ensure there are not more placement targets than requested units."""
+    if options.machines and (len(options.machines) > options.num_units):
+        parser.error('cannot use more --to targets than --num-units')
+
+
+def _validate_setup(options, parser):
+    """Ensure the service set up options are not used with bundles."""
+    uses_setup = (
+        options.config or options.constraints or options.expose or
+        options.relations)
+    if uses_setup and os.path.isfile(options.repo):
+        parser.error(
+            'cannot use --config, --constraints, --expose or --relate '
+            'with bundles')
+
+
+def _validate_offline(options, parser):
+    """Ensure offline deployments are not forwarded to the agent."""
+    if options.offline and options.agent:
+        parser.error('cannot use --offline with --agent')
 
 
 def setup():
     """Set up the application options and logger.
 
     Return the options as a namespace containing the following attributes:
-        - repo: the Github repository/branch hosting the charm;
+        - repo: the Github repository/branch hosting the charm, or the path
+          to a local charm directory or to a bundle file;
         - service: the service name, or None if the name must be derived from
           the charm name;
-        - series: the OS series, or None if the default environment series must
-          be used;
+        - series: the list of OS series, or None if the default environment
+          series must be used;
         - num_units: the number of units to be deployed;
-        - machine: the machine/container where to deploy the unit;
-        - env_name: the name of the Juju environment to use.
+        - machines: the list of machines/containers where to deploy the
+          units, or None if the units must not be placed;
+        - env_names: the list of Juju environment names to use, or None if
+          a default environment is not found;
+        - pool: the environment pool to pick the environment from, or None;
+        - jobs: the maximum number of operations performed in parallel;
+        - config: the contents of the YAML service options file, or None;
+        - constraints: the service constraints as a dict, or None;
+        - expose: whether to expose the service;
+        - relations: the list of endpoints the service must be related to,
+          or None;
+        - ephemeral: the label marking the services as ephemeral, or None;
+        - agent: whether to forward the request to the background agent;
+        - offline: the path to the prefetched archive directory, or None if
+          charms must be retrieved from Github.
     """
     default_env_name = env.get_default_env_name()
     # Define the help message for the --environment option.
     env_help = 'The name of the Juju environment to use'
     if default_env_name is not None:
         env_help = '{} (%(default)s)'.format(env_help)
+    env_help += (
+        '\nMultiple comma separated environments can be provided, e.g.:\n'
+        '    juju git-deploy hatched/ghost-charm -e staging,qa')
     # Create and set up the arguments parser.
     parser = argparse.ArgumentParser(
         description=app_doc, formatter_class=argparse.RawTextHelpFormatter)
@@ -100,26 +182,93 @@ def setup():
              'To deploy a specific git branch or reference, append a colon\n'
              'followed by the reference identifier, e.g.:\n'
              '    juju git-deploy frankban/ghost-charm:develop\n'
+             'Multiple comma separated references are deployed side by\n'
+             'side, appending the reference to the service names, e.g.:\n'
+             '    juju git-deploy frankban/ghost-charm:master,feature-x\n'
              "If the reference is not specified, the repository's default\n"
-             'branch is used (usually "master")')
+             'branch is used (usually "master").\n'
+             'Charms in a repository subdirectory can be selected by path,\n'
+             'using wildcards to deploy multiple charms at once, e.g.:\n'
+             '    juju git-deploy frankban/charms/charms/*:develop\n'
+             'A path to a local charm directory can also be provided:\n'
+             '    juju git-deploy ~/charms/ghost-charm\n'
+             'A path to a YAML bundle file can be provided to deploy\n'
+             'multiple services and their relations at once:\n'
+             '    juju git-deploy ~/stacks/blog.yaml\n'
+             'See the README for a description of the bundle format')
     parser.add_argument(
         'service', default=None, nargs='?',
         help='The service name. If omitted, the service name is derived from\n'
              'the charm name')
     parser.add_argument(
-        '-s', '--series',
+        '-s', '--series', type=_names_list,
         help='The OS series to use when deploying the charm. If not\n'
-             'specified, the default series for the Juju environment is used')
+             'specified, the default series for the Juju environment is\n'
+             'used. Multiple comma separated series can be provided, e.g.:\n'
+             '    juju git-deploy hatched/ghost-charm -s trusty,precise\n'
+             'In this case a service is deployed for each series, and the\n'
+             'series is appended to the service name')
     parser.add_argument(
         '-n', '--num-units', type=_positive_integer, default=1,
         help='The number of units to be deployed (default: 1)')
     parser.add_argument(
-        '--to', dest='machine',
+        '--to', dest='machines', type=_names_list,
         help='The machine or container to deploy the unit in.\n'
-             'See "juju help deploy"')
+             'See "juju help deploy". Multiple comma separated targets\n'
+             'can be provided, and units are spread across them, e.g.:\n'
+             '    juju git-deploy hatched/ghost-charm -n 4 --to 1,2,lxc:3')
+    parser.add_argument(
+        '-e', '--environment', type=_names_list, default=default_env_name,
+        dest='env_names', help=env_help)
     parser.add_argument(
-        '-e', '--environment', default=default_env_name, dest='env_name',
-        help=env_help)
+        '--pool',
+        help='Deploy to the least loaded environment in the given pool,\n'
+             'overriding -e. Pools are defined in the configuration file:\n'
+             '    pools:\n'
+             '      ci: [ci-1, ci-2, ci-3]\n'
+             'A comma separated list of environments can also be provided')
+    parser.add_argument(
+        '-j', '--jobs', type=_positive_integer, default=4,
+        help='The maximum number of operations performed in parallel, e.g.\n'
+             'when deploying to multiple environments or series\n'
+             '(default: 4)')
+    parser.add_argument(
+        '--config', type=_config_file,
+        help='A YAML file with the service options, in the same format\n'
+             'used by "juju deploy --config", e.g.:\n'
+             '    ghost:\n'
+             '      port: 8080')
+    parser.add_argument(
+        '--constraints', type=_constraints,
+        help='The machine constraints for the service, e.g.:\n'
+             '    juju git-deploy hatched/ghost-charm '
+             '--constraints "mem=4G cpu-cores=2"')
+    parser.add_argument(
+        '--expose', action='store_true',
+        help='Expose the service once deployed')
+    parser.add_argument(
+        '--relate', dest='relations', type=_names_list,
+        help='Relate the service to the given comma separated endpoints,\n'
+             'e.g.:\n'
+             '    juju git-deploy hatched/ghost-charm --relate mysql:db')
+    parser.add_argument(
+        '--ephemeral', metavar='LABEL',
+        help='Mark the deployed services as ephemeral using the given\n'
+             'label, e.g. a CI job identifier. Ephemeral services can then\n'
+             'be destroyed at once with "python -m jujugd.cleanup", e.g.:\n'
+             '    python -m jujugd.cleanup -e ci LABEL')
+    parser.add_argument(
+        '--agent', action='store_true',
+        help='Forward the request to the background agent, starting it if\n'
+             'required. The agent keeps environment information,\n'
+             'connections and archives warm, so that repeated deployments\n'
+             'are faster. It exits after 30 minutes of inactivity')
+    parser.add_argument(
+        '--offline', metavar='PATH',
+        help='Retrieve charms from the given directory of prefetched\n'
+             'archives, never contacting Github. Archives can be\n'
+             'prefetched with "python -m jujugd.offline", e.g.:\n'
+             '    python -m jujugd.offline ~/archives hatched/ghost-charm')
     parser.add_argument(
         '--version', action='version',
         version='%(prog)s {}'.format(get_version()))
@@ -135,16 +284,136 @@ def setup():
     options = parser.parse_args()
     # Validate the provided arguments.
     _validate_placement(options, parser)
+    _validate_setup(options, parser)
+    _validate_offline(options, parser)
     # Set up logging.
     _configure_logging(logging.DEBUG if options.debug else logging.INFO)
     return options
 
 
 def run(options):
-    """Run the application."""
-    zip_url, api_address, password, series = app.prepare(
-        options.repo, options.env_name, options.series)
-    charm_url = app.process(zip_url, api_address, password, series)
-    app.deploy(
-        charm_url, options.service, options.num_units, options.machine,
-        api_address, password)
+    """Run the application.
+
+    If an environment pool is provided, a lease is held on the chosen
+    environment for the whole deployment.
+    """
+    if not options.pool:
+        _run(options)
+        return
+    try:
+        env_names = pools.get_pool(options.pool)
+    except ValueError as err:
+        raise app.ProgramExit(str(err))
+    with pools.acquire(env_names, options.jobs) as lease:
+        print('using environment {} from pool {}'.format(
+            lease.env_name, options.pool))
+        options.env_names = [lease.env_name]
+        _run(options)
+
+
+def _run(options):
+    """Deploy the charm or bundle as described by the given options."""
+    if options.agent:
+        agent.forward(options)
+        return
+    env_names = options.env_names or [None]
+    series_list = options.series or [None]
+    session = None
+    if options.offline:
+        session = offline.OfflineSession(options.offline)
+    annotations = None
+    if options.ephemeral:
+        annotations = {cleanup.ANNOTATION: options.ephemeral}
+    if os.path.isfile(options.repo):
+        for env_name in env_names:
+            bundle.deploy(
+                options.repo, env_name, series_list[0], options.jobs,
+                session=session, annotations=annotations)
+        return
+    setup = app.ServiceSetup(
+        options.config, options.constraints, options.expose,
+        options.relations or (), annotations)
+    recorder = metrics.Recorder(options.repo)
+    try:
+        if app.get_charm_path(options.repo):
+            app.deploy_charms(
+                options.repo, env_names, series_list, options.service,
+                options.num_units, options.machines, options.jobs,
+                session=session, recorder=recorder, setup=setup)
+            return
+        if len(app.get_zip_urls(options.repo)) > 1:
+            app.deploy_refs(
+                options.repo, env_names, series_list, options.service,
+                options.num_units, options.machines, options.jobs,
+                session=session, recorder=recorder, setup=setup)
+            return
+        if len(env_names) > 1 or len(series_list) > 1:
+            app.fan_out(
+                options.repo, env_names, series_list, options.service,
+                options.num_units, options.machines, options.jobs,
+                session=session, recorder=recorder, setup=setup)
+            return
+        if session is None:
+            session = app.Session()
+        with recorder.measure('prepare', env_names[0]):
+            zip_url, api_address, password, series = app.prepare(
+                options.repo, env_names[0], series_list[0])
+            provenance = app.get_provenance(zip_url, session=session)
+        try:
+            lease = app.acquire_lease(
+                env_names[0], options.service, provenance, zip_url)
+        except leases.Superseded as err:
+            print('deployment {}'.format(err))
+            return
+        with lease:
+            services = lease.get_result(provenance.commit)
+            if services is not None:
+                print('service {} deployed concurrently at {}'.format(
+                    ', '.join(services), provenance.commit))
+                return
+            services = _deploy(
+                options, env_names[0], zip_url, api_address, password,
+                series, provenance, session, recorder, setup)
+            lease.record(provenance.commit, services)
+    finally:
+        recorder.save()
+
+
+def _deploy(
+        options, env_name, zip_url, api_address, password, series, provenance,
+        session, recorder, setup):
+    """Deploy the charm to a single environment, holding the service lease.
+
+    Return the list of deployed service names.
+    """
+    services = [options.service]
+    deployed = app.get_deployed(
+        services, provenance, api_address, password, session=session)
+    if app.is_current(deployed, provenance):
+        print('service {} already at {}'.format(
+            options.service, provenance.commit))
+        return services
+    transforms = app.get_transforms(zip_url)
+    with recorder.measure('process', env_name) as stats:
+        # The archive is opened once: the tree is hashed reading the archive
+        # central directory, and the same stream is then uploaded.
+        with session.open(zip_url, commit=provenance.commit) as stream:
+            tree = None
+            if provenance.commit is not None:
+                tree = app.get_stream_tree(stream, transforms)
+            if app.is_unchanged(deployed, provenance, tree):
+                app.record_provenance(
+                    services, provenance, tree, api_address, password,
+                    session=session)
+                print('service {} unchanged at {}'.format(
+                    options.service, provenance.commit))
+                return services
+            charm_url = app.process_stream(
+                stream, api_address, password, series,
+                transforms=transforms, stats=stats)
+    with recorder.measure('deploy', env_name):
+        service = app.deploy(
+            charm_url, options.service, options.num_units,
+            options.machines, api_address, password,
+            setup=app.add_provenance(setup, provenance, tree=tree))
+    return [service]
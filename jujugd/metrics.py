@@ -0,0 +1,239 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy deployment metrics.
+
+The duration of each deployment phase (prepare, process and deploy) and the
+number of bytes uploaded are accumulated, by environment and repository, in
+histograms stored in a small local JSON file. After each run the histograms
+are exported in the Prometheus text format, so that the file can be picked up
+by the node exporter textfile collector, e.g.:
+
+    metrics-textfile: /var/lib/node_exporter/textfile/juju_git_deploy.prom
+"""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from . import (
+    config,
+    settings,
+)
+
+
+# Define the prefix of the exported metric names.
+PREFIX = 'juju_git_deploy'
+
+
+def get_textfile_path():
+    """Return the path to the Prometheus textfile to write.
+
+    The path is retrieved from the JUJU_GIT_DEPLOY_METRICS environment
+    variable or, if not set, from the "metrics-textfile" key of the
+    configuration file. It defaults to metrics.prom in the cache directory.
+    """
+    path = os.getenv('JUJU_GIT_DEPLOY_METRICS', '').strip()
+    if not path:
+        try:
+            path = config.load().get('metrics-textfile') or ''
+        except ValueError as err:
+            logging.debug('unable to read the configuration: {}'.format(err))
+    return path or os.path.join(settings.CACHE_DIR, 'metrics.prom')
+
+
+def _escape(value):
+    """Escape the given label value as required by the text format."""
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    """Return the given (name, value) label pairs in the text format."""
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in labels))
+
+
+def _format_bound(bound):
+    """Return the given histogram bucket upper bound in the text format."""
+    return '{:g}'.format(bound)
+
+
+def render(entries, buckets=settings.METRICS_BUCKETS):
+    """Return the given histogram entries in the Prometheus text format.
+
+    See the Store below for a description of the entries.
+    """
+    duration = PREFIX + '_phase_duration_seconds'
+    size = PREFIX + '_phase_bytes_total'
+    lines = [
+        '# HELP {} Duration of the deployment phases.'.format(duration),
+        '# TYPE {} histogram'.format(duration),
+    ]
+    for entry in entries:
+        labels = [
+            ('phase', entry['phase']), ('env', entry['env']),
+            ('repo', entry['repo'])]
+        cumulative = 0
+        bounds = [_format_bound(i) for i in buckets] + ['+Inf']
+        for bound, count in zip(bounds, entry['buckets']):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                duration, _format_labels(labels + [('le', bound)]),
+                cumulative))
+        lines.append('{}_sum{} {}'.format(
+            duration, _format_labels(labels), repr(float(entry['sum']))))
+        lines.append('{}_count{} {}'.format(
+            duration, _format_labels(labels), entry['count']))
+    lines.extend([
+        '# HELP {} Bytes transferred by the deployment phases.'.format(size),
+        '# TYPE {} counter'.format(size),
+    ])
+    for entry in entries:
+        labels = [
+            ('phase', entry['phase']), ('env', entry['env']),
+            ('repo', entry['repo'])]
+        lines.append('{}{} {}'.format(
+            size, _format_labels(labels), entry['bytes']))
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path, text):
+    """Atomically write the given text to the file at the given path."""
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as stream:
+        stream.write(text)
+    os.rename(temp_path, path)
+
+
+class Store:
+    """The histograms of the deployment phase durations, stored on disk.
+
+    Histograms are stored as a JSON list of entries, one for each phase,
+    environment and repository. Each entry includes the observations count
+    for each bucket in buckets (plus a final +Inf bucket), the sum of the
+    observed seconds and the total number of transferred bytes.
+    The store is protected by a lock file, so that concurrent runs can merge
+    their observations safely.
+    """
+
+    def __init__(self, path, buckets=settings.METRICS_BUCKETS):
+        self.path = path
+        self.buckets = buckets
+
+    def _load(self):
+        """Return the stored entries keyed by phase, environment and repo."""
+        try:
+            with open(self.path) as stream:
+                entries = json.load(stream)
+        except FileNotFoundError:
+            return {}
+        except ValueError as err:
+            logging.debug('discarding invalid metrics: {}'.format(err))
+            return {}
+        result = {}
+        for entry in entries:
+            # Discard histograms recorded with different buckets.
+            if len(entry.get('buckets', ())) == len(self.buckets) + 1:
+                result[entry['phase'], entry['env'], entry['repo']] = entry
+        return result
+
+    def _new_entry(self, phase, env_name, repo):
+        """Return an empty histogram entry."""
+        return {
+            'phase': phase, 'env': env_name, 'repo': repo,
+            'buckets': [0] * (len(self.buckets) + 1),
+            'sum': 0, 'count': 0, 'bytes': 0,
+        }
+
+    def merge(self, samples, textfile_path):
+        """Add the given samples to the store, and export the histograms.
+
+        Each sample is a (phase, env name, repo, seconds, bytes) tuple. The
+        histograms are written in the Prometheus text format to the given
+        textfile path.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._load()
+            for phase, env_name, repo, seconds, size in samples:
+                key = (phase, env_name, repo)
+                entry = entries.get(key)
+                if entry is None:
+                    entry = entries[key] = self._new_entry(*key)
+                index = len(self.buckets)
+                for position, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        index = position
+                        break
+                entry['buckets'][index] += 1
+                entry['sum'] += seconds
+                entry['count'] += 1
+                entry['bytes'] += size
+            entries = [entries[key] for key in sorted(entries)]
+            _write(self.path, json.dumps(entries))
+            textfile_dir = os.path.dirname(textfile_path)
+            if textfile_dir:
+                os.makedirs(textfile_dir, exist_ok=True)
+            _write(textfile_path, render(entries, buckets=self.buckets))
+
+
+class Recorder:
+    """Record the duration of the deployment phases of a run.
+
+    The recorder is thread safe, so that it can be shared by deployments to
+    multiple environments running in parallel.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def observe(self, phase, env_name, seconds, size=0):
+        """Record the given phase duration and transferred bytes."""
+        with self._lock:
+            self.samples.append(
+                (phase, env_name or 'default', self.repo, seconds, size))
+
+    @contextmanager
+    def measure(self, phase, env_name):
+        """Measure the duration of the code in the context block.
+
+        A dict is made available in the block, in which the number of
+        transferred bytes can be stored under the "bytes" key. Nothing is
+        recorded if the phase fails.
+        """
+        sample = {'bytes': 0}
+        start = time.monotonic()
+        yield sample
+        self.observe(
+            phase, env_name, time.monotonic() - start, sample['bytes'])
+
+    def save(self):
+        """Merge the recorded samples into the metrics store.
+
+        Failing to store the metrics is not fatal.
+        """
+        with self._lock:
+            samples, self.samples = self.samples, []
+        if not samples:
+            return
+        store = Store(os.path.join(settings.CACHE_DIR, 'metrics.json'))
+        try:
+            store.merge(samples, get_textfile_path())
+        except (IOError, OSError) as err:
+            logging.debug('unable to store metrics: {}'.format(err))
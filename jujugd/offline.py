@@ -0,0 +1,236 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy offline deployments.
+
+Charm archives can be prefetched into a directory, e.g.:
+
+    python -m jujugd.offline ~/archives hatched/ghost-charm:develop
+
+The directory also includes a YAML manifest mapping each repository to the
+commit SHA, file name, size and SHA256 hash of its archive. The directory can
+then be copied to hosts with no route to Github, and used to deploy charms
+with "juju git-deploy --offline ~/archives".
+"""
+
+import argparse
+from collections.abc import Mapping
+import hashlib
+import logging
+import os
+
+import yaml
+
+from . import (
+    app,
+    github,
+    utils,
+)
+
+
+MANIFEST_NAME = 'manifest.yaml'
+# Define the size of the chunks read when copying and hashing archives.
+CHUNK_SIZE = 64 * 1024
+
+
+def get_key(zip_url):
+    """Return the manifest key for the given Github zip URL.
+
+    The key is in the {user}/{repo}[:{ref}] form.
+    """
+    base, ref = zip_url.rsplit('/zipball/', 1)
+    key = '/'.join(base.split('/')[-2:])
+    return '{}:{}'.format(key, ref) if ref else key
+
+
+def load_manifest(path):
+    """Return the manifest in the given directory as a dict.
+
+    Return an empty dict if the manifest does not exist.
+    Raise a ValueError if the manifest is not valid.
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as stream:
+            manifest = yaml.safe_load(stream)
+    except FileNotFoundError:
+        return {}
+    except Exception as err:
+        raise ValueError(str(err))
+    if manifest is None:
+        return {}
+    if not isinstance(manifest, Mapping):
+        raise ValueError('invalid manifest in {}'.format(path))
+    return manifest
+
+
+def _write_manifest(path, manifest):
+    """Atomically write the given manifest to the given directory."""
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    temp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+    with open(temp_path, 'w') as stream:
+        yaml.safe_dump(manifest, stream, default_flow_style=False)
+    os.rename(temp_path, manifest_path)
+
+
+def _copy(source, path):
+    """Copy the source file-like object to the file at the given path.
+
+    Contents are copied in chunks. Return the SHA256 hash and size of the
+    contents.
+    """
+    checksum = hashlib.sha256()
+    size = 0
+    temp_path = '{}.{}.partial'.format(path, os.getpid())
+    with open(temp_path, 'wb') as stream:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+            size += len(chunk)
+            stream.write(chunk)
+    os.rename(temp_path, path)
+    return checksum.hexdigest(), size
+
+
+def prefetch(repos, path):
+    """Download the archives of the given Github repositories to path.
+
+    Each repository is in the form accepted by the plugin, e.g.
+    "hatched/ghost-charm:develop". The manifest is updated accordingly.
+    Raise a ProgramExit if an error occurs.
+    """
+    try:
+        os.makedirs(path, exist_ok=True)
+        manifest = load_manifest(path)
+    except (OSError, ValueError) as err:
+        raise app.ProgramExit('invalid archive directory: {}'.format(err))
+    for repo in repos:
+        if os.path.isdir(repo):
+            raise app.ProgramExit('not a Github repository: {}'.format(repo))
+        zip_url = app.get_zip_url(repo)
+        key = get_key(zip_url)
+        commit = app.get_commit(zip_url)
+        entry = manifest.get(key)
+        if entry is not None and entry['commit'] == commit:
+            print('{}: already at {}'.format(key, commit))
+            continue
+        print('{}: downloading {}'.format(key, commit))
+        base = zip_url.rsplit('/zipball/', 1)[0]
+        name = '{}-{}.zip'.format(key.split(':')[0].replace('/', '-'), commit)
+        try:
+            response = github.urlget('{}/zipball/{}'.format(base, commit))
+            checksum, size = _copy(response, os.path.join(path, name))
+        except (IOError, OSError) as err:
+            msg = 'unable to retrieve charm contents: {}'.format(err)
+            raise app.ProgramExit(msg)
+        manifest[key] = {
+            'commit': commit, 'file': name, 'sha256': checksum, 'size': size}
+        _write_manifest(path, manifest)
+    print('{} archives in {}'.format(len(manifest), path))
+
+
+def open_archive(path, zip_url):
+    """Return a file-like object reading the archive for the given zip URL.
+
+    The archive is retrieved from the prefetched archives in the given
+    directory, and its hash is checked before returning it. The returned
+    object exposes the archive length, so that it can be streamed.
+    Raise a ValueError if the archive is not found or is not valid.
+    """
+    key = get_key(zip_url)
+    entry = load_manifest(path).get(key)
+    if entry is None:
+        raise ValueError('{} not found in {}'.format(key, path))
+    if not (isinstance(entry, Mapping) and
+            all(i in entry for i in ('commit', 'file', 'sha256'))):
+        raise ValueError('invalid manifest entry for {}'.format(key))
+    archive_path = os.path.join(path, entry['file'])
+    checksum = hashlib.sha256()
+    try:
+        stream = utils.FileStream(archive_path)
+    except OSError as err:
+        raise ValueError(str(err))
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        checksum.update(chunk)
+    if checksum.hexdigest() != entry['sha256']:
+        stream.close()
+        raise ValueError('{}: hash mismatch'.format(archive_path))
+    stream.seek(0)
+    logging.debug('{}: using {} at {}'.format(
+        key, archive_path, entry['commit']))
+    return stream
+
+
+class OfflineSession(app.Session):
+    """A session retrieving charms from a prefetched archive directory.
+
+    Github is never contacted. Local charm directories can still be used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_commit(self, zip_url, output=None):
+        """Return the commit of the prefetched archive."""
+        try:
+            entry = load_manifest(self.path).get(get_key(zip_url))
+        except ValueError as err:
+            raise app.ProgramExit('invalid archive directory: {}'.format(err))
+        if not isinstance(entry, Mapping) or 'commit' not in entry:
+            msg = '{} not found in {}'.format(get_key(zip_url), self.path)
+            raise app.ProgramExit(msg)
+        return entry['commit']
+
+    def open(self, zip_url, commit=None, output=None):
+        """Return a file-like object with the prefetched charm contents.
+
+        The commit is ignored: prefetched archives are always used.
+        """
+        if os.path.isdir(zip_url):
+            return super().open(zip_url, output=output)
+        if output is None:
+            output = print
+        output('using prefetched archive')
+        try:
+            return open_archive(self.path, zip_url)
+        except ValueError as err:
+            msg = 'unable to retrieve charm contents: {}'.format(err)
+            raise app.ProgramExit(msg)
+
+    def fetch(self, zip_url, commit=None, output=None):
+        """Return the prefetched charm contents."""
+        if os.path.isdir(zip_url):
+            return super().fetch(zip_url, output=output)
+        with self.open(zip_url, output=output) as stream:
+            return stream.read()
+
+
+def main():
+    """Prefetch archives: this is called when executing the module."""
+    parser = argparse.ArgumentParser(
+        description='Prefetch charm archives for offline deployments')
+    parser.add_argument(
+        'path', help='The directory where archives are stored')
+    parser.add_argument(
+        'repos', nargs='+', metavar='repo',
+        help='The Github repository hosting the charm, e.g. '
+             'hatched/ghost-charm:develop')
+    options = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        prefetch(options.repos, options.path)
+    except app.ProgramExit as err:
+        parser.exit(1, '{}\n'.format(err))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy environment pools.
+
+A pool is a list of identical Juju environments, defined in the configuration
+file, e.g.:
+
+    pools:
+      ci: [ci-1, ci-2, ci-3]
+
+When deploying with "juju git-deploy --pool ci", the least loaded environment
+in the pool is used. The load is measured by the number of deployments in
+progress in each environment, i.e. the leases taken on it by the plugin
+processes, and, to break ties, by the number of units in the environment.
+"""
+
+from collections.abc import Mapping
+from concurrent import futures
+from contextlib import contextmanager
+import fcntl
+import glob
+import logging
+import math
+import os
+import uuid
+
+from . import (
+    api,
+    app,
+    config,
+    env,
+    settings,
+)
+
+
+def get_pool(value):
+    """Return the list of environment names in the given pool.
+
+    The value is either the name of a pool defined in the "pools" section of
+    the configuration file, or a comma separated list of environment names.
+    Raise a ValueError if the pool is not found or is not valid.
+    """
+    pools = config.load().get('pools') or {}
+    if not isinstance(pools, Mapping):
+        raise ValueError('invalid pools in the configuration file')
+    env_names = pools.get(value)
+    if env_names is None:
+        if ',' not in value:
+            raise ValueError('unknown environment pool: {}'.format(value))
+        env_names = value.split(',')
+    if not isinstance(env_names, list):
+        raise ValueError('invalid environment pool: {}'.format(value))
+    env_names = [str(i).strip() for i in env_names if str(i).strip()]
+    if not env_names:
+        raise ValueError('invalid environment pool: {}'.format(value))
+    return env_names
+
+
+class Lease:
+    """A lease on a Juju environment, held until released.
+
+    A lease is a file kept locked by the process holding it, so that leases
+    left behind by processes exiting without releasing them are not counted.
+    """
+
+    def __init__(self, env_name, path, stream):
+        self.env_name = env_name
+        self.path = path
+        self.stream = stream
+
+    def release(self):
+        """Release the lease."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+@contextmanager
+def _lock(leases_dir):
+    """Exclude other processes choosing an environment in the context block.
+
+    All the pools share the lock, as an environment can be included in
+    multiple pools.
+    """
+    os.makedirs(leases_dir, exist_ok=True)
+    with open(os.path.join(leases_dir, 'pool.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def count_leases(env_name, leases_dir):
+    """Return the number of leases currently held on the given environment.
+
+    Stale leases are removed. This must be called while holding the lock.
+    """
+    count = 0
+    for path in glob.glob(os.path.join(leases_dir, env_name, '*.lease')):
+        try:
+            with open(path, 'rb') as stream:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # The process holding the lease exited.
+                os.remove(path)
+        except BlockingIOError:
+            count += 1
+        except OSError:
+            # The lease has been released in the meanwhile.
+            pass
+    return count
+
+
+def _take(env_name, leases_dir):
+    """Take a lease on the given environment. Return the Lease.
+
+    This must be called while holding the lock.
+    """
+    env_dir = os.path.join(leases_dir, env_name)
+    os.makedirs(env_dir, exist_ok=True)
+    path = os.path.join(
+        env_dir, '{}-{}.lease'.format(os.getpid(), uuid.uuid4().hex))
+    stream = open(path, 'w')
+    fcntl.flock(stream, fcntl.LOCK_EX)
+    return Lease(env_name, path, stream)
+
+
+def get_unit_counts(env_names, jobs, session=None):
+    """Return a dict mapping the given environments to their number of units.
+
+    Environments are queried in parallel, using at most the given number of
+    jobs. Environments that cannot be queried are not included.
+    """
+    if session is None:
+        session = app.Session()
+
+    def count(env_name):
+        try:
+            api_address = api.get_api_address(env_name)
+            password = env.parse_jenv(env_name, env.get_password)
+            with session.connect(api_address, password) as connection:
+                return api.count_units(connection)
+        except (api.JujuError, IOError, ValueError) as err:
+            logging.debug('{}: unable to count units: {}'.format(
+                env_name, err))
+            return None
+
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        counts = dict(zip(env_names, executor.map(count, env_names)))
+    return {
+        env_name: units for env_name, units in counts.items()
+        if units is not None}
+
+
+def acquire(env_names, jobs, session=None):
+    """Take a lease on the least loaded environment in the given list.
+
+    Environments with fewer leases are preferred. If multiple environments
+    have the same number of leases, their number of units is retrieved in
+    parallel using at most the given number of jobs, and the environment with
+    fewer units is chosen. The API connections are retrieved from the given
+    app.Session, if provided. Leases are counted and taken atomically across
+    all the plugin processes.
+
+    Return the Lease: the chosen environment is stored in its env_name.
+    Raise a ProgramExit if the lease cannot be taken.
+    """
+    leases_dir = os.path.join(settings.CACHE_DIR, 'leases')
+    try:
+        with _lock(leases_dir):
+            leases = {i: count_leases(i, leases_dir) for i in env_names}
+        candidates = [
+            i for i in env_names if leases[i] == min(leases.values())]
+        units = {}
+        if len(candidates) > 1:
+            units = get_unit_counts(candidates, jobs, session=session)
+        with _lock(leases_dir):
+            # Leases may have been taken while the environments were queried:
+            # count them again before choosing.
+            leases = {i: count_leases(i, leases_dir) for i in env_names}
+            env_name = min(env_names, key=lambda i: (
+                leases[i], units.get(i, math.inf), env_names.index(i)))
+            lease = _take(env_name, leases_dir)
+    except OSError as err:
+        msg = 'unable to lease an environment: {}'.format(err)
+        raise app.ProgramExit(msg)
+    logging.debug('{}: {} leases, {} units'.format(
+        env_name, leases[env_name], units.get(env_name, 'unknown')))
+    return lease
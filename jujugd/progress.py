@@ -0,0 +1,185 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy transfer progress reporting."""
+
+import logging
+import sys
+import threading
+import time
+
+from . import settings
+
+
+# Define the size of the chunks read when consuming a whole stream.
+CHUNK_SIZE = 64 * 1024
+
+
+def format_size(size):
+    """Return a human readable representation of the given bytes size."""
+    if size < 1024:
+        return '{} B'.format(int(size))
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return '{:.1f} {}'.format(size, unit)
+
+
+def format_duration(seconds):
+    """Return a human readable representation of the given seconds."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return '{}:{:02}'.format(minutes, seconds)
+
+
+def _isatty():
+    """Return whether the standard output is a terminal."""
+    isatty = getattr(sys.stdout, 'isatty', None)
+    return bool(isatty and isatty())
+
+
+class Progress:
+    """Report the progress of a transfer of the given total bytes.
+
+    On a terminal, the progress line is updated in place. Otherwise, e.g.
+    in CI logs, a progress line is printed at most once in a while. Nothing
+    is printed for transfers completing before the first report is due.
+    Progress lines are passed to the given output callable, if provided,
+    rather than printed: lines are only updated in place on a terminal.
+    """
+
+    def __init__(
+            self, label, total=None, tty=None, clock=time.monotonic,
+            output=None):
+        self.label = label
+        self.total = total
+        if tty is None:
+            tty = output is None and _isatty()
+        self.tty = tty
+        self.output = output
+        self.interval = (
+            settings.PROGRESS_TTY_INTERVAL if self.tty
+            else settings.PROGRESS_LOG_INTERVAL)
+        self.clock = clock
+        self.done = 0
+        self.start = self.last = clock()
+        self.shown = False
+        self._width = 0
+        self._lock = threading.Lock()
+
+    def _get_rate(self, now):
+        """Return the average transfer rate in bytes per second."""
+        elapsed = now - self.start
+        return self.done / elapsed if elapsed > 0 else 0
+
+    def _describe(self, now):
+        """Return a line describing the current progress."""
+        rate = self._get_rate(now)
+        done = format_size(self.done)
+        if self.total:
+            done = '{} of {} ({:.0%})'.format(
+                done, format_size(self.total), self.done / self.total)
+        parts = [done, '{}/s'.format(format_size(rate))]
+        if self.total and rate:
+            eta = max(self.total - self.done, 0) / rate
+            parts.append('ETA {}'.format(format_duration(eta)))
+        return '{}: {}'.format(self.label, ', '.join(parts))
+
+    def _print(self, line, final=False):
+        """Print the given progress line."""
+        if not self.tty:
+            output = print if self.output is None else self.output
+            output(line)
+            return
+        padding = ' ' * max(self._width - len(line), 0)
+        self._width = len(line)
+        print('\r' + line + padding, end='\n' if final else '', flush=True)
+
+    def update(self, count):
+        """Record the transfer of the given number of bytes."""
+        with self._lock:
+            self.done += count
+            now = self.clock()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            self.shown = True
+            self._print(self._describe(now))
+
+    def rewind(self, done):
+        """Restart counting from the given number of transferred bytes."""
+        with self._lock:
+            self.done = done
+
+    def finish(self):
+        """Report the transfer completion."""
+        with self._lock:
+            now = self.clock()
+            summary = '{}: {} in {} ({}/s)'.format(
+                self.label, format_size(self.done),
+                format_duration(now - self.start),
+                format_size(self._get_rate(now)))
+            logging.debug(summary)
+            if self.shown:
+                self._print(summary, final=True)
+
+
+class ProgressStream:
+    """A file-like object reporting the progress of reading the stream.
+
+    The stream length and, if supported by the stream, seek operations are
+    exposed, so that the wrapper can be passed to utils.urlpost.
+    """
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self._finished = False
+
+    @property
+    def length(self):
+        """Return the length of the stream contents, or None if unknown."""
+        return getattr(self.stream, 'length', None)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.stream.read()
+            self.progress.update(len(data))
+            self._finish()
+            return data
+        data = self.stream.read(size)
+        if data:
+            self.progress.update(len(data))
+        else:
+            self._finish()
+        return data
+
+    def _finish(self):
+        """Report the transfer completion, only once."""
+        if not self._finished:
+            self._finished = True
+            self.progress.finish()
+
+    def seekable(self):
+        seekable = getattr(self.stream, 'seekable', None)
+        return bool(seekable and seekable())
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, offset, whence=0):
+        position = self.stream.seek(offset, whence)
+        self.progress.rewind(position)
+        self._finished = False
+        return position
+
+    def close(self):
+        self.stream.close()
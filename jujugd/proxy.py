@@ -0,0 +1,189 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy charm archive proxy.
+
+The proxy serves Github charm archives to the plugin instances sharing a
+network link, storing them on disk by repository and commit, so that each
+archive is downloaded from Github only once. The proxy exposes the subset of
+the Github API used by the plugin, i.e.:
+
+    /repos/{user}/{repo}/commits/{ref}
+    /repos/{user}/{repo}/zipball/{ref}
+
+Run the proxy with "python -m jujugd.proxy", and point the plugin to it using
+the JUJU_GIT_DEPLOY_PROXY environment variable or the "github-proxy" key of
+the configuration file.
+
+The proxy does not authenticate its clients: anyone who can reach it can
+download the archives of all the repositories readable with the proxy Github
+token, including private ones. For this reason it only listens on the loopback
+interface by default. Use --host to serve other hosts only on trusted networks.
+"""
+
+import argparse
+import http.server
+import logging
+import os
+import re
+import threading
+import time
+
+from . import (
+    app,
+    cache,
+    github,
+    settings,
+    utils,
+)
+
+
+# Compile the regular expressions used to parse the requested paths.
+_path_expression = re.compile(r"""
+    ^/repos/
+    ([-\w]+)/  # User name.
+    ([-\w]+)/  # Repository name.
+    (commits|zipball)/
+    ([-\w.]*)$  # Optional branch/reference name.
+""", re.VERBOSE)
+_commit_expression = re.compile(r'^[0-9a-f]{40}$')
+
+
+class Proxy:
+    """Retrieve charm archives from the upstream Github API.
+
+    Archives are stored in the given directory, keeping at most max_entries
+    of them. Branch references are resolved to commits upstream, and the
+    result is reused for commit_ttl seconds.
+    """
+
+    def __init__(
+            self, upstream, path, max_entries=settings.PROXY_MAX_ARCHIVES,
+            commit_ttl=settings.PROXY_COMMIT_TTL):
+        self.upstream = upstream
+        self.cache = cache.ArchiveCache(path, max_entries=max_entries)
+        self.commit_ttl = commit_ttl
+        self._commits = {}
+        self._lock = threading.Lock()
+
+    def get_commit(self, user, repo, ref):
+        """Return the commit SHA the given reference points to.
+
+        Raise an IOError if the commit cannot be retrieved.
+        """
+        if _commit_expression.match(ref):
+            return ref
+        key = (user, repo, ref)
+        with self._lock:
+            expires, commit = self._commits.get(key, (0, None))
+        if expires > time.time():
+            return commit
+        url = '{}/{}/{}/commits/{}'.format(
+            self.upstream, user, repo, ref or 'HEAD')
+        headers = {'Accept': 'application/vnd.github.v3.sha'}
+        commit = github.urlget(url, headers=headers).read().decode('utf-8')
+        with self._lock:
+            self._commits[key] = (time.time() + self.commit_ttl, commit)
+        return commit
+
+    def get_archive(self, user, repo, ref):
+        """Return the zip archive contents for the given reference.
+
+        Raise an IOError if the archive cannot be retrieved.
+        """
+        commit = self.get_commit(user, repo, ref)
+        url = '{}/{}/{}/zipball/{}'.format(self.upstream, user, repo, commit)
+        return self.cache.get(
+            '{}/{}/{}@{}'.format(self.upstream, user, repo, commit),
+            lambda: github.urlget(url).read())
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serve the proxy requests."""
+
+    def do_GET(self):
+        match = _path_expression.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        user, repo, kind, ref = match.groups()
+        proxy = self.server.proxy
+        try:
+            if kind == 'commits':
+                body = proxy.get_commit(user, repo, ref).encode('utf-8')
+                content_type = 'text/plain'
+            else:
+                body = proxy.get_archive(user, repo, ref)
+                content_type = 'application/zip'
+        except utils.ResponseError as err:
+            self.send_error(err.status, str(err))
+            return
+        except IOError as err:
+            self.send_error(502, str(err))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info('{} {}'.format(self.address_string(), format % args))
+
+
+def make_server(host, port, upstream, path):
+    """Create and return the proxy HTTP server.
+
+    The server listens on the given host and port, retrieves archives from
+    the given upstream Github API URL and stores them in the given path.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.proxy = Proxy(upstream, path)
+    return server
+
+
+def main():
+    """Run the proxy: this is called when executing the module."""
+    parser = argparse.ArgumentParser(description='Juju Git Deploy proxy')
+    parser.add_argument(
+        '--host', default=settings.PROXY_HOST,
+        help='The address to listen to: clients are not authenticated, '
+             'so only expose the proxy on trusted networks '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--port', type=int, default=settings.PROXY_PORT,
+        help='The port to listen to (default: %(default)s)')
+    parser.add_argument(
+        '--upstream', default=app.GITHUB_API,
+        help='The Github API repositories URL (default: %(default)s)')
+    parser.add_argument(
+        '--path', default=os.path.join(settings.CACHE_DIR, 'proxy'),
+        help='The directory where archives are stored (default: %(default)s)')
+    options = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    server = make_server(
+        options.host, options.port, options.upstream.rstrip('/'),
+        options.path)
+    logging.info('proxy listening on {}:{}'.format(options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
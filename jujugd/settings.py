@@ -0,0 +1,96 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy settings."""
+
+import os
+
+
+# Define the directory where the application stores its cached data.
+CACHE_DIR = os.path.join(
+    os.path.expanduser(os.getenv('XDG_CACHE_HOME', '~/.cache')),
+    'juju-git-deploy')
+
+# Define the number of seconds after which subcommands (e.g. "juju status")
+# are killed, and the number of seconds they are given to exit once
+# terminated.
+CALL_TIMEOUT = 5 * 60
+CALL_KILL_TIMEOUT = 2
+# Define the maximum number of bytes of the subcommands error output kept.
+CALL_MAX_ERROR = 64 * 1024
+
+# Define the maximum number of charm archives kept in the shared cache.
+ARCHIVE_CACHE_MAX_ENTRIES = 32
+
+# Define the maximum number of worker processes running charm transforms.
+TRANSFORM_JOBS = os.cpu_count() or 1
+
+# Define the number of seconds to wait for the Juju API server to accept an
+# upload before sending the charm anyway.
+EXPECT_CONTINUE_TIMEOUT = 3
+# Define the number of times a failed upload is retried.
+UPLOAD_RETRIES = 3
+# Define the base and maximum number of seconds to wait between retries.
+UPLOAD_BACKOFF_BASE = 1
+UPLOAD_BACKOFF_MAX = 30
+
+# Define the minimum number of seconds between transfer progress reports,
+# when the output is a terminal and when it is not (e.g. in CI logs).
+PROGRESS_TTY_INTERVAL = 0.2
+PROGRESS_LOG_INTERVAL = 10
+
+# Define the upper bounds, in seconds, of the deployment phase duration
+# histogram buckets.
+METRICS_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Define the number of seconds to wait for the units of ephemeral services to
+# be removed before destroying their machines.
+CLEANUP_TIMEOUT = 10 * 60
+
+# Define the maximum number of seconds to wait for the deployment of the same
+# service by another process, and the seconds between lease checks.
+LEASE_TIMEOUT = 30 * 60
+LEASE_POLL_INTERVAL = 0.5
+
+# Define the maximum number of characters of each Juju API message logged at
+# debug level, and the maximum size of the chunks in which Juju API responses
+# are read and inflated.
+API_LOG_SIZE = 4096
+API_CHUNK_SIZE = 256 * 1024
+
+# Define the path to the Unix socket the background agent listens to.
+AGENT_SOCKET = os.path.join(CACHE_DIR, 'agent.sock')
+# Define the number of seconds after which an idle agent exits.
+AGENT_IDLE_TIMEOUT = 30 * 60
+# Define the number of seconds to wait for the agent to start.
+AGENT_START_TIMEOUT = 10
+# Define the maximum number of downloaded archives kept by the agent.
+AGENT_MAX_ARCHIVES = 16
+
+# Define the path to the optional YAML configuration file.
+CONFIG_PATH = os.path.join(
+    os.path.expanduser(os.getenv('XDG_CONFIG_HOME', '~/.config')),
+    'juju-git-deploy.yaml')
+
+# Define the number of remaining Github requests under which requests are
+# spread over the time left before the rate limit is reset.
+GITHUB_RATE_LIMIT_RESERVE = 10
+
+# Define the default address and port the archive proxy listens to. Only local
+# clients are served by default, as the proxy grants access to all the
+# repositories readable with its Github token.
+PROXY_HOST = '127.0.0.1'
+PROXY_PORT = 8042
+# Define the maximum number of charm archives stored by the archive proxy.
+PROXY_MAX_ARCHIVES = 256
+# Define the number of seconds the proxy reuses a resolved branch commit.
+PROXY_COMMIT_TTL = 60
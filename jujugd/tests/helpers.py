@@ -13,9 +13,50 @@
 """Test helpers for the Juju Git Deploy plugin."""
 
 from contextlib import contextmanager
+import io
+import json
+import os
+import shutil
+import tempfile
 from unittest import mock
 from urllib import request
 
+from .. import utils
+
+
+class ConfigMixin:
+    """Isolate each test from the user's environment and configuration."""
+
+    def setUp(self):
+        super().setUp()
+        patch_environ = mock.patch.dict(os.environ)
+        patch_environ.start()
+        self.addCleanup(patch_environ.stop)
+        for name in (
+                'GITHUB_TOKEN', 'JUJU_GIT_DEPLOY_PROXY',
+                'JUJU_GIT_DEPLOY_METRICS'):
+            os.environ.pop(name, None)
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        patch_config_path = mock.patch(
+            'jujugd.settings.CONFIG_PATH',
+            os.path.join(config_dir, 'juju-git-deploy.yaml'))
+        patch_config_path.start()
+        self.addCleanup(patch_config_path.stop)
+
+
+class CacheDirMixin:
+    """Use a temporary cache directory for the duration of each test."""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        patch_cache_dir = mock.patch(
+            'jujugd.settings.CACHE_DIR', self.cache_dir)
+        patch_cache_dir.start()
+        self.addCleanup(patch_cache_dir.stop)
+
 
 class ErrorTestsMixin:
     """Set up some base methods for testing functions raising exceptions."""
@@ -47,10 +88,31 @@ def patch_multiple_calls(side_effect):
     return mock.patch('jujugd.utils.call', mock_call)
 
 
-def make_response(contents='', status=200, reason='OK'):
-    """Create and return a response file-like object."""
-    mock_read = mock.Mock(return_value=contents)
-    return mock.Mock(status=status, reason=reason, read=mock_read)
+def make_response(contents='', status=200, reason='OK', headers=None):
+    """Create and return a response file-like object.
+
+    The response contents can be read all at once or in chunks.
+    """
+    if isinstance(contents, bytes):
+        stream = io.BytesIO(contents)
+    else:
+        stream = io.StringIO(contents)
+    mock_read = mock.Mock(side_effect=stream.read)
+    return mock.Mock(
+        status=status, reason=reason, read=mock_read, headers=headers or {})
+
+
+def stream_response(response, path=None, callback=None):
+    """Return the given Juju API response as returned by connection.send.
+
+    If a path is provided, the items found at the given path are streamed to
+    the callback (see api.JujuWebSocketConnection.send).
+    """
+    if path is None:
+        return response
+    decoder = utils.JSONStreamDecoder(path, callback)
+    decoder.feed(json.dumps(response))
+    return decoder.close()
 
 
 def make_stream(contents, length=None):
@@ -59,6 +121,7 @@ def make_stream(contents, length=None):
     return mock.Mock(read=mock_read, length=length)
 
 
+@contextmanager
 def patch_connection(contents='', status=200, reason='OK'):
     """Patch the http.client.HTTPSConnection object.
 
@@ -66,29 +129,36 @@ def patch_connection(contents='', status=200, reason='OK'):
         - response.read() returns the given contents;
         - response.status is the given status;
         - response.reason is the given reason.
+
+    The server is assumed to accept requests expecting 100-continue.
     """
     mock_response = make_response(
         contents=contents.encode('utf-8'), status=status, reason=reason)
     mock_getresponse = mock.Mock(return_value=mock_response)
     mock_connection = mock.Mock(getresponse=mock_getresponse)
     mock_connection_class = mock.Mock(return_value=mock_connection)
-    return mock.patch('http.client.HTTPSConnection', mock_connection_class)
+    with mock.patch('jujugd.utils._wait_for_continue', return_value=None):
+        with mock.patch(
+                'http.client.HTTPSConnection', mock_connection_class):
+            yield mock_connection_class
 
 
-def patch_urlopen(contents='', status=200, reason='OK', error=None):
+def patch_urlopen(
+        contents='', status=200, reason='OK', error=None, headers=None):
     """Patch the urllib.request.urlopen function.
 
     The returned response is a file-like object set up like the following:
         - response.read() returns the given contents;
         - response.status is the given status;
-        - response.reason is the given reason.
+        - response.reason is the given reason;
+        - response.headers is the given headers dict.
 
     If instead an error message is provided, the returned response generates
     an urllib.request.URLError side effect.
     """
     if error is None:
         mock_response = make_response(
-            contents=contents, status=status, reason=reason)
+            contents=contents, status=status, reason=reason, headers=headers)
         mock_urlopen = mock.Mock(return_value=mock_response)
     else:
         mock_urlopen = mock.Mock(side_effect=request.URLError(error))
@@ -0,0 +1,253 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy background agent."""
+
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    agent,
+    api,
+    app,
+)
+
+
+class TestWarmSessionDiscover(TestCase):
+
+    def setUp(self):
+        # Set up a jenv file and the session.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.jenv_path = os.path.join(directory, 'ec2.jenv')
+        with open(self.jenv_path, 'w') as stream:
+            stream.write('bootstrap-config: {}')
+        patch_jenv_path = mock.patch(
+            'jujugd.env.get_jenv_path', return_value=self.jenv_path)
+        patch_jenv_path.start()
+        self.addCleanup(patch_jenv_path.stop)
+        self.session = agent.WarmSession()
+        self.addCleanup(self.session.close)
+
+    def patch_discover(self):
+        """Patch the application discover function."""
+        return mock.patch(
+            'jujugd.app.discover',
+            return_value=('10.0.3.1:17070', 'secret!', 'trusty'))
+
+    def test_cached(self):
+        # The environment information is retrieved only once.
+        with self.patch_discover() as mock_discover:
+            facts1 = self.session.discover('ec2', None)
+            facts2 = self.session.discover('ec2', None)
+        self.assertEqual(('10.0.3.1:17070', 'secret!', 'trusty'), facts1)
+        self.assertEqual(facts1, facts2)
+        mock_discover.assert_called_once_with('ec2', None)
+
+    def test_jenv_changed(self):
+        # The environment information is retrieved again if the jenv file
+        # changed.
+        with self.patch_discover() as mock_discover:
+            self.session.discover('ec2', None)
+            os.utime(self.jenv_path, (0, 0))
+            self.session.discover('ec2', None)
+        self.assertEqual(2, mock_discover.call_count)
+
+
+class TestWarmSessionFetch(TestCase):
+
+    zip_url = 'https://api.github.com/repos/hatched/ghost-charm/zipball/dev'
+
+    def setUp(self):
+        self.session = agent.WarmSession(max_archives=1)
+        self.addCleanup(self.session.close)
+
+    @helpers.mock_print
+    def test_cached_by_commit(self, mock_print):
+        # Archives are retrieved only once for each commit.
+        with mock.patch('jujugd.app.get_commit', return_value='abc'):
+            with mock.patch(
+                    'jujugd.app.fetch', return_value=b'zip') as mock_fetch:
+                contents1 = self.session.fetch(self.zip_url)
+                contents2 = self.session.fetch(self.zip_url)
+        self.assertEqual(b'zip', contents1)
+        self.assertEqual(b'zip', contents2)
+        mock_fetch.assert_called_once_with(
+            self.zip_url, commit='abc', output=None)
+
+    def test_new_commit(self):
+        # Archives are retrieved again when the reference changes, and old
+        # archives are discarded.
+        with mock.patch('jujugd.app.get_commit', side_effect=['a', 'b', 'a']):
+            with mock.patch(
+                    'jujugd.app.fetch', return_value=b'zip') as mock_fetch:
+                for _ in range(3):
+                    self.session.fetch(self.zip_url)
+        self.assertEqual(3, mock_fetch.call_count)
+
+
+@mock.patch('jujugd.api.login')
+@mock.patch('jujugd.api.JujuWebSocketConnection')
+class TestWarmSessionConnect(helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        self.session = agent.WarmSession()
+        self.addCleanup(self.session.close)
+
+    def test_reused(self, mock_connection, mock_login):
+        # Connections are established and logged in only once.
+        with mock.patch('jujugd.api.ping') as mock_ping:
+            with self.session.connect('10.0.3.1:17070', 'secret!') as conn1:
+                pass
+            with self.session.connect('10.0.3.1:17070', 'secret!') as conn2:
+                pass
+        self.assertIs(conn1, conn2)
+        mock_connection.assert_called_once_with('wss://10.0.3.1:17070')
+        mock_login.assert_called_once_with(conn1, 'secret!')
+        mock_ping.assert_called_once_with(conn1)
+
+    def test_dead_connection(self, mock_connection, mock_login):
+        # A new connection is established if the cached one is not alive.
+        with self.session.connect('10.0.3.1:17070', 'secret!'):
+            pass
+        with mock.patch('jujugd.api.ping', side_effect=api.JujuError('bad')):
+            with self.session.connect('10.0.3.1:17070', 'secret!'):
+                pass
+        self.assertEqual(2, mock_connection.call_count)
+        self.assertEqual(2, mock_login.call_count)
+
+    def test_connection_error(self, mock_connection, mock_login):
+        # A JujuError is raised if the connection cannot be established.
+        mock_connection().connect.side_effect = ValueError('bad wolf')
+        mock_connection().ws_address = 'wss://10.0.3.1:17070'
+        expected = 'unable to connect to wss://10.0.3.1:17070: bad wolf'
+        with self.assert_error(api.JujuError, expected):
+            with self.session.connect('10.0.3.1:17070', 'secret!'):
+                pass
+
+
+class TestOutput(TestCase):
+
+    def test_lines(self):
+        # Only complete lines are sent.
+        send = mock.Mock()
+        output = agent._Output(send)
+        output.write('bad ')
+        self.assertFalse(send.called)
+        output.write('wolf\nexterminate')
+        send.assert_called_once_with({'Output': 'bad wolf'})
+
+
+class TestServeAndForward(helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        # Start the agent in a separate thread.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'agent.sock')
+        self.options = argparse.Namespace(
+            repo='hatched/ghost-charm', service=None, series=None,
+            num_units=1, machines=None, env_names=['ec2'], jobs=4,
+            agent=True, debug=False, config=None, constraints=None,
+            expose=False, relations=None, ephemeral=None)
+
+    def serve(self, side_effect):
+        """Run the agent handling a single request with a mock fan out."""
+        server = threading.Thread(target=agent.serve, args=(self.path, 0.5))
+
+        def start(path):
+            # Wait for the agent thread to listen rather than starting a new
+            # agent process.
+            sock = None
+            while sock is None:
+                sock = agent._connect(path)
+            return sock
+
+        with mock.patch('jujugd.app.fan_out', side_effect=side_effect):
+            server.start()
+            with helpers.mock_print as mock_print, \
+                    mock.patch('jujugd.agent.start', side_effect=start):
+                try:
+                    agent.forward(self.options, path=self.path)
+                finally:
+                    server.join()
+        return mock_print
+
+    def test_success(self):
+        # The request is handled by the agent and the output is forwarded.
+        def fan_out(*args, **kwargs):
+            self.assertIsInstance(kwargs['session'], agent.WarmSession)
+            # The builtin print is patched: write to the redirected stdout.
+            sys.stdout.write('deployed\n')
+        mock_print = self.serve(fan_out)
+        mock_print.assert_called_with('deployed')
+        # The agent exited after being idle.
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_error(self):
+        # A ProgramExit is raised if the deployment fails.
+        expected = 'juju-git-deploy: error: bad wolf'
+        with self.assert_error(app.ProgramExit, expected):
+            self.serve(app.ProgramExit('bad wolf'))
+
+
+class TestServeStartup(TestCase):
+
+    def setUp(self):
+        # Use a socket path in a temporary directory.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'agent.sock')
+
+    def bind(self):
+        """Bind a Unix socket to the path, and return the socket."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(self.path)
+        return sock
+
+    def test_already_running(self):
+        # The agent exits if another agent is listening on the socket.
+        self.bind().listen(1)
+        with mock.patch('jujugd.agent.WarmSession') as mock_session:
+            agent.serve(self.path, 0.01)
+        self.assertFalse(mock_session.called)
+        self.assertIsNotNone(agent._connect(self.path))
+
+    def test_stale_socket(self):
+        # Sockets left behind by crashed agents are replaced.
+        self.bind().close()
+        agent.serve(self.path, 0.01)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_socket_replaced(self):
+        # The agent does not remove sockets created by other agents.
+        server = threading.Thread(target=agent.serve, args=(self.path, 0.2))
+        server.start()
+        while not os.path.exists(self.path):
+            time.sleep(0.01)
+        with agent._startup_lock(self.path):
+            os.remove(self.path)
+            self.bind()
+        server.join()
+        self.assertTrue(os.path.exists(self.path))
@@ -13,15 +13,31 @@
 """Tests for the Juju Git Deploy base application function."""
 
 from contextlib import contextmanager
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 from unittest import (
     mock,
     TestCase,
 )
+import zipfile
 
 import yaml
 
 from . import helpers
-from .. import app
+from .. import (
+    api,
+    app,
+    archive,
+    leases,
+    metrics,
+    settings,
+    transform,
+)
 
 
 class TestProgramExit(TestCase):
@@ -32,7 +48,289 @@ class TestProgramExit(TestCase):
         self.assertEqual('juju-git-deploy: error: bad wolf', str(exception))
 
 
-class TestPrepare(helpers.ErrorTestsMixin, TestCase):
+class TestGetZipUrl(helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def test_repository(self):
+        # The Github zip URL for the repository is returned.
+        zip_url = app.get_zip_url('https://github.com/hatched/ghost-charm')
+        self.assertEqual(
+            'https://api.github.com/repos/hatched/ghost-charm/zipball/',
+            zip_url)
+
+    def test_reference(self):
+        # The zip URL includes the requested reference.
+        zip_url = app.get_zip_url('hatched/ghost-charm:develop')
+        self.assertEqual(
+            'https://api.github.com/repos/hatched/ghost-charm/zipball/develop',
+            zip_url)
+
+    def test_invalid_repository(self):
+        # A ProgramExit is raised if the Github repository is not valid.
+        expected = 'juju-git-deploy: error: invalid repository: bad:wolf:42'
+        with self.assert_error(app.ProgramExit, expected):
+            app.get_zip_url('bad:wolf:42')
+
+    def test_charm_path(self):
+        # The path to the charms is not included in the zip URL.
+        zip_url = app.get_zip_url('frankban/charms/charms/*:develop')
+        self.assertEqual(
+            'https://api.github.com/repos/frankban/charms/zipball/develop',
+            zip_url)
+
+
+class TestGetZipUrls(helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def test_references(self):
+        # A zip URL is returned for each reference.
+        zip_urls = app.get_zip_urls('hatched/ghost-charm:master,feature-x')
+        self.assertEqual([
+            'https://api.github.com/repos/hatched/ghost-charm/zipball/master',
+            'https://api.github.com/repos/hatched/ghost-charm/zipball/'
+            'feature-x',
+        ], zip_urls)
+
+    def test_default_branch(self):
+        # A single zip URL is returned if no references are provided.
+        zip_urls = app.get_zip_urls('hatched/ghost-charm')
+        self.assertEqual(
+            ['https://api.github.com/repos/hatched/ghost-charm/zipball/'],
+            zip_urls)
+
+    def test_multiple_references_not_supported(self):
+        # A single zip URL cannot be retrieved for multiple references.
+        expected = (
+            'juju-git-deploy: error: multiple references not supported: '
+            'hatched/ghost-charm:a,b')
+        with self.assert_error(app.ProgramExit, expected):
+            app.get_zip_url('hatched/ghost-charm:a,b')
+
+
+class TestGetRefService(TestCase):
+
+    def test_service(self):
+        # The reference is appended to the service name.
+        self.assertEqual(
+            'ghost-feature-x', app.get_ref_service('ghost', 'feature-x'))
+
+    def test_invalid_characters(self):
+        # Characters not allowed in service names are replaced.
+        self.assertEqual(
+            'ghost-release-1-2', app.get_ref_service('ghost', 'Release_1.2'))
+
+
+class TestGetCharmPath(helpers.ErrorTestsMixin, TestCase):
+
+    def test_path(self):
+        # The path following the repository name is returned.
+        self.assertEqual(
+            'charms/mysql',
+            app.get_charm_path('github.com/frankban/charms/charms/mysql/'))
+        self.assertEqual(
+            'charms/*', app.get_charm_path('frankban/charms/charms/*:dev'))
+
+    def test_no_path(self):
+        # An empty string is returned if the charm is the repository.
+        self.assertEqual('', app.get_charm_path('hatched/ghost-charm:dev'))
+
+    def test_local_directory(self):
+        # An empty string is returned for local directories.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.assertEqual('', app.get_charm_path(path))
+
+    def test_invalid_repository(self):
+        # A ProgramExit is raised if the Github repository is not valid.
+        expected = 'juju-git-deploy: error: invalid repository: bad:wolf:42'
+        with self.assert_error(app.ProgramExit, expected):
+            app.get_charm_path('bad:wolf:42')
+
+
+class TestGetCommit(helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
+
+    zip_url = 'https://api.github.com/repos/hatched/ghost-charm/zipball/'
+
+    def test_commit(self):
+        # The commit SHA is retrieved from the Github API.
+        with helpers.patch_urlopen(contents=b'abc123') as mock_urlopen:
+            commit = app.get_commit(self.zip_url + 'develop')
+        self.assertEqual('abc123', commit)
+        request = mock_urlopen.call_args[0][0]
+        self.assertEqual(
+            'https://api.github.com/repos/hatched/ghost-charm/commits/develop',
+            request.full_url)
+        self.assertEqual(
+            'application/vnd.github.v3.sha', request.get_header('Accept'))
+
+    def test_default_branch(self):
+        # The HEAD commit is retrieved if no reference is specified.
+        with helpers.patch_urlopen(contents=b'abc123') as mock_urlopen:
+            app.get_commit(self.zip_url)
+        request = mock_urlopen.call_args[0][0]
+        self.assertTrue(request.full_url.endswith('/commits/HEAD'))
+
+    def test_error(self):
+        # A ProgramExit is raised if the commit cannot be retrieved.
+        expected = (
+            'juju-git-deploy: error: '
+            'unable to retrieve the repository commit: bad wolf')
+        with helpers.patch_urlopen(error='bad wolf'):
+            with self.assert_error(app.ProgramExit, expected):
+                app.get_commit(self.zip_url)
+
+
+class TestProvenance(helpers.ErrorTestsMixin, TestCase):
+
+    zip_url = 'https://api.github.com/repos/hatched/ghost-charm/zipball/dev'
+    provenance = app.Provenance('hatched/ghost-charm', 'dev', 'abc')
+
+    def test_get_provenance(self):
+        # The provenance includes the repository, reference and commit.
+        session = mock.Mock()
+        session.get_commit.return_value = 'abc'
+        provenance = app.get_provenance(self.zip_url, session=session)
+        self.assertEqual(self.provenance, provenance)
+        session.get_commit.assert_called_once_with(self.zip_url, output=None)
+
+    def test_local_provenance(self):
+        # The provenance of local charms is unknown.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.assertEqual(
+            app.Provenance(None, None, None), app.get_provenance(path))
+
+    def test_add_provenance(self):
+        # The provenance is added to the service annotations.
+        setup = app.ServiceSetup(expose=True, annotations={'key': 'value'})
+        setup = app.add_provenance(setup, self.provenance)
+        self.assertTrue(setup.expose)
+        self.assertEqual({
+            'key': 'value',
+            'juju-git-deploy-repo': 'hatched/ghost-charm',
+            'juju-git-deploy-ref': 'dev',
+            'juju-git-deploy-commit': 'abc',
+        }, setup.annotations)
+
+    def test_add_local_provenance(self):
+        # Nothing is recorded for local charms.
+        setup = app.add_provenance(None, app.Provenance(None, None, None))
+        self.assertEqual(app.ServiceSetup(), setup)
+
+    def call_get_deployed(self, services, annotations):
+        """Call get_deployed with services annotated as given."""
+        session = mock.MagicMock()
+        with mock.patch(
+                'jujugd.api.get_annotations',
+                return_value=annotations) as mock_get_annotations:
+            deployed = app.get_deployed(
+                services, self.provenance, '10.0.3.1:17070', 'secret!',
+                session=session)
+        return deployed, mock_get_annotations
+
+    def test_get_deployed(self):
+        # The annotations of all the services are retrieved at once.
+        deployed, mock_get_annotations = self.call_get_deployed(
+            ['blog', 'proxy'], [{'key': 'value'}, {}])
+        self.assertEqual([{'key': 'value'}, {}], deployed)
+        mock_get_annotations.assert_called_once_with(
+            mock.ANY, ['service-blog', 'service-proxy'])
+
+    def test_get_deployed_unknown_service(self):
+        # The API is not queried if the service name is not known.
+        deployed, mock_get_annotations = self.call_get_deployed([None], [])
+        self.assertIsNone(deployed)
+        self.assertFalse(mock_get_annotations.called)
+
+    def test_get_deployed_error(self):
+        # A ProgramExit is raised if the annotations cannot be retrieved.
+        session = mock.MagicMock()
+        expected = 'juju-git-deploy: error: API failure: bad wolf'
+        with mock.patch(
+                'jujugd.api.get_annotations',
+                side_effect=api.JujuError('bad wolf')):
+            with self.assert_error(app.ProgramExit, expected):
+                app.get_deployed(
+                    ['blog'], self.provenance, '10.0.3.1:17070', 'secret!',
+                    session=session)
+
+    def test_current(self):
+        # The services run the given commit.
+        annotations = {
+            'juju-git-deploy-repo': 'hatched/ghost-charm',
+            'juju-git-deploy-commit': 'abc',
+        }
+        self.assertTrue(
+            app.is_current([annotations, annotations], self.provenance))
+
+    def test_not_current(self):
+        # Services not found or running other commits are not current.
+        annotations = {
+            'juju-git-deploy-repo': 'hatched/ghost-charm',
+            'juju-git-deploy-commit': 'def',
+        }
+        for deployed in ([annotations], [{}], None):
+            self.assertFalse(app.is_current(deployed, self.provenance))
+
+    def test_unchanged(self):
+        # Services deployed with the same charm files are unchanged.
+        annotations = {
+            'juju-git-deploy-repo': 'hatched/ghost-charm',
+            'juju-git-deploy-commit': 'def',
+            'juju-git-deploy-tree': 'hash',
+        }
+        self.assertTrue(
+            app.is_unchanged([annotations], self.provenance, 'hash'))
+        self.assertFalse(
+            app.is_unchanged([annotations], self.provenance, 'other'))
+        self.assertFalse(
+            app.is_unchanged([annotations], self.provenance, None))
+        self.assertFalse(app.is_unchanged(None, self.provenance, 'hash'))
+
+    def test_record_provenance(self):
+        # The provenance and tree hash are set on all the services.
+        session = mock.MagicMock()
+        with mock.patch('jujugd.api.set_annotations') as mock_set_annotations:
+            app.record_provenance(
+                ['blog', 'proxy'], self.provenance, 'hash', '10.0.3.1:17070',
+                'secret!', session=session)
+        mock_set_annotations.assert_called_once_with(
+            mock.ANY, ['service-blog', 'service-proxy'], {
+                'juju-git-deploy-repo': 'hatched/ghost-charm',
+                'juju-git-deploy-ref': 'dev',
+                'juju-git-deploy-commit': 'abc',
+                'juju-git-deploy-tree': 'hash',
+            })
+
+    def test_get_tree(self):
+        # The hash of the charm files is returned, or None if the contents
+        # are not a valid zip archive.
+        with mock.patch(
+                'jujugd.archive.get_tree_hash', return_value='hash'):
+            self.assertEqual('hash', app.get_tree(b'zip'))
+        self.assertIsNone(app.get_tree(b'bad wolf'))
+
+    def test_get_tree_transforms(self):
+        # The hash changes with the transform versions.
+        transforms = [transform.Transform('build:wheels', '1', '*')]
+        with mock.patch(
+                'jujugd.archive.get_tree_hash', return_value='hash'):
+            trees = {
+                app.get_tree(b'zip'),
+                app.get_tree(b'zip', transforms),
+                app.get_tree(b'zip', [transforms[0]._replace(version='2')]),
+            }
+        self.assertEqual(3, len(trees))
+
+    def test_service_names(self):
+        # The series is appended to the service names for multiple series.
+        self.assertEqual(['blog'], app.get_service_names('blog', ['trusty']))
+        self.assertEqual(
+            ['blog-trusty', 'blog-xenial'],
+            app.get_service_names('blog', ['trusty', 'xenial']))
+        self.assertEqual(
+            [None, None], app.get_service_names(None, ['trusty', 'xenial']))
+
+
+class TestPrepare(helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
 
     @contextmanager
     def patch_all(self, series='trusty'):
@@ -76,6 +374,17 @@ class TestPrepare(helpers.ErrorTestsMixin, TestCase):
         self.assertEqual('secret!', password)
         self.assertEqual('saucy', series)
 
+    def test_local_directory(self):
+        # The absolute path of the charm is returned if the repository is a
+        # local directory.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with self.patch_all():
+            zip_url, api_address, password, series = app.prepare(
+                os.path.relpath(path), 'ec2', None)
+        self.assertEqual(path, zip_url)
+        self.assertEqual('10.0.3.1:17070', api_address)
+
     def test_invalid_repository(self):
         # A ProgramExit is raised if the Github repository is not valid.
         expected = 'juju-git-deploy: error: invalid repository: invalid-repo'
@@ -85,38 +394,124 @@ class TestPrepare(helpers.ErrorTestsMixin, TestCase):
 
 
 @helpers.mock_print
-class TestProcess(helpers.ErrorTestsMixin, TestCase):
+class TestFetch(helpers.ConfigMixin, helpers.CacheDirMixin, TestCase):
+
+    zip_url = 'https://api.github.com/repos/hatched/ghost-charm/zipball/dev'
+
+    def test_commit_archive(self, mock_print):
+        # The archive for the current commit is retrieved.
+        with mock.patch('jujugd.app.get_commit', return_value='abc'):
+            with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+                contents = app.fetch(self.zip_url)
+        self.assertEqual(b'zip', contents)
+        mock_urlopen.assert_called_once_with(
+            'https://api.github.com/repos/hatched/ghost-charm/zipball/abc')
+
+    def test_cached(self, mock_print):
+        # Archives are retrieved only once for each commit.
+        with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+            app.fetch(self.zip_url, commit='abc')
+            contents = app.fetch(self.zip_url, commit='abc')
+            app.fetch(self.zip_url, commit='def')
+        self.assertEqual(b'zip', contents)
+        self.assertEqual(2, mock_urlopen.call_count)
+
+
+@helpers.mock_print
+class TestProcess(
+        helpers.ConfigMixin, helpers.CacheDirMixin,
+        helpers.ErrorTestsMixin, TestCase):
 
     api_address = '10.0.3.1:17070'
     password = 'secret!'
-    zip_url = 'api.example.com/django'
+    zip_url = 'https://api.github.com/repos/hatched/django/zipball/'
+
+    def setUp(self):
+        super().setUp()
+        patch_get_commit = mock.patch(
+            'jujugd.app.get_commit', return_value='abc')
+        patch_get_commit.start()
+        self.addCleanup(patch_get_commit.stop)
 
     def patch_upload_charm(self, error=False):
-        side_effect = IOError('bad wolf') if error else 'local:trusty/django-1'
-        return mock.patch('jujugd.api.upload_charm', side_effect=[side_effect])
+        """Patch the charm upload, storing the uploaded length and contents.
+
+        The stream is closed once uploaded: read it while uploading.
+        """
+        self.uploaded = []
+
+        def upload_charm(api_address, stream, password, series):
+            if error:
+                raise IOError('bad wolf')
+            self.uploaded.append((stream.length, stream.read()))
+            return 'local:trusty/django-1'
+        return mock.patch('jujugd.api.upload_charm', side_effect=upload_charm)
 
     def test_charm_url(self, mock_print):
         # The function return the newly uploaded local charm URL.
-        with helpers.patch_urlopen(contents='zip contents') as mock_urlopen:
+        with helpers.patch_urlopen(contents=b'zip contents') as mock_urlopen:
             with self.patch_upload_charm(error=False) as mock_upload_charm:
                 charm_url = app.process(
                     self.zip_url, self.api_address, self.password, 'trusty')
         self.assertEqual('local:trusty/django-1', charm_url)
-        mock_urlopen.assert_called_once_with(self.zip_url)
+        mock_urlopen.assert_called_once_with(self.zip_url + 'abc')
         mock_upload_charm.assert_called_once_with(
-            self.api_address, mock_urlopen(), self.password, 'trusty')
+            self.api_address, mock.ANY, self.password, 'trusty')
+        self.assertEqual([(12, b'zip contents')], self.uploaded)
         self.assertEqual(2, mock_print.call_count)
         mock_print.assert_has_calls([
             mock.call('connecting to github'),
             mock.call('uploading charm'),
         ])
 
+    def test_transforms(self, mock_print):
+        # The configured transforms are applied before the upload.
+        with open(settings.CONFIG_PATH, 'w') as stream:
+            stream.write('transforms:\n  - {function: "build:wheels"}\n')
+        with helpers.patch_urlopen(contents=b'zip contents'):
+            with self.patch_upload_charm(error=False):
+                with mock.patch(
+                        'jujugd.transform.apply',
+                        return_value=b'transformed') as mock_apply:
+                    app.process(
+                        self.zip_url, self.api_address, self.password,
+                        'trusty')
+        mock_apply.assert_called_once_with(b'zip contents', [
+            transform.Transform('build:wheels', '', '*')])
+        self.assertEqual([(11, b'transformed')], self.uploaded)
+
+    def test_transform_error(self, mock_print):
+        # A ProgramExit is raised if the charm cannot be transformed.
+        with open(settings.CONFIG_PATH, 'w') as stream:
+            stream.write('transforms:\n  - {function: "build:wheels"}\n')
+        expected = (
+            'juju-git-deploy: error: unable to transform charm: bad wolf')
+        with helpers.patch_urlopen(contents=b'zip contents'):
+            with mock.patch(
+                    'jujugd.transform.apply',
+                    side_effect=ValueError('bad wolf')):
+                with self.assert_error(app.ProgramExit, expected):
+                    app.process(
+                        self.zip_url, self.api_address, self.password,
+                        'trusty')
+
+    def test_stats(self, mock_print):
+        # The number of uploaded bytes is stored in the given stats.
+        stats = {}
+        with helpers.patch_urlopen(contents=b'zip contents'):
+            with self.patch_upload_charm():
+                app.process(
+                    self.zip_url, self.api_address, self.password, 'trusty',
+                    stats=stats)
+        self.assertEqual({'bytes': 12}, stats)
+
     def test_charm_retrieval_error(self, mock_print):
         # A ProgramExit is raised if a problem occurs fetching the charm.
         expected_error = (
             'juju-git-deploy: error: '
             'unable to retrieve charm contents: '
-            'invalid response from api.example.com/django (400): '
+            'invalid response from '
+            'https://api.github.com/repos/hatched/django/zipball/abc (400): '
             'bad request'
         )
         with helpers.patch_urlopen(status=400, reason='bad request'):
@@ -128,9 +523,657 @@ class TestProcess(helpers.ErrorTestsMixin, TestCase):
         # A ProgramExit is raised if a problem occurs uploading the charm.
         expected_error = (
             'juju-git-deploy: error: charm upload failed: bad wolf')
-        with helpers.patch_urlopen(contents='zip contents'):
+        with helpers.patch_urlopen(contents=b'zip contents'):
             with self.patch_upload_charm(error=True):
                 with self.assert_error(app.ProgramExit, expected_error):
                     app.process(
                         self.zip_url, self.api_address, self.password,
                         'trusty')
+
+    def test_local_directory(self, mock_print):
+        # The charm archive is built if a local directory is provided.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with open(os.path.join(path, 'metadata.yaml'), 'w') as stream:
+            stream.write('name: django\n')
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with mock.patch('jujugd.settings.CACHE_DIR', cache_dir):
+            with self.patch_upload_charm():
+                charm_url = app.process(
+                    path, self.api_address, self.password, 'trusty')
+        self.assertEqual('local:trusty/django-1', charm_url)
+        [(length, contents)] = self.uploaded
+        self.assertEqual(len(contents), length)
+        mock_print.assert_has_calls([
+            mock.call('building charm archive'),
+            mock.call('uploading charm'),
+        ])
+
+    def test_local_directory_error(self, mock_print):
+        # A ProgramExit is raised if the local directory is not a charm.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        expected_error = (
+            'juju-git-deploy: error: unable to build charm archive: '
+            'not a charm directory: {}'.format(path))
+        with self.assert_error(app.ProgramExit, expected_error):
+            app.process(path, self.api_address, self.password, 'trusty')
+
+
+@helpers.mock_print
+class TestFanOut(
+        helpers.ConfigMixin, helpers.CacheDirMixin,
+        helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch_get_commit = mock.patch(
+            'jujugd.app.get_commit', return_value='abc')
+        patch_get_commit.start()
+        self.addCleanup(patch_get_commit.stop)
+        # Deployed services are annotated with the charm provenance.
+        self.setup = app.ServiceSetup(annotations={
+            'juju-git-deploy-repo': 'hatched/ghost-charm',
+            'juju-git-deploy-ref': '',
+            'juju-git-deploy-commit': 'abc',
+        })
+
+    def patch_discover(self, error_env=None):
+        """Patch the environment discovery.
+
+        If error_env is provided, the discovery fails for that environment.
+        """
+        def discover(env_name, series):
+            if env_name == error_env:
+                raise app.ProgramExit('bad wolf')
+            return '{}.example.com:17070'.format(env_name), 'secret!', 'trusty'
+        return mock.patch('jujugd.app.discover', side_effect=discover)
+
+    def call_fan_out(self, env_names, series_list=(None,)):
+        """Call the fan out function deploying to the given environments."""
+        series_list = list(series_list)
+        return app.fan_out(
+            'hatched/ghost-charm', env_names, series_list, None, 1, None, 2)
+
+    def test_charm_retrieved_once(self, mock_print):
+        # The charm is retrieved once and deployed to all the environments.
+        with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+            with self.patch_discover():
+                with mock.patch(
+                        'jujugd.api.upload_charm',
+                        return_value='local:trusty/ghost-1') as mock_upload:
+                    with mock.patch(
+                            'jujugd.app._deploy',
+                            return_value=['ghost']) as mock_deploy:
+                        results = self.call_fan_out(['staging', 'qa'])
+        self.assertEqual({'staging': ['ghost'], 'qa': ['ghost']}, results)
+        self.assertEqual(1, mock_urlopen.call_count)
+        self.assertEqual(2, mock_upload.call_count)
+        addresses = sorted(i[0][0] for i in mock_upload.call_args_list)
+        self.assertEqual(
+            ['qa.example.com:17070', 'staging.example.com:17070'], addresses)
+        for call in mock_upload.call_args_list:
+            self.assertEqual(b'zip', call[0][1].read())
+        self.assertEqual(2, mock_deploy.call_count)
+
+    def test_errors(self, mock_print):
+        # Failures are collected for each environment.
+        expected_error = (
+            'juju-git-deploy: error: '
+            'deployment failed in 1 of 2 environments:\n'
+            'qa: bad wolf')
+        with helpers.patch_urlopen(contents=b'zip'):
+            with self.patch_discover(error_env='qa'):
+                with mock.patch(
+                        'jujugd.api.upload_charm',
+                        return_value='local:trusty/ghost-1'):
+                    with mock.patch(
+                            'jujugd.app._deploy',
+                            return_value=['ghost']) as mock_deploy:
+                        with self.assert_error(
+                                app.ProgramExit, expected_error):
+                            self.call_fan_out(['staging', 'qa'])
+        # The deployment to the other environment succeeded.
+        mock_deploy.assert_called_once_with(
+            ['local:trusty/ghost-1'], [None], 1, None,
+            'staging.example.com:17070', 'secret!', session=mock.ANY,
+            setup=self.setup)
+
+    def test_metrics(self, mock_print):
+        # The duration of each phase is recorded for each environment.
+        recorder = metrics.Recorder('hatched/ghost-charm')
+        with helpers.patch_urlopen(contents=b'zip'):
+            with self.patch_discover():
+                with mock.patch(
+                        'jujugd.api.upload_charm',
+                        return_value='local:trusty/ghost-1'):
+                    with mock.patch(
+                            'jujugd.app._deploy', return_value=['ghost']):
+                        app.fan_out(
+                            'hatched/ghost-charm', ['qa'], [None, 'precise'],
+                            None, 1, None, 2, recorder=recorder)
+        samples = [(i[0], i[1], i[4]) for i in recorder.samples]
+        self.assertEqual([
+            ('prepare', 'qa', 0), ('process', 'qa', 6), ('deploy', 'qa', 0),
+        ], samples)
+
+    def test_multiple_series(self, mock_print):
+        # The charm is uploaded and deployed for each series.
+        charm_urls = ['local:trusty/ghost-1', 'local:precise/ghost-1']
+        with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+            with self.patch_discover():
+                with mock.patch(
+                        'jujugd.api.upload_charm',
+                        side_effect=charm_urls) as mock_upload:
+                    with mock.patch(
+                            'jujugd.app._deploy',
+                            return_value=['a', 'b']) as mock_deploy:
+                        results = self.call_fan_out(
+                            ['qa'], series_list=[None, 'precise'])
+        self.assertEqual({'qa': ['a', 'b']}, results)
+        self.assertEqual(1, mock_urlopen.call_count)
+        series = sorted(i[0][3] for i in mock_upload.call_args_list)
+        self.assertEqual(['precise', 'trusty'], series)
+        mock_deploy.assert_called_once_with(
+            mock.ANY, mock.ANY, 1, None, 'qa.example.com:17070', 'secret!',
+            session=mock.ANY, setup=self.setup)
+
+    def test_current(self, mock_print):
+        # Environments already running the commit are skipped, and the charm
+        # is not retrieved at all if all the environments are skipped.
+        annotations = self.setup.annotations
+
+        def get_annotations(connection, tags):
+            return [annotations for _ in tags]
+        with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+            with self.patch_discover():
+                with mock.patch('jujugd.app.Session.connect'):
+                    with mock.patch(
+                            'jujugd.api.get_annotations',
+                            side_effect=get_annotations) as mock_annotations:
+                        results = app.fan_out(
+                            'hatched/ghost-charm', ['staging', 'qa'],
+                            [None, 'precise'], 'blog', 1, None, 2)
+        self.assertEqual({
+            'staging': ['blog-trusty', 'blog-precise'],
+            'qa': ['blog-trusty', 'blog-precise'],
+        }, results)
+        self.assertFalse(mock_urlopen.called)
+        mock_annotations.assert_called_with(
+            mock.ANY, ['service-blog-trusty', 'service-blog-precise'])
+        mock_print.assert_any_call(
+            'qa: blog-trusty, blog-precise already at abc')
+
+    def test_unchanged(self, mock_print):
+        # Environments running the same charm files at another commit are
+        # skipped, and the new commit is recorded.
+        annotations = dict(self.setup.annotations, **{
+            'juju-git-deploy-commit': 'old', 'juju-git-deploy-tree': 'hash'})
+        mock_api = mock.patch.multiple(
+            'jujugd.api', get_annotations=mock.DEFAULT,
+            set_annotations=mock.DEFAULT, upload_charm=mock.DEFAULT)
+        with helpers.patch_urlopen(contents=b'zip'):
+            with self.patch_discover():
+                with mock.patch('jujugd.app.Session.connect'):
+                    with mock.patch(
+                            'jujugd.app.get_tree', return_value='hash'):
+                        with mock_api as mocks:
+                            mocks['get_annotations'].return_value = [
+                                annotations]
+                            with mock.patch(
+                                    'jujugd.app.apply_transforms') as mock_tr:
+                                results = app.fan_out(
+                                    'hatched/ghost-charm', ['qa'], [None],
+                                    'blog', 1, None, 2)
+        self.assertEqual({'qa': ['blog']}, results)
+        self.assertFalse(mocks['upload_charm'].called)
+        # The charm is not transformed.
+        self.assertFalse(mock_tr.called)
+        mocks['set_annotations'].assert_called_once_with(
+            mock.ANY, ['service-blog'],
+            dict(self.setup.annotations, **{'juju-git-deploy-tree': 'hash'}))
+        mock_print.assert_any_call('qa: blog unchanged at abc')
+
+    def test_jobs_shared(self, mock_print):
+        # The number of parallel uploads is limited across environments.
+        lock = threading.Lock()
+        running, peaks = [0], []
+
+        def upload_charm(api_address, stream, password, series, pool):
+            with lock:
+                running[0] += 1
+                peaks.append(running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return 'local:{}/ghost-1'.format(series)
+        with helpers.patch_urlopen(contents=b'zip'):
+            with self.patch_discover():
+                with mock.patch(
+                        'jujugd.api.upload_charm', side_effect=upload_charm):
+                    with mock.patch(
+                            'jujugd.app._deploy', return_value=['a', 'b']):
+                        self.call_fan_out(
+                            ['staging', 'qa'],
+                            series_list=[None, 'precise', 'xenial'])
+        self.assertEqual(6, len(peaks))
+        self.assertLessEqual(max(peaks), 2)
+
+    def test_superseded(self, mock_print):
+        # Nothing is deployed if a newer commit has been requested while
+        # waiting for the service lease.
+        with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+            with self.patch_discover():
+                with mock.patch(
+                        'jujugd.leases.acquire',
+                        side_effect=leases.Superseded('def')):
+                    results = self.call_fan_out(['qa'])
+        self.assertEqual({'qa': []}, results)
+        self.assertFalse(mock_urlopen.called)
+        mock_print.assert_any_call('qa: deployment superseded by def')
+
+    def test_deployed_concurrently(self, mock_print):
+        # The result of a deployment of the same commit completed while
+        # waiting for the service lease is reused.
+        lease = leases.acquire('qa', 'hatched/ghost-charm', 'abc')
+        lease.record('abc', ['ghost'])
+        with mock.patch('jujugd.leases.acquire', return_value=lease):
+            with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+                with self.patch_discover():
+                    results = self.call_fan_out(['qa'])
+        self.assertEqual({'qa': ['ghost']}, results)
+        self.assertFalse(mock_urlopen.called)
+        mock_print.assert_any_call('qa: ghost deployed concurrently at abc')
+
+    def test_lease_recorded(self, mock_print):
+        # The deployed services are recorded in the service lease.
+        with helpers.patch_urlopen(contents=b'zip'):
+            with self.patch_discover():
+                with mock.patch(
+                        'jujugd.api.upload_charm',
+                        return_value='local:trusty/ghost-1'):
+                    with mock.patch(
+                            'jujugd.app._deploy', return_value=['ghost']):
+                        self.call_fan_out(['qa'])
+        with leases.acquire('qa', 'hatched/ghost-charm', 'abc') as lease:
+            with open(os.path.join(lease.directory, 'result.json')) as stream:
+                result = json.load(stream)
+        self.assertEqual('abc', result['commit'])
+        self.assertEqual(['ghost'], result['services'])
+
+
+def make_repo_zip(names):
+    """Return the zip contents of a Github archive including the charms."""
+    members = [
+        archive.compress('charms-abc/charms/{}/metadata.yaml'.format(name),
+                         'name: {}\n'.format(name).encode('utf-8'))
+        for name in names]
+    stream = io.BytesIO()
+    archive.write_zip(stream, members)
+    return stream.getvalue()
+
+
+@helpers.mock_print
+class TestDeployCharms(
+        helpers.ConfigMixin, helpers.CacheDirMixin,
+        helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch_get_commit = mock.patch(
+            'jujugd.app.get_commit', return_value='abc')
+        patch_get_commit.start()
+        self.addCleanup(patch_get_commit.stop)
+        self.contents = make_repo_zip(['ghost', 'mysql'])
+
+    def patch_discover(self):
+        """Patch the environment discovery."""
+        def discover(env_name, series):
+            return '{}.example.com:17070'.format(env_name), 'secret!', 'trusty'
+        return mock.patch('jujugd.app.discover', side_effect=discover)
+
+    def call_deploy_charms(self, repo, service=None, deployed=None):
+        """Deploy the charms in the given repo to the staging and qa envs.
+
+        Services are deployed with the given annotations, if provided.
+        Return the results and the mocks used to upload and deploy.
+        """
+        def upload_charm(api_address, stream, password, series, pool):
+            name = yaml.safe_load(zipfile.ZipFile(stream).read(
+                'metadata.yaml'))['name']
+            return 'local:{}/{}-1'.format(series, name)
+
+        def deploy_services(connection, charm_urls, services, *args, **kw):
+            return services
+
+        def get_annotations(connection, tags):
+            return [(deployed or {}).get(tag, {}) for tag in tags]
+        mock_api = mock.patch.multiple(
+            'jujugd.api', get_annotations=mock.DEFAULT,
+            upload_charm=mock.DEFAULT)
+        with helpers.patch_urlopen(contents=self.contents):
+            with self.patch_discover():
+                with mock.patch('jujugd.app.Session.connect'):
+                    with mock.patch(
+                            'jujugd.app.deploy_services',
+                            side_effect=deploy_services) as mock_deploy:
+                        with mock_api as mocks:
+                            mocks['upload_charm'].side_effect = upload_charm
+                            mocks['get_annotations'].side_effect = (
+                                get_annotations)
+                            results = app.deploy_charms(
+                                repo, ['staging', 'qa'], [None], service, 1,
+                                None, 2)
+        return results, mocks['upload_charm'], mock_deploy
+
+    def test_charms(self, mock_print):
+        # All the selected charms are uploaded and deployed in each env.
+        results, mock_upload, mock_deploy = self.call_deploy_charms(
+            'frankban/charms/charms/*')
+        self.assertEqual({
+            'staging': ['ghost', 'mysql'], 'qa': ['ghost', 'mysql'],
+        }, results)
+        charm_urls = sorted(i[0][1] for i in mock_deploy.call_args_list)
+        self.assertEqual([
+            ['local:trusty/ghost-1'], ['local:trusty/ghost-1'],
+            ['local:trusty/mysql-1'], ['local:trusty/mysql-1'],
+        ], charm_urls)
+        self.assertEqual(4, mock_upload.call_count)
+        # Each service records the path of its charm.
+        setups = [i[1]['setup'] for i in mock_deploy.call_args_list]
+        self.assertEqual(
+            {'frankban/charms/charms/ghost', 'frankban/charms/charms/mysql'},
+            {i.annotations['juju-git-deploy-repo'] for i in setups})
+
+    def test_service_name(self, mock_print):
+        # The service name is used if a single charm is selected.
+        results, _, _ = self.call_deploy_charms(
+            'frankban/charms/charms/mysql', service='db')
+        self.assertEqual({'staging': ['db'], 'qa': ['db']}, results)
+
+    def test_service_name_multiple_charms(self, mock_print):
+        # A ProgramExit is raised if a service name is provided for multiple
+        # charms.
+        expected = (
+            'juju-git-deploy: error: cannot use a service name with 2 charms')
+        with self.assert_error(app.ProgramExit, expected):
+            self.call_deploy_charms('frankban/charms/charms/*', service='db')
+
+    def test_current(self, mock_print):
+        # Charms whose services already run the commit are not uploaded.
+        deployed = {'service-ghost': {
+            'juju-git-deploy-repo': 'frankban/charms/charms/ghost',
+            'juju-git-deploy-commit': 'abc',
+        }}
+        results, mock_upload, _ = self.call_deploy_charms(
+            'frankban/charms/charms/*', deployed=deployed)
+        self.assertEqual({
+            'staging': ['ghost', 'mysql'], 'qa': ['ghost', 'mysql'],
+        }, results)
+        self.assertEqual(2, mock_upload.call_count)
+        mock_print.assert_any_call('qa: ghost already at abc')
+
+    def test_not_found(self, mock_print):
+        # A ProgramExit is raised if no charms match the path.
+        expected = 'juju-git-deploy: error: no charms found in charms/no-such'
+        with self.assert_error(app.ProgramExit, expected):
+            self.call_deploy_charms('frankban/charms/charms/no-such')
+
+
+@helpers.mock_print
+class TestDeployRefs(
+        helpers.ConfigMixin, helpers.CacheDirMixin,
+        helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch_get_commit = mock.patch(
+            'jujugd.app.get_commit',
+            side_effect=lambda zip_url, output=None: (
+                zip_url.rsplit('/', 1)[1] + '-sha'))
+        patch_get_commit.start()
+        self.addCleanup(patch_get_commit.stop)
+
+    def call_deploy_refs(self, service=None, deployed=None):
+        """Deploy the master and develop refs to the staging and qa envs.
+
+        Services are deployed with the given annotations, if provided.
+        Return the results and the mocks used to download, upload and deploy.
+        """
+        def upload_charm(api_address, stream, password, series, pool):
+            return 'local:{}/ghost-1'.format(series)
+
+        def get_annotations(connection, tags):
+            return [(deployed or {}).get(tag, {}) for tag in tags]
+        mock_api = mock.patch.multiple(
+            'jujugd.api', get_annotations=mock.DEFAULT,
+            upload_charm=mock.DEFAULT)
+        discover = mock.patch(
+            'jujugd.app.discover',
+            return_value=('10.0.3.1:17070', 'secret!', 'trusty'))
+        with helpers.patch_urlopen(contents=b'zip') as mock_urlopen:
+            with discover:
+                with mock.patch('jujugd.app.Session.connect'):
+                    with mock.patch(
+                            'jujugd.app.deploy_services') as mock_deploy:
+                        with mock_api as mocks:
+                            mocks['upload_charm'].side_effect = upload_charm
+                            mocks['get_annotations'].side_effect = (
+                                get_annotations)
+                            results = app.deploy_refs(
+                                'hatched/ghost-charm:master,develop',
+                                ['staging', 'qa'], [None], service, 1, None,
+                                2)
+        return results, mock_urlopen, mocks['upload_charm'], mock_deploy
+
+    def test_refs(self, mock_print):
+        # A service is deployed for each reference.
+        results, mock_urlopen, mock_upload, mock_deploy = (
+            self.call_deploy_refs())
+        services = ['ghost-master', 'ghost-develop']
+        self.assertEqual({'staging': services, 'qa': services}, results)
+        # Archives are downloaded once for all the environments.
+        self.assertEqual(2, mock_urlopen.call_count)
+        self.assertEqual(4, mock_upload.call_count)
+        names = [i[0][2] for i in mock_deploy.call_args_list]
+        self.assertEqual([['ghost-master'], ['ghost-develop']] * 2, names)
+        setup = mock_deploy.call_args[1]['setup']
+        self.assertEqual(
+            'develop-sha', setup.annotations['juju-git-deploy-commit'])
+        mock_print.assert_any_call('master at master-sha')
+
+    def test_same_files(self, mock_print):
+        # References with the same charm files are uploaded only once.
+        with mock.patch('jujugd.app.get_tree', return_value='hash'):
+            results, _, mock_upload, mock_deploy = self.call_deploy_refs(
+                service='blog')
+        self.assertEqual(2, mock_upload.call_count)
+        self.assertEqual(4, mock_deploy.call_count)
+        self.assertEqual(
+            ['blog-master', 'blog-develop'], results['qa'])
+
+    def test_current(self, mock_print):
+        # References already deployed at their commit are skipped.
+        deployed = {'service-blog-master': {
+            'juju-git-deploy-repo': 'hatched/ghost-charm',
+            'juju-git-deploy-commit': 'master-sha',
+        }}
+        results, mock_urlopen, mock_upload, mock_deploy = (
+            self.call_deploy_refs(service='blog', deployed=deployed))
+        self.assertEqual(['blog-master', 'blog-develop'], results['qa'])
+        self.assertEqual(1, mock_urlopen.call_count)
+        self.assertEqual(2, mock_upload.call_count)
+        names = [i[0][2] for i in mock_deploy.call_args_list]
+        self.assertEqual([['blog-develop']] * 2, names)
+        mock_print.assert_any_call('qa: blog-master already at master-sha')
+
+
+class TestUploadSeries(helpers.ErrorTestsMixin, TestCase):
+
+    def test_charm_urls(self):
+        # The charm is uploaded for each series, reusing connections.
+        with mock.patch(
+                'jujugd.api.upload_charm',
+                side_effect=lambda address, stream, password, series, pool:
+                'local:{}/ghost-1'.format(series)) as mock_upload:
+            charm_urls = app.upload_series(
+                b'zip', '10.0.3.1:17070', 'secret!', ['trusty', 'precise'], 2)
+        self.assertEqual(
+            ['local:trusty/ghost-1', 'local:precise/ghost-1'], charm_urls)
+        pools = set(i[1]['pool'] for i in mock_upload.call_args_list)
+        self.assertEqual(1, len(pools))
+
+    def test_upload_error(self):
+        # A ProgramExit is raised if any of the uploads fails.
+        expected_error = (
+            'juju-git-deploy: error: charm upload failed: bad wolf')
+        with mock.patch(
+                'jujugd.api.upload_charm', side_effect=IOError('bad wolf')):
+            with self.assert_error(app.ProgramExit, expected_error):
+                app.upload_series(
+                    b'zip', '10.0.3.1:17070', 'secret!', ['trusty'], 2)
+
+
+class TestGetPlacements(TestCase):
+
+    def test_unplaced(self):
+        # All units are unplaced if no machines are provided.
+        self.assertEqual([None, None], app.get_placements(2, None))
+
+    def test_spread(self):
+        # Units are spread across the given machines.
+        placements = app.get_placements(5, ['1', 'lxc:2'])
+        self.assertEqual(['1', 'lxc:2', '1', 'lxc:2', '1'], placements)
+
+
+@mock.patch('jujugd.api.setup_service')
+@mock.patch('jujugd.api.deploy', return_value='django')
+@mock.patch('jujugd.api.login')
+@mock.patch('jujugd.api.connect')
+class TestInternalDeploy(TestCase):
+
+    def call_deploy(self, num_units, machines=None, setup=None):
+        """Deploy a charm with the given units and placement."""
+        return app._deploy(
+            ['local:trusty/django-1'], [None], num_units, machines,
+            '10.0.3.1:17070', 'secret!', setup=setup)
+
+    def test_single_unit(self, mock_connect, mock_login, mock_deploy,
+                         mock_setup_service):
+        # A single unit is created together with the service.
+        services = self.call_deploy(1)
+        self.assertEqual(['django'], services)
+        mock_deploy.assert_called_once_with(
+            mock_connect().__enter__(), 'local:trusty/django-1', service=None,
+            num_units=1, machine=None, config=None, config_yaml=None,
+            constraints=None)
+        mock_setup_service.assert_called_once_with(
+            mock_connect().__enter__(), 'django', [], expose=False,
+            relations=(), annotations=None)
+
+    def test_unplaced_units(self, mock_connect, mock_login, mock_deploy,
+                            mock_setup_service):
+        # Units exceeding the chunk size are added in batches.
+        with mock.patch('jujugd.api.UNITS_CHUNK_SIZE', 3):
+            self.call_deploy(5)
+        self.assertEqual(3, mock_deploy.call_args[1]['num_units'])
+        mock_setup_service.assert_called_once_with(
+            mock_connect().__enter__(), 'django', [None, None], expose=False,
+            relations=(), annotations=None)
+
+    def test_placed_units(self, mock_connect, mock_login, mock_deploy,
+                          mock_setup_service):
+        # The first unit is placed when the service is deployed, and the
+        # others are added to the remaining targets.
+        self.call_deploy(3, machines=['1', 'lxc:2'])
+        self.assertEqual({
+            'service': None, 'num_units': 1, 'machine': '1', 'config': None,
+            'config_yaml': None, 'constraints': None,
+        }, mock_deploy.call_args[1])
+        mock_setup_service.assert_called_once_with(
+            mock_connect().__enter__(), 'django', ['lxc:2', '1'],
+            expose=False, relations=(), annotations=None)
+
+    def test_setup(self, mock_connect, mock_login, mock_deploy,
+                   mock_setup_service):
+        # The service is configured, constrained, exposed and related.
+        setup = app.ServiceSetup(
+            'django: {debug: true}', {'mem': 4096}, True, ['mysql:db'])
+        self.call_deploy(2, setup=setup)
+        self.assertEqual(
+            {'debug': True}, mock_deploy.call_args[1]['config'])
+        self.assertIsNone(mock_deploy.call_args[1]['config_yaml'])
+        self.assertEqual(
+            {'mem': 4096}, mock_deploy.call_args[1]['constraints'])
+        mock_setup_service.assert_called_once_with(
+            mock_connect().__enter__(), 'django', [], expose=True,
+            relations=['mysql:db'], annotations=None)
+
+    def test_setup_suffixed_services(self, mock_connect, mock_login,
+                                     mock_deploy, mock_setup_service):
+        # Options are looked up using the requested service name when the
+        # deployed names include the series.
+        setup = app.ServiceSetup('django: {debug: true}')
+        app._deploy(
+            ['local:trusty/django-1', 'local:precise/django-1'],
+            ['django-trusty', 'django-precise'], 1, None, '10.0.3.1:17070',
+            'secret!', setup=setup)
+        self.assertEqual(2, mock_deploy.call_count)
+        for call in mock_deploy.call_args_list:
+            self.assertEqual({'debug': True}, call[1]['config'])
+            self.assertIsNone(call[1]['config_yaml'])
+
+    def test_setup_missing_options(self, mock_connect, mock_login,
+                                   mock_deploy, mock_setup_service):
+        # The YAML is sent unchanged if no options are found for the service.
+        setup = app.ServiceSetup('wordpress: {debug: true}')
+        self.call_deploy(1, setup=setup)
+        self.assertIsNone(mock_deploy.call_args[1]['config'])
+        self.assertEqual('wordpress: {debug: true}',
+                         mock_deploy.call_args[1]['config_yaml'])
+
+
+class TestGetServiceConfig(TestCase):
+
+    options = {
+        'ghost': {'port': 80},
+        'ghost-blog': {'port': 8080},
+    }
+
+    def test_exact_name(self):
+        # The options for the exact service name are returned.
+        self.assertEqual(
+            {'port': 8080}, app.get_service_config(self.options, 'ghost-blog'))
+
+    def test_suffixed_name(self):
+        # Services with a series or reference suffix use the options of the
+        # longest matching name.
+        self.assertEqual(
+            {'port': 80}, app.get_service_config(self.options, 'ghost-trusty'))
+        self.assertEqual(
+            {'port': 8080},
+            app.get_service_config(self.options, 'ghost-blog-develop'))
+
+    def test_not_found(self):
+        # None is returned if no options are found for the service.
+        self.assertIsNone(app.get_service_config(self.options, 'ghostly'))
+        self.assertIsNone(app.get_service_config(self.options, 'mysql'))
+
+
+class TestGetServices(TestCase):
+
+    def test_single_charm(self):
+        # The given service name is used for a single charm.
+        services = app.get_services(['local:trusty/ghost-1'], None)
+        self.assertEqual([None], services)
+
+    def test_multiple_charms(self):
+        # The series is appended to service names for multiple charms.
+        charm_urls = ['local:trusty/ghost-1', 'local:precise/ghost-1']
+        self.assertEqual(
+            ['ghost-trusty', 'ghost-precise'],
+            app.get_services(charm_urls, None))
+        self.assertEqual(
+            ['blog-trusty', 'blog-precise'],
+            app.get_services(charm_urls, 'blog'))
@@ -0,0 +1,331 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy charm archives management."""
+
+import io
+import os
+import shutil
+import stat
+import tempfile
+from unittest import (
+    mock,
+    TestCase,
+)
+import zipfile
+
+from . import helpers
+from .. import archive
+
+
+class TestCompress(TestCase):
+
+    def test_member(self):
+        # The contents are compressed and the member info is returned.
+        member = archive.compress(
+            'hooks/install', b'#!/bin/sh\n', 0o100755, (2014, 4, 1, 12, 0, 0))
+        self.assertEqual('hooks/install', member.name)
+        self.assertEqual(0o100755, member.mode)
+        self.assertEqual((2014, 4, 1, 12, 0, 0), member.date_time)
+        self.assertEqual(10, member.file_size)
+        self.assertEqual(archive.ZIP_DEFLATED, member.compress_type)
+
+    def test_default_date_time(self):
+        # The current time is used if date_time is not provided.
+        member = archive.compress('README', b'exterminate')
+        self.assertEqual(6, len(member.date_time))
+
+
+class TestWriteZip(TestCase):
+
+    def test_archive(self):
+        # The resulting archive is a valid zip file.
+        members = [
+            archive.compress('metadata.yaml', b'name: ghost\n'),
+            archive.compress('hooks/install', b'#!/bin/sh\n', 0o100755),
+        ]
+        stream = io.BytesIO()
+        archive.write_zip(stream, members)
+        with zipfile.ZipFile(stream) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(
+                ['metadata.yaml', 'hooks/install'], zf.namelist())
+            self.assertEqual(b'name: ghost\n', zf.read('metadata.yaml'))
+            mode = zf.getinfo('hooks/install').external_attr >> 16
+        self.assertEqual(0o100755, mode)
+
+    def test_empty(self):
+        # An archive with no members can be written.
+        stream = io.BytesIO()
+        archive.write_zip(stream, [])
+        with zipfile.ZipFile(stream) as zf:
+            self.assertEqual([], zf.namelist())
+
+
+class CharmDirMixin:
+    """Set up a temporary charm directory."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.write('metadata.yaml', 'name: ghost\n')
+        self.write('hooks/install', '#!/bin/sh\n', mode=0o755)
+        os.symlink('install', os.path.join(self.path, 'hooks', 'start'))
+        self.write('.git/HEAD', 'ref: refs/heads/master\n')
+
+    def write(self, name, contents, mode=None):
+        """Write the given contents to the named file in the charm dir."""
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as stream:
+            stream.write(contents)
+        if mode is not None:
+            os.chmod(path, mode)
+
+
+class TestGetMembers(CharmDirMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.cache = archive.MemberCache(cache_dir)
+
+    def test_members(self):
+        # The charm files are returned, excluding hidden directories.
+        members = archive.get_members(self.path)
+        names = [member.name for member in members]
+        self.assertEqual(
+            ['metadata.yaml', 'hooks/install', 'hooks/start'], names)
+
+    def test_symlinks(self):
+        # Symbolic links are stored as links.
+        members = dict(
+            (member.name, member) for member in
+            archive.get_members(self.path))
+        self.assertTrue(stat.S_ISLNK(members['hooks/start'].mode))
+        self.assertTrue(members['hooks/install'].mode & stat.S_IXUSR)
+
+    def test_cache_hit(self):
+        # Unchanged files are not compressed again.
+        archive.get_members(self.path, cache=self.cache)
+        with mock.patch('jujugd.archive.compress') as mock_compress:
+            members = archive.get_members(self.path, cache=self.cache)
+        self.assertFalse(mock_compress.called)
+        self.assertEqual(3, len(members))
+
+    def test_cache_miss(self):
+        # Only changed files are compressed again.
+        archive.get_members(self.path, cache=self.cache)
+        self.write('hooks/install', '#!/bin/sh\necho installed\n')
+        with mock.patch(
+                'jujugd.archive.compress',
+                side_effect=archive.compress) as mock_compress:
+            archive.get_members(self.path, cache=self.cache)
+        self.assertEqual(1, mock_compress.call_count)
+        self.assertEqual('hooks/install', mock_compress.call_args[0][0])
+
+    def test_not_a_charm(self):
+        # A ValueError is raised if the directory does not include a charm.
+        os.remove(os.path.join(self.path, 'metadata.yaml'))
+        expected = 'not a charm directory: {}'.format(self.path)
+        with self.assert_error(ValueError, expected):
+            archive.get_members(self.path)
+
+
+class TestBuild(CharmDirMixin, TestCase):
+
+    def test_stream(self):
+        # A stream with the zip contents and length is returned.
+        stream = archive.build(self.path)
+        length = stream.length
+        with zipfile.ZipFile(stream) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(b'#!/bin/sh\n', zf.read('hooks/install'))
+        self.assertEqual(length, len(stream.getvalue()))
+
+
+class TestExtract(helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def make_zip(self, members):
+        """Return a zip stream including the given members."""
+        stream = io.BytesIO()
+        archive.write_zip(stream, members)
+        stream.seek(0)
+        return stream
+
+    def test_files(self):
+        # Files are extracted without the top level directory, keeping their
+        # modes and symbolic links.
+        stream = self.make_zip([
+            archive.compress('a-b/hooks/install', b'#!/bin/sh\n', 0o100755),
+            archive.compress('a-b/hooks/start', b'install', 0o120777),
+        ])
+        archive.extract(stream, self.path)
+        install = os.path.join(self.path, 'hooks', 'install')
+        with open(install, 'rb') as stream:
+            self.assertEqual(b'#!/bin/sh\n', stream.read())
+        self.assertEqual(0o755, stat.S_IMODE(os.stat(install).st_mode))
+        self.assertEqual(
+            'install', os.readlink(os.path.join(self.path, 'hooks', 'start')))
+
+    def test_outside(self):
+        # A ValueError is raised if files are outside the archive root.
+        stream = self.make_zip([archive.compress('../evil', b'')])
+        with self.assert_error(ValueError, 'invalid file name: ../evil'):
+            archive.extract(stream, self.path)
+
+
+class TestGetTreeHash(helpers.ErrorTestsMixin, TestCase):
+
+    def make_zip(self, files, prefix=''):
+        """Return a zip stream including the given (name, contents) pairs."""
+        members = [
+            archive.compress(prefix + name, contents, mode)
+            for name, contents, mode in files]
+        stream = io.BytesIO()
+        archive.write_zip(stream, members)
+        stream.seek(0)
+        return stream
+
+    files = [
+        ('metadata.yaml', b'name: ghost\n', 0o100644),
+        ('hooks/install', b'#!/bin/sh\n', 0o100755),
+    ]
+
+    def test_prefix(self):
+        # The top level directory of Github archives is ignored.
+        self.assertEqual(
+            archive.get_tree_hash(self.make_zip(self.files)),
+            archive.get_tree_hash(self.make_zip(self.files, prefix='a-b/')))
+
+    def test_ignored_files(self):
+        # Files not affecting the charm do not change the hash.
+        files = self.files + [
+            ('README.md', b'exterminate', 0o100644),
+            ('tests/test_ghost.py', b'', 0o100644),
+            ('.travis.yml', b'', 0o100644),
+            ('hooks/.cache/data', b'', 0o100644),
+            ('lib/__pycache__/ghost.cpython-34.pyc', b'', 0o100644),
+        ]
+        self.assertEqual(
+            archive.get_tree_hash(self.make_zip(self.files)),
+            archive.get_tree_hash(self.make_zip(files)))
+
+    def test_nested_documentation(self):
+        # Documentation and test files are only ignored at the top level of
+        # the charm, as they can be part of the charm payload elsewhere.
+        for name in ('templates/motd.md', 'lib/app/docs/index.html',
+                     'lib/app/tests/data', 'files/README'):
+            files = self.files + [(name, b'v1', 0o100644)]
+            changed = self.files + [(name, b'v2', 0o100644)]
+            self.assertNotEqual(
+                archive.get_tree_hash(self.make_zip(files)),
+                archive.get_tree_hash(self.make_zip(changed)), name)
+
+    def test_jujuignore(self):
+        # Additional patterns can be listed in the .jujuignore file.
+        files = self.files + [
+            ('.jujuignore', b'# Comment.\n/build\n*.log\n', 0o100644),
+            ('build/output', b'', 0o100644),
+            ('hooks/debug.log', b'', 0o100644),
+        ]
+        self.assertEqual(
+            archive.get_tree_hash(self.make_zip(self.files)),
+            archive.get_tree_hash(self.make_zip(files, prefix='a-b/')))
+
+    def test_changes(self):
+        # Changes to the charm files, including their mode, change the hash.
+        base = archive.get_tree_hash(self.make_zip(self.files))
+        variants = [
+            self.files[:1],
+            [self.files[0], ('hooks/install', b'#!/bin/bash\n', 0o100755)],
+            [self.files[0], ('hooks/install', b'#!/bin/sh\n', 0o100644)],
+        ]
+        for files in variants:
+            self.assertNotEqual(
+                base, archive.get_tree_hash(self.make_zip(files)))
+
+    def test_invalid_archive(self):
+        # A ValueError is raised if the archive is not valid.
+        with self.assertRaises(ValueError):
+            archive.get_tree_hash(io.BytesIO(b'bad wolf'))
+
+
+class TestSplit(helpers.ErrorTestsMixin, TestCase):
+
+    def make_zip(self, files):
+        """Return a Github like zip stream with the given (name, contents)."""
+        members = [
+            archive.compress('repo-abc/' + name, contents, 0o100755)
+            for name, contents in files]
+        stream = io.BytesIO()
+        archive.write_zip(stream, members)
+        stream.seek(0)
+        return stream
+
+    files = [
+        ('README.md', b'charms'),
+        ('charms/ghost/metadata.yaml', b'name: ghost\n'),
+        ('charms/ghost/hooks/install', b'#!/bin/sh\n'),
+        ('charms/mysql/metadata.yaml', b'name: mysql\n'),
+        ('charms/mysql/tests/charm/metadata.yaml', b'name: test\n'),
+        ('lib/metadata.yaml', b'name: lib\n'),
+    ]
+
+    def test_single(self):
+        # An archive is returned for the charm in the given path.
+        [(path, contents)] = archive.split(
+            self.make_zip(self.files), 'charms/ghost')
+        self.assertEqual('charms/ghost', path)
+        with zipfile.ZipFile(io.BytesIO(contents)) as charm:
+            self.assertEqual(
+                ['metadata.yaml', 'hooks/install'], charm.namelist())
+            self.assertEqual(b'#!/bin/sh\n', charm.read('hooks/install'))
+            info = charm.getinfo('hooks/install')
+            self.assertEqual(0o100755, info.external_attr >> 16)
+
+    def test_wildcards(self):
+        # Wildcards select multiple charms, only within a path component.
+        charms = archive.split(self.make_zip(self.files), 'charms/*')
+        self.assertEqual(
+            ['charms/ghost', 'charms/mysql'], [path for path, _ in charms])
+        with zipfile.ZipFile(io.BytesIO(charms[1][1])) as charm:
+            self.assertEqual(
+                ['metadata.yaml', 'tests/charm/metadata.yaml'],
+                charm.namelist())
+
+    def test_data_copied(self):
+        # The compressed data is copied without compressing it again.
+        member = archive.compress('repo-abc/ghost/metadata.yaml', b'a' * 99)
+        stream = io.BytesIO()
+        archive.write_zip(stream, [member])
+        stream.seek(0)
+        with mock.patch('jujugd.archive.compress') as mock_compress:
+            [(_, contents)] = archive.split(stream, 'ghost')
+        self.assertFalse(mock_compress.called)
+        self.assertIn(member.data, contents)
+
+    def test_not_found(self):
+        # An empty list is returned if no charms match the pattern.
+        self.assertEqual(
+            [], archive.split(self.make_zip(self.files), 'charms/no-such'))
+
+    def test_invalid_archive(self):
+        # A ValueError is raised if the archive is not valid.
+        with self.assertRaises(ValueError):
+            archive.split(io.BytesIO(b'bad wolf'), 'charms/*')
@@ -0,0 +1,201 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy bundles management."""
+
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+from unittest import (
+    mock,
+    TestCase,
+)
+
+import yaml
+
+from . import helpers
+from .. import (
+    api,
+    app,
+    bundle,
+)
+
+
+class BundleMixin:
+    """Create bundle files in a temporary directory."""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_bundle(self, contents):
+        """Write the given YAML encoded contents to a bundle file.
+
+        Return the bundle path.
+        """
+        path = os.path.join(self.directory, 'bundle.yaml')
+        with open(path, 'w') as stream:
+            if isinstance(contents, str):
+                stream.write(contents)
+            else:
+                yaml.safe_dump(contents, stream)
+        return path
+
+
+class TestLoad(BundleMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def test_services(self):
+        # The bundle services and relations are returned.
+        path = self.make_bundle({
+            'services': {
+                'blog': {
+                    'repo': 'hatched/ghost-charm',
+                    'num_units': 3,
+                    'to': [1, 'lxc:2'],
+                    'options': {'port': 8080},
+                },
+                'db': {'repo': 'frankban/mysql-charm', 'series': 'precise'},
+            },
+            'relations': [['blog', 'db:db']],
+        })
+        services, relations = bundle.load(path)
+        self.assertEqual({
+            'blog': bundle.Service(
+                'hatched/ghost-charm', None, 3, ['1', 'lxc:2'],
+                {'port': 8080}),
+            'db': bundle.Service(
+                'frankban/mysql-charm', 'precise', 1, None, {}),
+        }, services)
+        self.assertEqual([('blog', 'db:db')], relations)
+
+    def test_local_repo(self):
+        # Local charm paths are relative to the bundle directory.
+        os.mkdir(os.path.join(self.directory, 'ghost'))
+        path = self.make_bundle({'services': {'blog': {'repo': 'ghost'}}})
+        services, _ = bundle.load(path)
+        self.assertEqual(
+            os.path.join(self.directory, 'ghost'), services['blog'].repo)
+
+    def test_errors(self):
+        # A ValueError is raised if the bundle is not valid.
+        tests = (
+            ('[]', 'invalid bundle contents'),
+            ({'services': {}}, 'no services found'),
+            ({'services': {'blog': 42}}, 'invalid service blog'),
+            ({'services': {'blog': {}}}, 'service blog: missing repo'),
+            ({'services': {'blog': {'repo': 'a/b', 'num_units': 0}}},
+             'service blog: invalid num_units'),
+            ({'services': {'blog': {'repo': 'a/b', 'to': [1, 2]}}},
+             'service blog: more placement targets than units'),
+            ({'services': {'blog': {'repo': 'a/b', 'options': 'bad'}}},
+             'service blog: invalid options'),
+            ({'services': {'blog': {'repo': 'a/b'}}, 'relations': [['blog']]},
+             "invalid relation: ['blog']"),
+            ({'services': {'blog': {'repo': 'a/b'}},
+              'relations': [['blog', 'db:db']]},
+             'relation to unknown service: db:db'),
+        )
+        for contents, expected in tests:
+            path = self.make_bundle(contents)
+            with self.assert_error(ValueError, expected, contents):
+                bundle.load(path)
+
+
+@helpers.mock_print
+class TestDeploy(BundleMixin, helpers.ErrorTestsMixin, TestCase):
+
+    @contextmanager
+    def patch_all(self):
+        """Patch the functions used to upload and deploy charms."""
+        session = mock.MagicMock(pool=None)
+        session.discover.return_value = ('10.0.3.1:17070', 'secret!', 'trusty')
+        session.fetch.side_effect = lambda zip_url: zip_url.encode('utf-8')
+
+        def upload_series(contents, address, password, series_list, *args,
+                          **kwargs):
+            name = contents.decode('utf-8').split('/')[-3]
+            return ['local:{}/{}-1'.format(series_list[0], name)]
+
+        with mock.patch(
+                'jujugd.app.upload_series',
+                side_effect=upload_series) as mock_upload_series:
+            with mock.patch(
+                    'jujugd.app.deploy_services') as mock_deploy_services:
+                with mock.patch(
+                        'jujugd.api.add_relations') as mock_add_relations:
+                    yield (
+                        session, mock_upload_series, mock_deploy_services,
+                        mock_add_relations)
+
+    def test_deploy(self, mock_print):
+        # Charms are uploaded once, services are deployed and relations added.
+        path = self.make_bundle({
+            'services': {
+                'blog': {'repo': 'hatched/ghost', 'options': {'port': 80}},
+                'blog2': {'repo': 'hatched/ghost'},
+                'db': {'repo': 'frankban/mysql', 'series': 'precise'},
+            },
+            'relations': [['blog', 'db'], ['blog2', 'db']],
+        })
+        with self.patch_all() as (session, mock_upload, mock_deploy,
+                                  mock_add_relations):
+            bundle.deploy(path, 'ec2', None, 4, session=session)
+        session.discover.assert_called_once_with('ec2', None)
+        self.assertEqual(2, mock_upload.call_count)
+        connection = session.connect().__enter__()
+        mock_deploy.assert_has_calls([
+            mock.call(
+                connection, ['local:trusty/ghost-1'], ['blog'], 1, None,
+                config={'port': 80}, setup=app.ServiceSetup()),
+            mock.call(
+                connection, ['local:trusty/ghost-1'], ['blog2'], 1, None,
+                config={}, setup=app.ServiceSetup()),
+            mock.call(
+                connection, ['local:precise/mysql-1'], ['db'], 1, None,
+                config={}, setup=app.ServiceSetup()),
+        ], any_order=True)
+        mock_add_relations.assert_called_once_with(
+            connection, [('blog', 'db'), ('blog2', 'db')])
+
+    def test_annotations(self, mock_print):
+        # The given annotations are set on all the services.
+        path = self.make_bundle({
+            'services': {'blog': {'repo': 'hatched/ghost'}},
+        })
+        annotations = {'juju-git-deploy-ephemeral': 'ci-42'}
+        with self.patch_all() as (session, mock_upload, mock_deploy,
+                                  mock_add_relations):
+            bundle.deploy(
+                path, 'ec2', None, 4, session=session,
+                annotations=annotations)
+        setup = mock_deploy.call_args[1]['setup']
+        self.assertEqual(annotations, setup.annotations)
+
+    def test_invalid_bundle(self, mock_print):
+        # A ProgramExit is raised if the bundle is not valid.
+        path = self.make_bundle({'services': {}})
+        expected = 'juju-git-deploy: error: invalid bundle {}: {}'.format(
+            path, 'no services found')
+        with self.assert_error(app.ProgramExit, expected):
+            bundle.deploy(path, 'ec2', None, 4, session=mock.Mock())
+
+    def test_api_error(self, mock_print):
+        # A ProgramExit is raised if an API error occurs.
+        path = self.make_bundle({'services': {'blog': {'repo': 'a/ghost'}}})
+        with self.patch_all() as (session, _, mock_deploy, _):
+            mock_deploy.side_effect = api.JujuError('bad wolf')
+            with self.assert_error(
+                    app.ProgramExit,
+                    'juju-git-deploy: error: API failure: bad wolf'):
+                bundle.deploy(path, 'ec2', None, 4, session=session)
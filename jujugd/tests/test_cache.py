@@ -0,0 +1,145 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy shared archive cache."""
+
+import fcntl
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from .. import cache
+
+
+class TestArchiveCache(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = cache.ArchiveCache(self.path, max_entries=2)
+
+    def test_retrieved_once(self):
+        # Contents are retrieved only the first time they are requested.
+        retrieve = mock.Mock(return_value=b'zip')
+        self.assertEqual(b'zip', self.cache.get('ghost@abc', retrieve))
+        self.assertEqual(b'zip', self.cache.get('ghost@abc', retrieve))
+        retrieve.assert_called_once_with()
+
+    def test_shared(self):
+        # Entries are shared by different cache instances.
+        self.cache.get('ghost@abc', lambda: b'zip')
+        other = cache.ArchiveCache(self.path)
+        self.assertEqual(b'zip', other.get('ghost@abc', mock.Mock()))
+
+    def test_single_flight(self):
+        # Concurrent requesters wait for the first retrieval to complete.
+        calls = []
+
+        def retrieve():
+            calls.append(None)
+            time.sleep(0.1)
+            return b'zip'
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    cache.ArchiveCache(self.path).get('ghost@abc', retrieve)))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([b'zip'] * 4, results)
+        self.assertEqual(1, len(calls))
+
+    def test_retrieve_error(self):
+        # Errors are propagated and nothing is stored.
+        with self.assertRaises(IOError):
+            self.cache.get('ghost@abc', mock.Mock(side_effect=IOError('bad')))
+        self.assertEqual([], glob.glob(os.path.join(self.path, '*.zip')))
+        self.assertEqual(b'zip', self.cache.get('ghost@abc', lambda: b'zip'))
+
+    def test_partial_files(self):
+        # Partial files left by crashed processes are discarded.
+        entry_path = self.cache._entry_path('ghost@abc')
+        partial_path = entry_path + '.4242.partial'
+        with open(partial_path, 'wb') as stream:
+            stream.write(b'zi')
+        self.assertEqual(b'zip', self.cache.get('ghost@abc', lambda: b'zip'))
+        self.assertFalse(os.path.exists(partial_path))
+        self.assertEqual([], glob.glob(os.path.join(self.path, '*.partial')))
+
+    def test_prune(self):
+        # The least recently used entries are removed.
+        for i, key in enumerate(('a', 'b', 'c')):
+            self.cache.get(key, lambda: b'zip')
+            os.utime(self.cache._entry_path(key), (i, i))
+        self.cache.get('d', lambda: b'zip')
+        self.assertFalse(os.path.exists(self.cache._entry_path('a')))
+        self.assertFalse(os.path.exists(self.cache._entry_path('b')))
+        self.assertTrue(os.path.exists(self.cache._entry_path('c')))
+        # The lock files of the removed entries are removed as well.
+        self.assertEqual(2, len(glob.glob(os.path.join(self.path, '*.lock'))))
+
+    def test_prune_failed_retrievals(self):
+        # Lock files left by failed retrievals are removed.
+        with self.assertRaises(IOError):
+            self.cache.get('ghost@abc', mock.Mock(side_effect=IOError('bad')))
+        self.cache.get('ghost@def', lambda: b'zip')
+        lock_paths = glob.glob(os.path.join(self.path, '*.lock'))
+        self.assertEqual([self.cache._entry_path('ghost@def') + '.lock'],
+                         lock_paths)
+
+    def test_prune_locked(self):
+        # Entries locked by other processes are not removed.
+        for i, key in enumerate(('a', 'b')):
+            self.cache.get(key, lambda: b'zip')
+            os.utime(self.cache._entry_path(key), (i, i))
+        entry_path = self.cache._entry_path('a')
+        with open(entry_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.cache.get('c', lambda: b'zip')
+        self.assertTrue(os.path.exists(entry_path))
+        self.assertTrue(os.path.exists(entry_path + '.lock'))
+
+    def test_lock_file_removed(self):
+        # Lock files removed while waiting for the lock are created again.
+        entry_path = self.cache._entry_path('ghost@abc')
+        flock = fcntl.flock
+
+        def remove_lock_file(lock, operation):
+            # Simulate pruning while waiting for the lock, the first time.
+            if mock_flock.call_count == 1:
+                os.remove(entry_path + '.lock')
+            flock(lock, operation)
+        with mock.patch(
+                'fcntl.flock', side_effect=remove_lock_file) as mock_flock:
+            self.cache.get('ghost@abc', lambda: b'zip')
+        self.assertEqual(2, mock_flock.call_count)
+        self.assertTrue(os.path.exists(entry_path + '.lock'))
+
+    def test_unusable_directory(self):
+        # Contents are still retrieved if the cache cannot be used.
+        path = os.path.join(self.path, 'file')
+        open(path, 'w').close()
+        archive_cache = cache.ArchiveCache(os.path.join(path, 'cache'))
+        contents = archive_cache.get('ghost@abc', lambda: b'zip')
+        self.assertEqual(b'zip', contents)
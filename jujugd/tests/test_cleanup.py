@@ -0,0 +1,218 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy ephemeral services teardown."""
+
+from contextlib import contextmanager
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    api,
+    app,
+    cleanup,
+)
+
+
+def service(name, label=None):
+    """Return the deltas describing the given service."""
+    deltas = [['service', 'change', {'Name': name}]]
+    if label is not None:
+        deltas.append(['annotation', 'change', {
+            'Tag': 'service-{}'.format(name),
+            'Annotations': {cleanup.ANNOTATION: label},
+        }])
+    return deltas
+
+
+def unit(name, machine, subordinate=False):
+    """Return the delta describing the given unit."""
+    return ['unit', 'change', {
+        'Name': name, 'Service': name.split('/')[0], 'MachineId': machine,
+        'Subordinate': subordinate}]
+
+
+def machine(machine_id, manager=False):
+    """Return the delta describing the given machine."""
+    jobs = ['JobHostUnits']
+    if manager:
+        jobs.append('JobManageEnviron')
+    return ['machine', 'change', {'Id': machine_id, 'Jobs': jobs}]
+
+
+# An environment including ephemeral and permanent services.
+DELTAS = (
+    service('ghost', label='ci-1') + service('mysql', label='ci-2') +
+    service('haproxy') + service('nrpe') + [
+        machine('0', manager=True),
+        machine('1'), machine('2'), machine('3'), machine('3/lxc/0'),
+        unit('ghost/0', '1'), unit('ghost/1', '2'), unit('ghost/2', '0'),
+        unit('mysql/0', '3/lxc/0'), unit('haproxy/0', '2'),
+        unit('nrpe/0', '1', subordinate=True),
+        ['relation', 'change', {'Key': 'ghost:db mysql:db'}],
+    ])
+
+
+class TestModel(TestCase):
+
+    def setUp(self):
+        # Build the model of the environment.
+        self.model = cleanup.Model()
+        self.model.update(DELTAS)
+
+    def test_update(self):
+        # Entities are added, changed and removed.
+        self.assertEqual(4, len(self.model.services))
+        self.model.update([
+            ['service', 'remove', {'Name': 'ghost'}],
+            ['unit', 'change', {'Name': 'mysql/0', 'Service': 'mysql'}],
+        ])
+        self.assertNotIn('ghost', self.model.services)
+        self.assertEqual(
+            {'Name': 'mysql/0', 'Service': 'mysql'},
+            self.model.units['mysql/0'])
+
+    def test_ephemeral_services(self):
+        # All the ephemeral services are returned.
+        self.assertEqual(
+            ['ghost', 'mysql'], self.model.get_ephemeral_services())
+
+    def test_ephemeral_services_label(self):
+        # Services can be filtered by label.
+        self.assertEqual(
+            ['mysql'], self.model.get_ephemeral_services(label='ci-2'))
+
+    def test_units(self):
+        # The units of the given services are returned.
+        self.assertEqual(
+            ['ghost/0', 'ghost/1', 'ghost/2'],
+            self.model.get_units(['ghost']))
+
+    def test_machines(self):
+        # Only the machines exclusively hosting the given services are
+        # returned. Subordinate units are ignored, while machines managing
+        # the environment, hosting other units or containers are excluded.
+        self.assertEqual(
+            ['1', '3/lxc/0'], self.model.get_machines(['ghost', 'mysql']))
+
+
+class FakeConnection:
+    """A fake API connection serving the AllWatcher requests."""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.requests = []
+
+    def send(self, request, path=None, callback=None, timeout=None):
+        self.requests.append(request)
+        if request['Request'] == 'WatchAll':
+            return {'Response': {'AllWatcherId': '42'}}
+        if request['Request'] == 'Next':
+            if not self.batches:
+                # No more changes: a real watcher would block.
+                raise api.JujuTimeout('timed out')
+            return helpers.stream_response(
+                {'Response': {'Deltas': self.batches.pop(0)}},
+                path=path, callback=callback)
+        return {}
+
+    def send_many(self, requests):
+        self.requests.extend(requests)
+        return [{} for _ in requests]
+
+
+@helpers.mock_print
+class TestCleanup(helpers.ErrorTestsMixin, TestCase):
+
+    def make_session(self, connection):
+        """Return a session connecting to the given connection."""
+        @contextmanager
+        def connect(api_address, password):
+            yield connection
+        return mock.Mock(connect=connect)
+
+    def call_cleanup(self, batches, **kwargs):
+        """Call cleanup using a fake connection returning the given deltas.
+
+        Return the destroyed services and the requests sent.
+        """
+        connection = FakeConnection(batches)
+        services = cleanup.cleanup(
+            '10.0.3.1:17070', 'secret!',
+            session=self.make_session(connection), **kwargs)
+        requests = [request['Request'] for request in connection.requests]
+        return services, requests
+
+    def test_cleanup(self, mock_print):
+        # Ephemeral services are destroyed, and machines are destroyed once
+        # their units are removed.
+        removed = [
+            ['unit', 'remove', {'Name': 'ghost/0'}],
+            ['unit', 'remove', {'Name': 'nrpe/0'}],
+        ]
+        services, requests = self.call_cleanup(
+            [DELTAS, removed[:1], removed[1:]], label='ci-1')
+        self.assertEqual(['ghost'], services)
+        self.assertEqual([
+            'WatchAll', 'Next', 'DestroyServiceUnits', 'ServiceDestroy',
+            'Next', 'Next', 'DestroyMachines', 'Stop',
+        ], requests)
+        mock_print.assert_called_with('destroying machines 1')
+
+    def test_dry_run(self, mock_print):
+        # Nothing is destroyed in dry run mode.
+        services, requests = self.call_cleanup([DELTAS], dry_run=True)
+        self.assertEqual(['ghost', 'mysql'], services)
+        self.assertEqual(['WatchAll', 'Next', 'Stop'], requests)
+
+    def test_nothing_found(self, mock_print):
+        # Nothing is destroyed if there are no ephemeral services.
+        services, requests = self.call_cleanup([DELTAS], label='ci-3')
+        self.assertEqual([], services)
+        self.assertEqual(['WatchAll', 'Next', 'Stop'], requests)
+        mock_print.assert_called_once_with('no ephemeral services found')
+
+    def test_timeout(self, mock_print):
+        # A ProgramExit is raised if units are not removed in time.
+        expected = (
+            'juju-git-deploy: error: '
+            'timed out waiting for the units to be removed')
+        with self.assert_error(app.ProgramExit, expected):
+            self.call_cleanup([DELTAS], label='ci-1', timeout=-1)
+
+    def test_watcher_timeout(self, mock_print):
+        # A ProgramExit is raised if no changes are received in time. The
+        # watcher is not stopped, as the connection has been closed.
+        expected = (
+            'juju-git-deploy: error: '
+            'timed out waiting for the units to be removed')
+        connection = FakeConnection([DELTAS])
+        with self.assert_error(app.ProgramExit, expected):
+            cleanup.cleanup(
+                '10.0.3.1:17070', 'secret!', label='ci-1',
+                session=self.make_session(connection))
+        self.assertEqual('Next', connection.requests[-1]['Request'])
+
+    def test_api_error(self, mock_print):
+        # A ProgramExit is raised if an API error occurs.
+        connection = mock.Mock()
+        connection.send.return_value = {'Error': 'bad wolf'}
+        expected = (
+            'juju-git-deploy: error: API failure: '
+            'error watching the environment: bad wolf')
+        with self.assert_error(app.ProgramExit, expected):
+            cleanup.cleanup(
+                '10.0.3.1:17070', 'secret!',
+                session=self.make_session(connection))
@@ -0,0 +1,55 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy configuration file management."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from . import helpers
+from .. import config
+
+
+class TestLoad(helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'juju-git-deploy.yaml')
+
+    def write(self, contents):
+        """Write the given contents to the configuration file."""
+        with open(self.path, 'w') as stream:
+            stream.write(contents)
+
+    def test_contents(self):
+        # The configuration is returned as a dict.
+        self.write('github-token: secret')
+        self.assertEqual({'github-token': 'secret'}, config.load(self.path))
+
+    def test_missing_file(self):
+        # An empty dict is returned if the configuration file does not exist.
+        self.assertEqual({}, config.load(self.path))
+
+    def test_empty_file(self):
+        # An empty dict is returned if the configuration file is empty.
+        self.write('')
+        self.assertEqual({}, config.load(self.path))
+
+    def test_invalid_contents(self):
+        # A ValueError is raised if the configuration is not a mapping.
+        self.write('- bad wolf')
+        expected = 'invalid configuration file: {}'.format(self.path)
+        with self.assert_error(ValueError, expected):
+            config.load(self.path)
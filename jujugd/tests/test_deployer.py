@@ -0,0 +1,221 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy Python API."""
+
+from contextlib import contextmanager
+import sys
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    api,
+    app,
+    deployer,
+    leases,
+)
+
+
+class FakeSession(app.Session):
+    """A session returning canned environment facts and contents."""
+
+    def __init__(self):
+        self.pool = mock.Mock()
+        self.connection = mock.Mock()
+        self.closed = False
+
+    def discover(self, env_name, series):
+        return '10.0.3.1:17070', 'secret!', series or 'trusty'
+
+    def get_commit(self, zip_url, output=None):
+        return 'abc'
+
+    def fetch(self, zip_url, commit=None, output=None):
+        if output is not None:
+            output('fetching')
+        return b'zip contents'
+
+    @contextmanager
+    def connect(self, api_address, password):
+        yield self.connection
+
+    def close(self):
+        self.closed = True
+
+
+class TestDeployer(
+        helpers.CacheDirMixin, helpers.ConfigMixin, helpers.ErrorTestsMixin,
+        TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = FakeSession()
+        self.deployer = deployer.Deployer(session=self.session)
+
+    def deploy(self, **kwargs):
+        """Deploy the ghost charm, patching the charm upload and deploy."""
+        def upload_charm(api_address, stream, password, series, pool=None):
+            self.assertEqual(b'zip contents', stream.read())
+            return 'local:{}/ghost-0'.format(series)
+
+        with mock.patch(
+                'jujugd.api.upload_charm',
+                side_effect=upload_charm) as self.mock_upload_charm:
+            with mock.patch(
+                    'jujugd.app.deploy_services',
+                    return_value=['ghost']) as self.mock_deploy_services:
+                return self.deployer.deploy(
+                    'hatched/ghost-charm', 'ec2', **kwargs)
+
+    def test_result(self):
+        # A result describing the deployment is returned.
+        result = self.deploy()
+        self.assertEqual('local:trusty/ghost-0', result.charm_url)
+        self.assertEqual('ghost', result.service)
+        self.assertEqual('ec2', result.env_name)
+        self.assertEqual(
+            ['deploy', 'prepare', 'process'], sorted(result.timings))
+        self.assertEqual(12, result.bytes)
+        self.assertFalse(result.skipped)
+        self.mock_deploy_services.assert_called_once_with(
+            self.session.connection, ['local:trusty/ghost-0'], [None], 1,
+            None, setup=mock.ANY)
+        setup = self.mock_deploy_services.call_args[1]['setup']
+        self.assertEqual('abc', setup.annotations['juju-git-deploy-commit'])
+
+    def test_skipped(self):
+        # Nothing is uploaded if the service already runs the commit.
+        self.session.connection.send_many.return_value = [{'Response': {
+            'Annotations': {
+                'juju-git-deploy-repo': 'hatched/ghost-charm',
+                'juju-git-deploy-commit': 'abc',
+            }}}]
+        result = self.deploy(service='blog')
+        self.assertTrue(result.skipped)
+        self.assertIsNone(result.charm_url)
+        self.assertEqual('blog', result.service)
+        self.assertEqual(['prepare'], list(result.timings))
+        self.assertFalse(self.mock_upload_charm.called)
+        self.assertFalse(self.mock_deploy_services.called)
+
+    def test_unchanged(self):
+        # Nothing is uploaded if the service runs the same charm files.
+        self.session.connection.send_many.side_effect = [
+            [{'Response': {'Annotations': {
+                'juju-git-deploy-repo': 'hatched/ghost-charm',
+                'juju-git-deploy-commit': 'old',
+                'juju-git-deploy-tree': 'hash',
+            }}}],
+            [{}],
+        ]
+        with mock.patch('jujugd.app.get_tree', return_value='hash'):
+            with mock.patch('jujugd.app.apply_transforms') as mock_transform:
+                result = self.deploy(service='blog')
+        self.assertTrue(result.skipped)
+        self.assertFalse(self.mock_upload_charm.called)
+        self.assertFalse(mock_transform.called)
+        # The new commit is recorded.
+        requests = self.session.connection.send_many.call_args[0][0]
+        self.assertEqual('SetAnnotations', requests[0]['Request'])
+        self.assertEqual(
+            'abc', requests[0]['Params']['Pairs']['juju-git-deploy-commit'])
+
+    def test_superseded(self):
+        # Nothing is deployed if a newer commit has been requested while
+        # waiting for the service lease.
+        with mock.patch(
+                'jujugd.leases.acquire',
+                side_effect=leases.Superseded('def')):
+            result = self.deploy(service='blog')
+        self.assertTrue(result.skipped)
+        self.assertEqual('blog', result.service)
+        self.assertFalse(self.mock_upload_charm.called)
+        self.assertFalse(self.mock_deploy_services.called)
+
+    def test_deployed_concurrently(self):
+        # Deployments of the same commit completed while waiting for the
+        # service lease are reused.
+        lease = leases.acquire('ec2', 'blog', 'abc')
+        lease.record('abc', ['blog'])
+        with mock.patch('jujugd.leases.acquire', return_value=lease):
+            result = self.deploy(service='blog')
+        self.assertTrue(result.skipped)
+        self.assertEqual('blog', result.service)
+        self.assertFalse(self.mock_upload_charm.called)
+
+    def test_pool(self):
+        # Charms are uploaded using the session connection pool.
+        self.deploy(series='precise')
+        self.assertEqual(
+            self.session.pool,
+            self.mock_upload_charm.call_args[1]['pool'])
+
+    def test_no_output(self):
+        # Nothing is printed while deploying: progress is logged instead.
+        with mock.patch('builtins.print') as mock_print:
+            with mock.patch('jujugd.deployer.logging') as mock_logging:
+                self.deploy()
+        self.assertFalse(mock_print.called)
+        mock_logging.debug.assert_called_once_with('fetching')
+
+    def test_output_restored(self):
+        # The standard output is left untouched.
+        stdout = sys.stdout
+        self.deploy()
+        self.assertIs(stdout, sys.stdout)
+
+    def test_discovery_error(self):
+        # A DiscoveryError is raised if the repository is not valid.
+        expected = 'invalid repository: bad wolf'
+        with self.assert_error(deployer.DiscoveryError, expected):
+            self.deployer.deploy('bad wolf')
+
+    def test_charm_path(self):
+        # A DiscoveryError is raised if the repository includes a charm path.
+        expected = 'charm paths are not supported: frankban/charms/charms/*'
+        with self.assert_error(deployer.DiscoveryError, expected):
+            self.deployer.deploy('frankban/charms/charms/*')
+
+    def test_fetch_error(self):
+        # A FetchError is raised if the charm cannot be retrieved.
+        self.session.fetch = mock.Mock(
+            side_effect=app.ProgramExit('bad wolf'))
+        with self.assertRaises(deployer.FetchError) as context_manager:
+            self.deploy()
+        self.assertEqual('process', context_manager.exception.phase)
+
+    def test_upload_error(self):
+        # An UploadError is raised if the charm cannot be uploaded.
+        with mock.patch(
+                'jujugd.api.upload_charm', side_effect=IOError('bad wolf')):
+            expected = 'charm upload failed: bad wolf'
+            with self.assert_error(deployer.UploadError, expected):
+                self.deployer.deploy('hatched/ghost-charm', 'ec2')
+
+    def test_api_error(self):
+        # An APIError is raised if the service cannot be deployed.
+        with mock.patch('jujugd.api.upload_charm'):
+            with mock.patch(
+                    'jujugd.app.deploy_services',
+                    side_effect=api.JujuError('bad wolf')):
+                expected = 'API failure: bad wolf'
+                with self.assert_error(deployer.APIError, expected):
+                    self.deployer.deploy('hatched/ghost-charm', 'ec2')
+
+    def test_close(self):
+        # The session is closed when exiting the context block.
+        with self.deployer:
+            pass
+        self.assertTrue(self.session.closed)
@@ -69,6 +69,15 @@ class TestGetDefaultEnvName(TestCase):
         mock_call.assert_called_once_with('juju', 'switch')
 
 
+class TestGetJenvPath(TestCase):
+
+    def test_path(self):
+        # The path to the jenv file in the Juju home is returned.
+        with mock.patch('os.environ', {'HOME': '/home/who'}):
+            path = env.get_jenv_path('ec2')
+        self.assertEqual('/home/who/.juju/environments/ec2.jenv', path)
+
+
 class TestParseJenv(TestCase):
 
     def make_jenv(self, contents, env_name='ec2'):
@@ -0,0 +1,201 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy Github API client."""
+
+import os
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    github,
+    utils,
+)
+
+
+def make_headers(remaining, reset, limit=60):
+    """Return Github rate limit headers."""
+    return {
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(reset),
+    }
+
+
+class TestGetProxy(TestCase):
+
+    def test_environment(self):
+        # The proxy URL is retrieved from the environment.
+        with mock.patch.dict(
+                os.environ, {'JUJU_GIT_DEPLOY_PROXY': 'http://proxy:8042/'}):
+            self.assertEqual('http://proxy:8042', github.get_proxy())
+
+    def test_config(self):
+        # The proxy URL is retrieved from the configuration file.
+        with mock.patch.dict(os.environ, {'JUJU_GIT_DEPLOY_PROXY': ''}):
+            with mock.patch(
+                    'jujugd.config.load',
+                    return_value={'github-proxy': 'http://proxy:8042'}):
+                self.assertEqual('http://proxy:8042', github.get_proxy())
+
+    def test_no_proxy(self):
+        # None is returned if no proxy is configured.
+        with mock.patch.dict(os.environ, {'JUJU_GIT_DEPLOY_PROXY': ''}):
+            with mock.patch('jujugd.config.load', return_value={}):
+                self.assertIsNone(github.get_proxy())
+
+
+class TestGetToken(TestCase):
+
+    def test_environment(self):
+        # The token is retrieved from the environment.
+        with mock.patch.dict(os.environ, {'GITHUB_TOKEN': 'secret'}):
+            self.assertEqual('secret', github.get_token())
+
+    def test_config(self):
+        # The token is retrieved from the configuration file.
+        with mock.patch.dict(os.environ, {'GITHUB_TOKEN': ''}):
+            with mock.patch(
+                    'jujugd.config.load',
+                    return_value={'github-token': 'secret'}):
+                self.assertEqual('secret', github.get_token())
+
+    def test_no_token(self):
+        # None is returned if no token is configured.
+        with mock.patch.dict(os.environ, {'GITHUB_TOKEN': ''}):
+            with mock.patch('jujugd.config.load', return_value={}):
+                self.assertIsNone(github.get_token())
+
+    def test_invalid_config(self):
+        # None is returned if the configuration file is not valid.
+        with mock.patch.dict(os.environ, {'GITHUB_TOKEN': ''}):
+            with mock.patch(
+                    'jujugd.config.load', side_effect=ValueError('bad wolf')):
+                self.assertIsNone(github.get_token())
+
+
+@mock.patch('time.time', mock.Mock(return_value=1000))
+class TestRateLimit(TestCase):
+
+    def test_unknown(self):
+        # Requests are not delayed if the rate limit is not known.
+        rate_limit = github.RateLimit(reserve=10)
+        self.assertEqual(0, rate_limit.get_delay())
+        self.assertEqual('unknown', str(rate_limit))
+
+    def test_invalid_headers(self):
+        # Responses without rate limit headers are ignored.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update({'X-RateLimit-Remaining': 'bad'})
+        self.assertIsNone(rate_limit.remaining)
+
+    def test_plenty_left(self):
+        # Requests are not delayed if many requests are left.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update(make_headers(42, 1100))
+        self.assertEqual(0, rate_limit.get_delay())
+        self.assertEqual(41, rate_limit.remaining)
+
+    def test_spread(self):
+        # Requests are spread over the time left if only a few are left.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update(make_headers(5, 1100))
+        self.assertEqual(20, rate_limit.get_delay())
+        self.assertEqual(25, rate_limit.get_delay())
+
+    def test_exhausted(self):
+        # Requests are suspended until the reset time if none are left.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update(make_headers(0, 1100))
+        self.assertEqual(101, rate_limit.get_delay())
+
+    def test_reset(self):
+        # Requests are not delayed if the reset time has passed.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update(make_headers(0, 900))
+        self.assertEqual(0, rate_limit.get_delay())
+        self.assertIsNone(rate_limit.remaining)
+
+    @helpers.mock_print
+    def test_wait(self, mock_print):
+        # The user is notified when requests are suspended.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update(make_headers(0, 1100))
+        with mock.patch('time.sleep') as mock_sleep:
+            rate_limit.wait()
+        mock_sleep.assert_called_once_with(101)
+        self.assertIn('waiting 101 seconds', mock_print.call_args[0][0])
+
+    @helpers.mock_print
+    def test_wait_output(self, mock_print):
+        # The notification can be passed to an output callable.
+        rate_limit = github.RateLimit(reserve=10)
+        rate_limit.update(make_headers(0, 1100))
+        output = mock.Mock()
+        with mock.patch('time.sleep'):
+            rate_limit.wait(output=output)
+        self.assertIn('waiting 101 seconds', output.call_args[0][0])
+        self.assertFalse(mock_print.called)
+
+
+@mock.patch('jujugd.github.get_token', mock.Mock(return_value='secret'))
+class TestUrlget(helpers.ErrorTestsMixin, TestCase):
+
+    url = 'https://api.github.com/repos/hatched/ghost-charm/zipball/dev'
+
+    def setUp(self):
+        # Use a fresh rate limit for each test.
+        patch_rate_limit = mock.patch(
+            'jujugd.github.rate_limit', github.RateLimit(reserve=10))
+        self.rate_limit = patch_rate_limit.start()
+        self.addCleanup(patch_rate_limit.stop)
+
+    def test_authenticated(self):
+        # Requests are authenticated and the rate limit is updated.
+        response = helpers.make_response(headers=make_headers(42, 1100))
+        with mock.patch(
+                'jujugd.utils.urlget', return_value=response) as mock_urlget:
+            result = github.urlget(self.url, headers={'a': 'b'})
+        self.assertIs(response, result)
+        mock_urlget.assert_called_once_with(
+            self.url, headers={'a': 'b', 'Authorization': 'token secret'})
+        self.assertEqual(42, self.rate_limit.remaining)
+
+    def test_proxy_not_authenticated(self):
+        # The token is not sent to the charm archive proxy.
+        url = 'http://proxy:8042/repos/hatched/ghost-charm/zipball/dev'
+        response = helpers.make_response()
+        with mock.patch(
+                'jujugd.utils.urlget', return_value=response) as mock_urlget:
+            github.urlget(url)
+        mock_urlget.assert_called_once_with(url, headers={})
+
+    def test_retry_exhausted(self):
+        # The request is retried once if the rate limit is exceeded.
+        error = utils.ResponseError(
+            self.url, 403, 'Forbidden', make_headers(0, 0))
+        response = helpers.make_response()
+        with mock.patch(
+                'jujugd.utils.urlget',
+                side_effect=[error, response]) as mock_urlget:
+            self.assertIs(response, github.urlget(self.url))
+        self.assertEqual(2, mock_urlget.call_count)
+
+    def test_error(self):
+        # Other errors are propagated.
+        error = utils.ResponseError(self.url, 404, 'Not Found', {})
+        with mock.patch('jujugd.utils.urlget', side_effect=error):
+            with self.assertRaises(utils.ResponseError):
+                github.urlget(self.url)
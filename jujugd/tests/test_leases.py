@@ -0,0 +1,215 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy per service deployment leases."""
+
+import fcntl
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import leases
+
+
+def make_ticket(directory, name, commit, locked=True):
+    """Queue a ticket with the given file name in the given directory.
+
+    Return the open ticket file, locked if requested.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stream = open(os.path.join(directory, name), 'w')
+    stream.write(commit)
+    stream.flush()
+    if locked:
+        fcntl.flock(stream, fcntl.LOCK_EX)
+    return stream
+
+
+class TestGetNewerCommit(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.ticket = make_ticket(self.directory, '2.ticket', 'abc')
+        self.addCleanup(self.ticket.close)
+
+    def get_newer_commit(self, commit='abc'):
+        return leases.get_newer_commit(
+            self.directory, self.ticket.name, commit)
+
+    def add_ticket(self, name, commit, locked=True):
+        stream = make_ticket(self.directory, name, commit, locked=locked)
+        self.addCleanup(stream.close)
+        return stream.name
+
+    def test_not_superseded(self):
+        # None is returned if no other requests are queued.
+        self.assertIsNone(self.get_newer_commit())
+
+    def test_newer_commit(self):
+        # The ticket is superseded by later requests for other commits.
+        self.add_ticket('3.ticket', 'def')
+        self.assertEqual('def', self.get_newer_commit())
+
+    def test_same_commit(self):
+        # Later requests for the same commit do not supersede the ticket.
+        self.add_ticket('3.ticket', 'abc')
+        self.assertIsNone(self.get_newer_commit())
+
+    def test_older_request(self):
+        # Requests queued earlier do not supersede the ticket.
+        self.add_ticket('1.ticket', 'def')
+        self.assertIsNone(self.get_newer_commit())
+
+    def test_local_charm(self):
+        # Requests for local charms are always superseded.
+        self.add_ticket('3.ticket', 'abc')
+        self.assertEqual('abc', self.get_newer_commit(commit=''))
+
+    def test_stale(self):
+        # Tickets not locked by any process are removed.
+        path = self.add_ticket('3.ticket', 'def', locked=False)
+        self.assertIsNone(self.get_newer_commit())
+        self.assertFalse(os.path.exists(path))
+
+
+@helpers.mock_print
+class TestAcquire(helpers.CacheDirMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = os.path.join(
+            self.cache_dir, 'services', 'qa',
+            hashlib.sha1(b'ghost').hexdigest())
+
+    def acquire(self, commit, **kwargs):
+        """Take the lease on the ghost service in the qa environment."""
+        lease = leases.acquire('qa', 'ghost', commit, **kwargs)
+        self.addCleanup(lease.release)
+        return lease
+
+    def get_tickets(self):
+        """Return the names of the queued tickets."""
+        return sorted(
+            os.path.basename(i)
+            for i in glob.glob(os.path.join(self.directory, '*.ticket')))
+
+    def wait_for_tickets(self, count):
+        """Wait for the given number of tickets to be queued."""
+        deadline = time.monotonic() + 5
+        while len(self.get_tickets()) < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_acquire_release(self, mock_print):
+        # The ticket is queued while the lease is held.
+        lease = self.acquire('abc')
+        self.assertEqual([os.path.basename(lease.ticket_path)],
+                         self.get_tickets())
+        with open(lease.ticket_path) as stream:
+            self.assertEqual('abc', stream.read())
+        lease.release()
+        self.assertEqual([], self.get_tickets())
+        # The lease can be taken again once released.
+        self.acquire('abc').release()
+        self.assertFalse(mock_print.called)
+
+    def test_services(self, mock_print):
+        # Leases on different services do not exclude each other.
+        self.acquire('abc')
+        lease = leases.acquire('qa', 'mysql', 'abc', timeout=0)
+        lease.release()
+
+    def test_timeout(self, mock_print):
+        # An IOError is raised if the lease is not released in time.
+        self.acquire('abc')
+        expected = 'timed out waiting for the deployment of ghost in progress'
+        with self.assert_error(IOError, expected):
+            leases.acquire(
+                'qa', 'ghost', 'abc', timeout=0.05, poll_interval=0.01)
+        # The ticket is removed.
+        self.assertEqual(1, len(self.get_tickets()))
+        mock_print.assert_called_once_with(
+            'waiting for the deployment of ghost in progress')
+
+    def test_output(self, mock_print):
+        # Waiting can be reported to an output callable.
+        self.acquire('abc')
+        output = mock.Mock()
+        with self.assertRaises(IOError):
+            leases.acquire(
+                'qa', 'ghost', 'abc', timeout=0.05, poll_interval=0.01,
+                output=output)
+        output.assert_called_once_with(
+            'waiting for the deployment of ghost in progress')
+        self.assertFalse(mock_print.called)
+
+    def test_superseded(self, mock_print):
+        # Superseded is raised if a newer request is queued.
+        self.acquire('abc')
+        errors = []
+
+        def acquire():
+            try:
+                leases.acquire('qa', 'ghost', 'abc', poll_interval=0.01)
+            except leases.Superseded as err:
+                errors.append(err)
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.wait_for_tickets(2)
+        expected = 'timed out waiting for the deployment of ghost in progress'
+        with self.assert_error(IOError, expected):
+            leases.acquire('qa', 'ghost', 'def', timeout=0.5)
+        thread.join()
+        [err] = errors
+        self.assertEqual('def', err.commit)
+        self.assertEqual('superseded by def', str(err))
+
+    def test_result_reused(self, mock_print):
+        # Requesters for the same commit reuse the result of the deployment
+        # they waited for.
+        lease = self.acquire('abc')
+        results = []
+
+        def acquire():
+            with leases.acquire(
+                    'qa', 'ghost', 'abc', poll_interval=0.01) as other:
+                results.append(other.get_result('abc'))
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.wait_for_tickets(2)
+        lease.record('abc', ['ghost'])
+        lease.release()
+        thread.join()
+        self.assertEqual([['ghost']], results)
+
+    def test_result_not_reused(self, mock_print):
+        # Results recorded before the request, or for other commits, are not
+        # reused.
+        lease = self.acquire('abc')
+        lease.record('abc', ['ghost'])
+        lease.release()
+        lease = self.acquire('abc')
+        self.assertIsNone(lease.get_result('abc'))
+        lease.record('abc', ['ghost'])
+        self.assertIsNone(lease.get_result('def'))
+        self.assertIsNone(lease.get_result(None))
@@ -14,6 +14,9 @@
 
 import argparse
 import logging
+import os
+import shutil
+import tempfile
 from unittest import (
     mock,
     TestCase,
@@ -22,7 +25,11 @@ from unittest import (
 from . import helpers
 from .. import (
     __doc__ as app_doc,
+    app,
+    archive,
     manage,
+    metrics,
+    utils,
 )
 
 
@@ -49,7 +56,7 @@ class TestPositiveInteger(helpers.ErrorTestsMixin, TestCase):
     def test_valid_value(self):
         # No errors are raised if the value is a positive integer.
         for value in ('1', 42, '47'):
-            manage._positive_integer(value)
+            self.assertEqual(int(value), manage._positive_integer(value))
 
     def test_not_a_number(self):
         # An argparse error is raised if the value cannot be converted to an
@@ -69,6 +76,72 @@ class TestPositiveInteger(helpers.ErrorTestsMixin, TestCase):
                 manage._positive_integer(value)
 
 
+class TestNamesList(helpers.ErrorTestsMixin, TestCase):
+
+    def test_single_name(self):
+        # A list containing a single name is returned.
+        self.assertEqual(['ec2'], manage._names_list('ec2'))
+
+    def test_multiple_names(self):
+        # Comma separated names are split and stripped.
+        names = manage._names_list('staging, qa,,eu-west ')
+        self.assertEqual(['staging', 'qa', 'eu-west'], names)
+
+    def test_empty(self):
+        # An argparse error is raised if no names are provided.
+        with self.assert_error(
+                argparse.ArgumentTypeError,
+                "' , ' is not a valid list of names"):
+            manage._names_list(' , ')
+
+
+class TestConfigFile(helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        # Create a temporary options file.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'config.yaml')
+
+    def write(self, contents):
+        """Write the given contents to the options file."""
+        with open(self.path, 'w') as stream:
+            stream.write(contents)
+
+    def test_valid_file(self):
+        # The file contents are returned.
+        self.write('ghost: {port: 8080}\n')
+        self.assertEqual(
+            'ghost: {port: 8080}\n', manage._config_file(self.path))
+
+    def test_missing_file(self):
+        # An ArgumentTypeError is raised if the file cannot be read.
+        with self.assertRaises(argparse.ArgumentTypeError):
+            manage._config_file(self.path)
+
+    def test_not_a_mapping(self):
+        # An ArgumentTypeError is raised if the file is not a mapping.
+        self.write('- bad wolf')
+        expected = 'invalid config file {}: not a mapping'.format(self.path)
+        with self.assert_error(argparse.ArgumentTypeError, expected):
+            manage._config_file(self.path)
+
+
+class TestConstraints(helpers.ErrorTestsMixin, TestCase):
+
+    def test_valid_constraints(self):
+        # The constraints are returned as a dict.
+        self.assertEqual(
+            {'mem': 4096, 'cpu-cores': 2},
+            manage._constraints('mem=4G cpu-cores=2'))
+
+    def test_invalid_constraints(self):
+        # An ArgumentTypeError is raised if the constraints are not valid.
+        with self.assert_error(
+                argparse.ArgumentTypeError, 'invalid constraint: bad'):
+            manage._constraints('bad')
+
+
 class TestValidatePlacement(TestCase):
 
     def setUp(self):
@@ -77,23 +150,144 @@ class TestValidatePlacement(TestCase):
 
     def test_multiple_units(self):
         # More than one units can be requested if machine is not specified.
-        options = mock.Mock(num_units=42, machine=None)
+        options = mock.Mock(num_units=42, machines=None)
         manage._validate_placement(options, self.parser)
         self.assertFalse(self.parser.error.called)
 
     def test_single_placed_unit(self):
         # A single unit can be placed to a specific machine.
-        options = mock.Mock(num_units=1, machine='42')
+        options = mock.Mock(num_units=1, machines=['42'])
+        manage._validate_placement(options, self.parser)
+        self.assertFalse(self.parser.error.called)
+
+    def test_multiple_placed_units(self):
+        # Multiple units can be spread across placement targets.
+        options = mock.Mock(num_units=42, machines=['1', 'lxc:2'])
         manage._validate_placement(options, self.parser)
         self.assertFalse(self.parser.error.called)
 
-    def test_multiple_units_error(self):
-        # The parser exits with an error if multiple units are requested and
-        # a machine target is specified.
-        options = mock.Mock(num_units=42, machine='1')
+    def test_too_many_targets_error(self):
+        # The parser exits with an error if more placement targets than units
+        # are requested.
+        options = mock.Mock(num_units=1, machines=['1', '2'])
         manage._validate_placement(options, self.parser)
         self.parser.error.assert_called_once_with(
-            'cannot use --num-units > 1 with --to')
+            'cannot use more --to targets than --num-units')
+
+
+class TestValidateSetup(TestCase):
+
+    def make_options(self, repo, **kwargs):
+        """Return options deploying the given repo."""
+        defaults = {
+            'config': None, 'constraints': None, 'expose': False,
+            'relations': None}
+        defaults.update(kwargs)
+        return mock.Mock(repo=repo, **defaults)
+
+    def test_charm(self):
+        # Charms can be set up.
+        parser = mock.Mock()
+        options = self.make_options(
+            'hatched/ghost-charm', expose=True, relations=['mysql'])
+        manage._validate_setup(options, parser)
+        self.assertFalse(parser.error.called)
+
+    def test_bundle_error(self):
+        # Bundles cannot be set up using the command line options.
+        parser = mock.Mock()
+        with tempfile.NamedTemporaryFile() as bundle:
+            manage._validate_setup(
+                self.make_options(bundle.name, expose=True), parser)
+        parser.error.assert_called_once_with(
+            'cannot use --config, --constraints, --expose or --relate '
+            'with bundles')
+
+
+class TestValidateOffline(TestCase):
+
+    def test_offline(self):
+        # Offline deployments can be requested.
+        parser = mock.Mock()
+        options = mock.Mock(offline='/tmp/archives', agent=False)
+        manage._validate_offline(options, parser)
+        self.assertFalse(parser.error.called)
+
+    def test_agent_error(self):
+        # Offline deployments cannot be forwarded to the agent.
+        parser = mock.Mock()
+        options = mock.Mock(offline='/tmp/archives', agent=True)
+        manage._validate_offline(options, parser)
+        parser.error.assert_called_once_with(
+            'cannot use --offline with --agent')
+
+
+@helpers.mock_print
+class TestDeploy(helpers.ConfigMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.archive_path = os.path.join(path, 'ghost.zip')
+        with open(self.archive_path, 'wb') as stream:
+            archive.write_zip(stream, [
+                archive.compress('metadata.yaml', b'name: ghost\n')])
+        self.streams = []
+        self.session = mock.Mock()
+        self.session.open.side_effect = self.open
+
+    def open(self, zip_url, commit=None):
+        """Open the prefetched archive, as the offline session does."""
+        stream = utils.FileStream(self.archive_path)
+        self.streams.append(stream)
+        return stream
+
+    def deploy(self, deployed):
+        """Deploy the charm to a service with the given annotations."""
+        options = mock.Mock(service='ghost', num_units=1, machines=None)
+        provenance = app.Provenance('hatched/ghost-charm', '', 'abc')
+        zip_url = 'https://api.github.com/repos/hatched/ghost-charm/zipball/'
+        mock_app = mock.patch.multiple(
+            'jujugd.app', get_deployed=mock.Mock(return_value=deployed),
+            record_provenance=mock.DEFAULT,
+            deploy=mock.Mock(return_value='ghost'))
+        with mock_app as mocks:
+            with mock.patch(
+                    'jujugd.api.upload_charm',
+                    side_effect=self.upload_charm) as self.mock_upload:
+                services = manage._deploy(
+                    options, 'ec2', zip_url, '10.0.3.1:17070', 'secret!',
+                    'trusty', provenance, self.session,
+                    metrics.Recorder('hatched/ghost-charm'), None)
+        self.mock_record = mocks['record_provenance']
+        return services
+
+    def upload_charm(self, api_address, stream, password, series):
+        with open(self.archive_path, 'rb') as expected:
+            self.assertEqual(expected.read(), stream.read())
+        return 'local:trusty/ghost-1'
+
+    def test_streamed(self, mock_print):
+        # The archive is opened once, hashed and then uploaded from the same
+        # stream, without reading it in memory.
+        self.assertEqual(['ghost'], self.deploy(None))
+        self.assertFalse(self.session.fetch.called)
+        [stream] = self.streams
+        self.assertTrue(stream.closed)
+        self.assertEqual(1, self.mock_upload.call_count)
+
+    def test_unchanged(self, mock_print):
+        # Nothing is uploaded if the charm files did not change.
+        with open(self.archive_path, 'rb') as stream:
+            tree = app.get_tree(stream.read())
+        self.assertEqual(['ghost'], self.deploy([{
+            app.REPO_ANNOTATION: 'hatched/ghost-charm',
+            app.TREE_ANNOTATION: tree,
+        }]))
+        self.assertFalse(self.session.fetch.called)
+        self.assertFalse(self.mock_upload.called)
+        self.assertEqual(1, self.mock_record.call_count)
 
 
 class TestSetup(TestCase):
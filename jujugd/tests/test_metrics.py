@@ -0,0 +1,199 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy deployment metrics."""
+
+import json
+import os
+import threading
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import metrics
+
+
+class TestGetTextfilePath(
+        helpers.ConfigMixin, helpers.CacheDirMixin, TestCase):
+
+    def test_default(self):
+        # The textfile is stored in the cache directory by default.
+        expected = os.path.join(self.cache_dir, 'metrics.prom')
+        self.assertEqual(expected, metrics.get_textfile_path())
+
+    def test_environment(self):
+        # The path can be provided using an environment variable.
+        os.environ['JUJU_GIT_DEPLOY_METRICS'] = '/tmp/metrics.prom'
+        self.assertEqual('/tmp/metrics.prom', metrics.get_textfile_path())
+
+    def test_configuration(self):
+        # The path can be provided in the configuration file.
+        with mock.patch(
+                'jujugd.config.load',
+                return_value={'metrics-textfile': '/tmp/jujugd.prom'}):
+            self.assertEqual('/tmp/jujugd.prom', metrics.get_textfile_path())
+
+
+class TestRender(TestCase):
+
+    def test_histogram(self):
+        # Histograms are exported with cumulative buckets.
+        entries = [{
+            'phase': 'deploy', 'env': 'ec2', 'repo': 'hatched/ghost',
+            'buckets': [1, 0, 2], 'sum': 7.5, 'count': 3, 'bytes': 42,
+        }]
+        labels = 'phase="deploy",env="ec2",repo="hatched/ghost"'
+        expected = '\n'.join([
+            '# HELP juju_git_deploy_phase_duration_seconds '
+            'Duration of the deployment phases.',
+            '# TYPE juju_git_deploy_phase_duration_seconds histogram',
+            'juju_git_deploy_phase_duration_seconds_bucket'
+            '{' + labels + ',le="0.5"} 1',
+            'juju_git_deploy_phase_duration_seconds_bucket'
+            '{' + labels + ',le="5"} 1',
+            'juju_git_deploy_phase_duration_seconds_bucket'
+            '{' + labels + ',le="+Inf"} 3',
+            'juju_git_deploy_phase_duration_seconds_sum{' + labels + '} 7.5',
+            'juju_git_deploy_phase_duration_seconds_count{' + labels + '} 3',
+            '# HELP juju_git_deploy_phase_bytes_total '
+            'Bytes transferred by the deployment phases.',
+            '# TYPE juju_git_deploy_phase_bytes_total counter',
+            'juju_git_deploy_phase_bytes_total{' + labels + '} 42',
+        ]) + '\n'
+        self.assertEqual(expected, metrics.render(entries, buckets=(0.5, 5)))
+
+    def test_escape(self):
+        # Label values are escaped.
+        entries = [{
+            'phase': 'deploy', 'env': 'ec2', 'repo': 'my "charm"\\',
+            'buckets': [1], 'sum': 1, 'count': 1, 'bytes': 0,
+        }]
+        text = metrics.render(entries, buckets=())
+        self.assertIn(r'repo="my \"charm\"\\"', text)
+
+
+class TestStore(helpers.CacheDirMixin, TestCase):
+
+    def setUp(self):
+        # Store the metrics in the temporary cache directory.
+        super().setUp()
+        self.path = os.path.join(self.cache_dir, 'metrics.json')
+        self.textfile_path = os.path.join(self.cache_dir, 'metrics.prom')
+        self.store = metrics.Store(self.path, buckets=(1, 10))
+
+    def load(self):
+        """Return the stored entries."""
+        with open(self.path) as stream:
+            return json.load(stream)
+
+    def test_merge(self):
+        # Samples are added to the histograms and exported.
+        self.store.merge([
+            ('process', 'ec2', 'ghost', 0.5, 100),
+            ('process', 'ec2', 'ghost', 20, 200),
+            ('deploy', 'ec2', 'ghost', 5, 0),
+        ], self.textfile_path)
+        self.store.merge(
+            [('process', 'ec2', 'ghost', 2, 300)], self.textfile_path)
+        self.assertEqual([{
+            'phase': 'deploy', 'env': 'ec2', 'repo': 'ghost',
+            'buckets': [0, 1, 0], 'sum': 5, 'count': 1, 'bytes': 0,
+        }, {
+            'phase': 'process', 'env': 'ec2', 'repo': 'ghost',
+            'buckets': [1, 1, 1], 'sum': 22.5, 'count': 3, 'bytes': 600,
+        }], self.load())
+        with open(self.textfile_path) as stream:
+            self.assertEqual(
+                metrics.render(self.load(), (1, 10)), stream.read())
+
+    def test_concurrent_merges(self):
+        # Concurrent merges do not lose samples.
+        def merge():
+            store = metrics.Store(self.path, buckets=(1, 10))
+            store.merge(
+                [('deploy', 'ec2', 'ghost', 1, 10)] * 5, self.textfile_path)
+        threads = [threading.Thread(target=merge) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        [entry] = self.load()
+        self.assertEqual(40, entry['count'])
+        self.assertEqual(400, entry['bytes'])
+
+    def test_buckets_changed(self):
+        # Histograms recorded with different buckets are discarded.
+        self.store.merge(
+            [('deploy', 'ec2', 'ghost', 1, 0)], self.textfile_path)
+        store = metrics.Store(self.path, buckets=(1, 10, 100))
+        store.merge(
+            [('deploy', 'ec2', 'ghost', 1, 0)], self.textfile_path)
+        [entry] = self.load()
+        self.assertEqual([1, 0, 0, 0], entry['buckets'])
+
+    def test_invalid_store(self):
+        # Invalid stores are discarded.
+        with open(self.path, 'w') as stream:
+            stream.write('bad wolf')
+        self.store.merge(
+            [('deploy', 'ec2', 'ghost', 1, 0)], self.textfile_path)
+        self.assertEqual(1, len(self.load()))
+
+
+class TestRecorder(helpers.ConfigMixin, helpers.CacheDirMixin, TestCase):
+
+    def test_measure(self):
+        # The phase duration and transferred bytes are recorded.
+        recorder = metrics.Recorder('hatched/ghost')
+        with mock.patch('time.monotonic', side_effect=[10, 12.5]):
+            with recorder.measure('process', 'ec2') as stats:
+                stats['bytes'] = 42
+        self.assertEqual(
+            [('process', 'ec2', 'hatched/ghost', 2.5, 42)], recorder.samples)
+
+    def test_default_environment(self):
+        # The default environment is recorded as "default".
+        recorder = metrics.Recorder('hatched/ghost')
+        recorder.observe('deploy', None, 1)
+        self.assertEqual(
+            [('deploy', 'default', 'hatched/ghost', 1, 0)], recorder.samples)
+
+    def test_failure(self):
+        # Nothing is recorded if the phase fails.
+        recorder = metrics.Recorder('hatched/ghost')
+        with self.assertRaises(ValueError):
+            with recorder.measure('deploy', 'ec2'):
+                raise ValueError('bad wolf')
+        self.assertEqual([], recorder.samples)
+
+    def test_save(self):
+        # Samples are stored in the cache directory, and the textfile is
+        # written.
+        recorder = metrics.Recorder('hatched/ghost')
+        recorder.observe('deploy', 'ec2', 1)
+        recorder.save()
+        self.assertEqual([], recorder.samples)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.cache_dir, 'metrics.json')))
+        with open(os.path.join(self.cache_dir, 'metrics.prom')) as stream:
+            self.assertIn('repo="hatched/ghost"', stream.read())
+
+    def test_save_error(self):
+        # Failing to store the metrics is not fatal.
+        recorder = metrics.Recorder('hatched/ghost')
+        recorder.observe('deploy', 'ec2', 1)
+        path = os.path.join(self.cache_dir, 'file')
+        open(path, 'w').close()
+        with mock.patch('jujugd.settings.CACHE_DIR', path):
+            recorder.save()
@@ -0,0 +1,174 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy offline deployments."""
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    app,
+    offline,
+)
+
+
+GITHUB = 'https://api.github.com/repos'
+
+
+class TestGetKey(TestCase):
+
+    def test_reference(self):
+        # The key includes the reference, if provided.
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/develop'
+        self.assertEqual(
+            'hatched/ghost-charm:develop', offline.get_key(zip_url))
+
+    def test_default_branch(self):
+        # The reference is omitted for the default branch.
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        self.assertEqual('hatched/ghost-charm', offline.get_key(zip_url))
+
+
+@helpers.mock_print
+class TestPrefetchAndOpen(
+        helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def prefetch(self, repos, commit='abc'):
+        """Prefetch the given repos, all pointing to the given commit.
+
+        Return the mock used to download the archives.
+        """
+        with mock.patch('jujugd.app.get_commit', return_value=commit):
+            with mock.patch(
+                    'jujugd.github.urlget',
+                    side_effect=lambda url: io.BytesIO(b'zip contents')
+                    ) as mock_urlget:
+                offline.prefetch(repos, self.path)
+        return mock_urlget
+
+    def test_manifest(self, mock_print):
+        # Archives are downloaded and described in the manifest.
+        mock_urlget = self.prefetch(['hatched/ghost-charm:develop'])
+        mock_urlget.assert_called_once_with(
+            GITHUB + '/hatched/ghost-charm/zipball/abc')
+        manifest = offline.load_manifest(self.path)
+        self.assertEqual({
+            'hatched/ghost-charm:develop': {
+                'commit': 'abc',
+                'file': 'hatched-ghost-charm-abc.zip',
+                'sha256': hashlib.sha256(b'zip contents').hexdigest(),
+                'size': 12,
+            },
+        }, manifest)
+        archive_path = os.path.join(self.path, 'hatched-ghost-charm-abc.zip')
+        with open(archive_path, 'rb') as stream:
+            self.assertEqual(b'zip contents', stream.read())
+
+    def test_already_fetched(self, mock_print):
+        # Archives are not downloaded again if the commit did not change.
+        self.prefetch(['hatched/ghost-charm'])
+        mock_urlget = self.prefetch(['hatched/ghost-charm', 'frankban/mysql'])
+        mock_urlget.assert_called_once_with(
+            GITHUB + '/frankban/mysql/zipball/abc')
+        self.assertEqual(2, len(offline.load_manifest(self.path)))
+
+    def test_open(self, mock_print):
+        # Prefetched archives are streamed from the directory.
+        self.prefetch(['hatched/ghost-charm'])
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        with offline.open_archive(self.path, zip_url) as stream:
+            self.assertEqual(12, stream.length)
+            self.assertEqual(b'zip contents', stream.read())
+
+    def test_open_not_found(self, mock_print):
+        # A ValueError is raised if the archive has not been prefetched.
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/develop'
+        expected = 'hatched/ghost-charm:develop not found in {}'.format(
+            self.path)
+        with self.assert_error(ValueError, expected):
+            offline.open_archive(self.path, zip_url)
+
+    def test_open_hash_mismatch(self, mock_print):
+        # A ValueError is raised if the archive has been modified.
+        self.prefetch(['hatched/ghost-charm'])
+        archive_path = os.path.join(self.path, 'hatched-ghost-charm-abc.zip')
+        with open(archive_path, 'ab') as stream:
+            stream.write(b'!')
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        expected = '{}: hash mismatch'.format(archive_path)
+        with self.assert_error(ValueError, expected):
+            offline.open_archive(self.path, zip_url)
+
+    def test_process(self, mock_print):
+        # Charms are uploaded from the prefetched archives.
+        self.prefetch(['hatched/ghost-charm'])
+        session = offline.OfflineSession(self.path)
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        streams = []
+
+        def upload_charm(api_address, stream, password, series):
+            streams.append(stream.stream)
+            self.assertEqual(12, stream.length)
+            return 'local:trusty/ghost-1'
+        with mock.patch('jujugd.github.urlget') as mock_urlget:
+            with mock.patch(
+                    'jujugd.api.upload_charm', side_effect=upload_charm):
+                charm_url = app.process(
+                    zip_url, '10.0.3.1:17070', 'secret!', 'trusty',
+                    session=session)
+        self.assertEqual('local:trusty/ghost-1', charm_url)
+        self.assertFalse(mock_urlget.called)
+        # The archive file is closed after the upload.
+        [stream] = streams
+        self.assertTrue(stream.closed)
+
+    def test_get_commit(self, mock_print):
+        # The commit is retrieved from the manifest.
+        self.prefetch(['hatched/ghost-charm'])
+        session = offline.OfflineSession(self.path)
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        with mock.patch('jujugd.github.urlget') as mock_urlget:
+            self.assertEqual('abc', session.get_commit(zip_url))
+        self.assertFalse(mock_urlget.called)
+
+    def test_get_commit_not_found(self, mock_print):
+        # A ProgramExit is raised if the archive has not been prefetched.
+        session = offline.OfflineSession(self.path)
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        expected = (
+            'juju-git-deploy: error: '
+            'hatched/ghost-charm not found in {}'.format(self.path))
+        with self.assert_error(app.ProgramExit, expected):
+            session.get_commit(zip_url)
+
+    def test_fetch_error(self, mock_print):
+        # A ProgramExit is raised if the archive cannot be retrieved.
+        session = offline.OfflineSession(self.path)
+        zip_url = GITHUB + '/hatched/ghost-charm/zipball/'
+        expected = (
+            'juju-git-deploy: error: unable to retrieve charm contents: '
+            'hatched/ghost-charm not found in {}'.format(self.path))
+        with self.assert_error(app.ProgramExit, expected):
+            session.fetch(zip_url)
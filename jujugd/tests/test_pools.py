@@ -0,0 +1,131 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy environment pools."""
+
+import os
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    app,
+    pools,
+    settings,
+)
+
+
+class TestGetPool(helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def write_config(self, contents):
+        """Write the given contents to the configuration file."""
+        with open(settings.CONFIG_PATH, 'w') as stream:
+            stream.write(contents)
+
+    def test_config(self):
+        # Pools are retrieved from the configuration file.
+        self.write_config('pools:\n  ci: [ci-1, ci-2]\n')
+        self.assertEqual(['ci-1', 'ci-2'], pools.get_pool('ci'))
+
+    def test_list(self):
+        # A comma separated list of environments can be provided.
+        self.assertEqual(['ci-1', 'ci-2'], pools.get_pool('ci-1, ci-2'))
+
+    def test_unknown(self):
+        # A ValueError is raised if the pool is not defined.
+        with self.assert_error(ValueError, 'unknown environment pool: ci'):
+            pools.get_pool('ci')
+
+    def test_invalid(self):
+        # A ValueError is raised if the pool is not a list.
+        self.write_config('pools:\n  ci: ci-1\n')
+        with self.assert_error(ValueError, 'invalid environment pool: ci'):
+            pools.get_pool('ci')
+
+
+class TestAcquire(helpers.CacheDirMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.leases_dir = os.path.join(self.cache_dir, 'leases')
+
+    def acquire(self, env_names, units=None):
+        """Acquire a lease, using the given unit counts to break ties."""
+        with mock.patch(
+                'jujugd.pools.get_unit_counts',
+                return_value=units or {}) as mock_get_unit_counts:
+            lease = pools.acquire(env_names, 4)
+        self.addCleanup(lease.release)
+        return lease, mock_get_unit_counts
+
+    def test_least_loaded(self):
+        # Environments with fewer leases are chosen first.
+        env_names = ['ci-1', 'ci-2', 'ci-3']
+        chosen = [self.acquire(env_names)[0].env_name for _ in range(4)]
+        self.assertEqual(['ci-1', 'ci-2', 'ci-3', 'ci-1'], chosen)
+        self.assertEqual(2, pools.count_leases('ci-1', self.leases_dir))
+
+    def test_units(self):
+        # The number of units is used to break ties.
+        lease, mock_get_unit_counts = self.acquire(
+            ['ci-1', 'ci-2', 'ci-3'], units={'ci-1': 5, 'ci-2': 2})
+        self.assertEqual('ci-2', lease.env_name)
+        mock_get_unit_counts.assert_called_once_with(
+            ['ci-1', 'ci-2', 'ci-3'], 4, session=None)
+
+    def test_no_ties(self):
+        # Units are not counted if an environment has fewer leases.
+        self.acquire(['ci-1', 'ci-2'])
+        lease, mock_get_unit_counts = self.acquire(['ci-1', 'ci-2'])
+        self.assertEqual('ci-2', lease.env_name)
+        self.assertFalse(mock_get_unit_counts.called)
+
+    def test_release(self):
+        # Released leases are not counted.
+        lease = self.acquire(['ci-1'])[0]
+        lease.release()
+        self.assertEqual(0, pools.count_leases('ci-1', self.leases_dir))
+
+    def test_stale(self):
+        # Leases not locked by any process are removed.
+        path = os.path.join(self.leases_dir, 'ci-1', '42-stale.lease')
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        self.assertEqual(0, pools.count_leases('ci-1', self.leases_dir))
+        self.assertFalse(os.path.exists(path))
+
+    def test_error(self):
+        # A ProgramExit is raised if the lease cannot be taken.
+        with mock.patch('os.makedirs', side_effect=OSError('bad wolf')):
+            with self.assertRaises(app.ProgramExit) as context_manager:
+                pools.acquire(['ci-1'], 4)
+        self.assertEqual(
+            'unable to lease an environment: bad wolf',
+            context_manager.exception.message)
+
+
+class TestGetUnitCounts(TestCase):
+
+    def test_counts(self):
+        # Unit counts are returned for the environments that can be queried.
+        session = mock.Mock()
+        session.connect.return_value.__enter__ = mock.Mock()
+        session.connect.return_value.__exit__ = mock.Mock(return_value=None)
+        with mock.patch('jujugd.api.get_api_address'):
+            with mock.patch('jujugd.env.parse_jenv', side_effect=[
+                    'secret!', ValueError('bad wolf')]):
+                with mock.patch('jujugd.api.count_units', return_value=3):
+                    counts = pools.get_unit_counts(
+                        ['ci-1', 'ci-2'], 1, session=session)
+        self.assertEqual({'ci-1': 3}, counts)
@@ -0,0 +1,158 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy transfer progress reporting."""
+
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    progress,
+    utils,
+)
+
+
+class Clock:
+    """A fake monotonic clock."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFormat(TestCase):
+
+    def test_size(self):
+        # Sizes are formatted using binary units.
+        self.assertEqual('42 B', progress.format_size(42))
+        self.assertEqual('1.5 KiB', progress.format_size(1536))
+        self.assertEqual('2.0 MiB', progress.format_size(2 * 1024 ** 2))
+        self.assertEqual('3.0 GiB', progress.format_size(3 * 1024 ** 3))
+
+    def test_duration(self):
+        # Durations are formatted as minutes and seconds.
+        self.assertEqual('0:05', progress.format_duration(5))
+        self.assertEqual('2:03', progress.format_duration(123))
+
+
+@helpers.mock_print
+class TestProgress(TestCase):
+
+    def make_progress(self, tty, total=4096):
+        """Return a Progress using a fake clock."""
+        self.clock = Clock()
+        return progress.Progress(
+            'uploading', total=total, tty=tty, clock=self.clock)
+
+    def test_quick_transfer(self, mock_print):
+        # Nothing is printed if the transfer completes before the first report.
+        progress_ = self.make_progress(tty=False)
+        progress_.update(4096)
+        progress_.finish()
+        self.assertFalse(mock_print.called)
+
+    def test_log_lines(self, mock_print):
+        # Without a terminal, lines are printed at most once per interval.
+        with mock.patch('jujugd.settings.PROGRESS_LOG_INTERVAL', 10):
+            progress_ = self.make_progress(tty=False)
+            self.clock.now = 5
+            progress_.update(1024)
+            self.assertFalse(mock_print.called)
+            self.clock.now = 10
+            progress_.update(1024)
+            mock_print.assert_called_once_with(
+                'uploading: 2.0 KiB of 4.0 KiB (50%), 204 B/s, ETA 0:10')
+            self.clock.now = 12
+            progress_.update(1024)
+            self.assertEqual(1, mock_print.call_count)
+            self.clock.now = 16
+            progress_.update(1024)
+            progress_.finish()
+        mock_print.assert_called_with('uploading: 4.0 KiB in 0:16 (256 B/s)')
+
+    def test_tty(self, mock_print):
+        # On a terminal, the progress line is updated in place.
+        with mock.patch('jujugd.settings.PROGRESS_TTY_INTERVAL', 1):
+            progress_ = self.make_progress(tty=True, total=None)
+            self.clock.now = 1
+            progress_.update(2048)
+            self.clock.now = 2
+            progress_.finish()
+        mock_print.assert_has_calls([
+            mock.call('\ruploading: 2.0 KiB, 2.0 KiB/s', end='', flush=True),
+            mock.call(
+                '\ruploading: 2.0 KiB in 0:02 (1.0 KiB/s)', end='\n',
+                flush=True),
+        ])
+
+    def test_output(self, mock_print):
+        # Lines are passed to the output callable, if provided, and never
+        # updated in place.
+        lines = []
+        with mock.patch('jujugd.progress._isatty', return_value=True):
+            progress_ = progress.Progress(
+                'uploading', total=None, clock=Clock(), output=lines.append)
+        self.assertFalse(progress_.tty)
+        progress_.clock.now = 60
+        progress_.update(2048)
+        self.assertEqual(['uploading: 2.0 KiB, 34 B/s'], lines)
+        self.assertFalse(mock_print.called)
+
+    def test_rewind(self, mock_print):
+        # The transferred bytes are counted again after a rewind.
+        progress_ = self.make_progress(tty=False)
+        progress_.update(3072)
+        progress_.rewind(0)
+        progress_.update(1024)
+        self.assertEqual(1024, progress_.done)
+
+
+class TestProgressStream(TestCase):
+
+    def make_stream(self, contents):
+        """Return a progress stream wrapping the given contents."""
+        self.progress = mock.Mock()
+        return progress.ProgressStream(
+            utils.BytesStream(contents), self.progress)
+
+    def test_read_chunks(self):
+        # Progress is updated for each chunk, and completed at the end.
+        stream = self.make_stream(b'exterminate')
+        self.assertEqual(11, stream.length)
+        self.assertEqual(b'exter', stream.read(5))
+        self.assertEqual(b'minate', stream.read(10))
+        self.assertEqual(b'', stream.read(10))
+        self.assertEqual(b'', stream.read(10))
+        self.progress.update.assert_has_calls([mock.call(5), mock.call(6)])
+        self.progress.finish.assert_called_once_with()
+
+    def test_read_all(self):
+        # Reading the whole stream is forwarded to the wrapped stream.
+        stream = self.make_stream(b'exterminate')
+        self.assertEqual(b'exterminate', stream.read())
+        self.progress.update.assert_called_once_with(11)
+        self.progress.finish.assert_called_once_with()
+
+    def test_seek(self):
+        # Seeking the stream rewinds the progress, e.g. when retrying.
+        stream = self.make_stream(b'exterminate')
+        stream.read()
+        self.assertTrue(stream.seekable())
+        stream.seek(0)
+        self.progress.rewind.assert_called_once_with(0)
+        self.assertEqual(b'exterminate', stream.read())
+        self.assertEqual(2, self.progress.finish.call_count)
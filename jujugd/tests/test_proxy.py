@@ -0,0 +1,136 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy charm archive proxy."""
+
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+from unittest import (
+    mock,
+    TestCase,
+)
+
+from . import helpers
+from .. import (
+    app,
+    proxy,
+)
+
+
+COMMIT = 'a' * 40
+
+
+class _UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """A fake Github API serving the hatched/ghost repository."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/repos/hatched/ghost/commits/'):
+            body = COMMIT.encode('utf-8')
+        elif self.path == '/repos/hatched/ghost/zipball/' + COMMIT:
+            body = b'zip contents'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start(server):
+    """Serve requests in a separate thread, and return the server URL."""
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.01})
+    thread.start()
+    return thread, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+@helpers.mock_print
+class TestProxy(helpers.ConfigMixin, helpers.CacheDirMixin, TestCase):
+
+    def setUp(self):
+        # Start the fake upstream and the proxy servers.
+        super().setUp()
+        upstream = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _UpstreamHandler)
+        upstream.requests = []
+        self.upstream_requests = upstream.requests
+        upstream_url = self.start(upstream)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        server = proxy.make_server(
+            '127.0.0.1', 0, upstream_url + '/repos', path)
+        self.proxy_url = self.start(server)
+        patch_env = mock.patch.dict(
+            os.environ, {'JUJU_GIT_DEPLOY_PROXY': self.proxy_url})
+        patch_env.start()
+        self.addCleanup(patch_env.stop)
+
+    def start(self, server):
+        """Start the given server, and stop it at the end of the test."""
+        thread, url = _start(server)
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+        return url
+
+    def test_zip_url(self, mock_print):
+        # The zip URL points to the proxy if configured.
+        expected = '{}/repos/hatched/ghost/zipball/dev'.format(self.proxy_url)
+        self.assertEqual(expected, app.get_zip_url('hatched/ghost:dev'))
+
+    def test_fetch(self, mock_print):
+        # Archives are retrieved through the proxy.
+        contents = app.fetch(app.get_zip_url('hatched/ghost:dev'))
+        self.assertEqual(b'zip contents', contents)
+        self.assertEqual([
+            '/repos/hatched/ghost/commits/dev',
+            '/repos/hatched/ghost/zipball/' + COMMIT,
+        ], self.upstream_requests)
+
+    def test_archive_stored(self, mock_print):
+        # Archives are retrieved from upstream only once, and branch commits
+        # are reused for a while.
+        zip_url = app.get_zip_url('hatched/ghost')
+        app.fetch(zip_url)
+        # Simulate another client, not sharing the local archive cache.
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with mock.patch('jujugd.settings.CACHE_DIR', cache_dir):
+            app.fetch(zip_url)
+        self.assertEqual([
+            '/repos/hatched/ghost/commits/HEAD',
+            '/repos/hatched/ghost/zipball/' + COMMIT,
+        ], self.upstream_requests)
+
+    def test_upstream_error(self, mock_print):
+        # Upstream errors are propagated to the client.
+        zip_url = app.get_zip_url('hatched/other')
+        with self.assertRaises(app.ProgramExit) as context_manager:
+            app.fetch(zip_url)
+        self.assertIn('(404)', str(context_manager.exception))
+
+    def test_not_found(self, mock_print):
+        # Unknown paths are not served.
+        with self.assertRaises(app.ProgramExit) as context_manager:
+            app.fetch(self.proxy_url + '/bad/wolf/zipball/')
+        self.assertIn('(404)', str(context_manager.exception))
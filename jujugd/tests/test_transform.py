@@ -0,0 +1,130 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju Git Deploy charm transforms."""
+
+import io
+import os
+from unittest import (
+    mock,
+    TestCase,
+)
+import zipfile
+
+from . import helpers
+from .. import (
+    archive,
+    settings,
+    transform,
+)
+
+
+def add_version(path):
+    """A transform adding a version file to the charm."""
+    with open(os.path.join(path, 'version'), 'w') as stream:
+        stream.write('42\n')
+
+
+def fail(path):
+    """A transform always failing."""
+    raise RuntimeError('bad wolf')
+
+
+def make_charm():
+    """Return the zip contents of a charm, as stored in Github archives."""
+    date_time = (2014, 5, 1, 12, 0, 0)
+    members = [
+        archive.compress(
+            'ghost-abc/metadata.yaml', b'name: ghost\n',
+            date_time=date_time),
+        archive.compress(
+            'ghost-abc/hooks/install', b'#!/bin/sh\n', mode=0o100755,
+            date_time=date_time),
+    ]
+    stream = io.BytesIO()
+    archive.write_zip(stream, members)
+    return stream.getvalue()
+
+
+class TestGetTransforms(
+        helpers.ConfigMixin, helpers.ErrorTestsMixin, TestCase):
+
+    def write_config(self, contents):
+        """Write the given contents to the configuration file."""
+        with open(settings.CONFIG_PATH, 'w') as stream:
+            stream.write(contents)
+
+    def test_no_transforms(self):
+        # No transforms are returned if none are configured.
+        self.assertEqual([], transform.get_transforms('hatched/ghost-charm'))
+
+    def test_matching(self):
+        # The transforms matching the charm are returned in order.
+        self.write_config(
+            'transforms:\n'
+            '  - {function: "build:wheels", version: 2, repo: "frankban/*"}\n'
+            '  - {function: "build:render"}\n')
+        self.assertEqual([
+            transform.Transform('build:wheels', '2', 'frankban/*'),
+            transform.Transform('build:render', '', '*'),
+        ], transform.get_transforms('frankban/charms/charms/mysql'))
+        self.assertEqual([
+            transform.Transform('build:render', '', '*'),
+        ], transform.get_transforms('hatched/ghost-charm'))
+
+    def test_invalid(self):
+        # A ValueError is raised if the transforms are not valid.
+        self.write_config('transforms:\n  - {function: build}\n')
+        expected = "invalid transform: {'function': 'build'}"
+        with self.assert_error(ValueError, expected):
+            transform.get_transforms('hatched/ghost-charm')
+
+
+class TestApply(helpers.CacheDirMixin, helpers.ErrorTestsMixin, TestCase):
+
+    transforms = [transform.Transform(__name__ + ':add_version', '1', '*')]
+
+    def test_transformed(self):
+        # The transforms are applied in a worker process, keeping file modes.
+        contents = transform.apply(make_charm(), self.transforms)
+        with zipfile.ZipFile(io.BytesIO(contents)) as charm:
+            self.assertEqual(
+                ['hooks/install', 'metadata.yaml', 'version'],
+                sorted(charm.namelist()))
+            self.assertEqual(b'42\n', charm.read('version'))
+            info = charm.getinfo('hooks/install')
+            self.assertEqual(0o755, info.external_attr >> 16 & 0o777)
+
+    def test_cached(self):
+        # Archives are transformed only once for each transform version.
+        contents = transform.apply(make_charm(), self.transforms)
+        with mock.patch(
+                'jujugd.transform.pool.run', return_value=b'') as mock_run:
+            self.assertEqual(
+                contents, transform.apply(make_charm(), self.transforms))
+            self.assertFalse(mock_run.called)
+            transform.apply(
+                make_charm(), [self.transforms[0]._replace(version='2')])
+        self.assertEqual(1, mock_run.call_count)
+
+    def test_failure(self):
+        # A ValueError is raised if a transform fails.
+        transforms = [transform.Transform(__name__ + ':fail', '', '*')]
+        expected = '{}:fail failed: bad wolf'.format(__name__)
+        with self.assert_error(ValueError, expected):
+            transform.apply(make_charm(), transforms)
+
+    def test_not_found(self):
+        # A ValueError is raised if a transform cannot be imported.
+        transforms = [transform.Transform(__name__ + ':no_such', '', '*')]
+        with self.assertRaises(ValueError):
+            transform.apply(make_charm(), transforms)
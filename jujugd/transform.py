@@ -0,0 +1,166 @@
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju Git Deploy charm transforms.
+
+Charms requiring a build step before being uploaded, e.g. to vendor Python
+wheels or to render templates, can declare transforms in the configuration
+file, e.g.:
+
+    transforms:
+      - function: mycharms.build:vendor_wheels
+        version: 2
+        repo: frankban/*
+
+Each function is called with the path to a directory including the charm
+files, which it can change in place. Transforms matching the repository (all
+of them if repo is omitted) are applied in order, in a pool of worker
+processes. Results are cached by input archive hash and transform versions:
+increase the version when the function behavior changes.
+"""
+
+from collections import namedtuple
+from collections.abc import Mapping
+from concurrent import futures
+import fnmatch
+import hashlib
+import importlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from . import (
+    archive,
+    cache,
+    config,
+    settings,
+)
+
+
+# A transform declared in the configuration file: the function in the
+# "module:name" form, its version and the repository pattern it applies to.
+Transform = namedtuple('Transform', 'function version repo')
+
+
+def get_transforms(name):
+    """Return the transforms to apply to the charm with the given name.
+
+    The name is either the Github repository in the {user}/{repo} form,
+    possibly followed by the path to the charm, or the path to a local charm
+    directory. Return the list of matching transforms in declaration order.
+    Raise a ValueError if the transforms are not valid.
+    """
+    declared = config.load().get('transforms') or []
+    if not isinstance(declared, list):
+        raise ValueError('invalid transforms in the configuration file')
+    transforms = []
+    for data in declared:
+        function = data.get('function') if isinstance(data, Mapping) else None
+        if not isinstance(function, str) or ':' not in function:
+            raise ValueError('invalid transform: {}'.format(data))
+        repo = str(data.get('repo') or '*')
+        if fnmatch.fnmatch(name, repo):
+            transforms.append(
+                Transform(function, str(data.get('version', '')), repo))
+    return transforms
+
+
+def get_fingerprint(transforms):
+    """Return a string identifying the given transforms and their versions."""
+    return ','.join('{}@{}'.format(i.function, i.version) for i in transforms)
+
+
+def _load(function):
+    """Return the function in the given "module:name" form.
+
+    Raise a ValueError if the function cannot be imported.
+    """
+    module_name, name = function.split(':', 1)
+    try:
+        return getattr(importlib.import_module(module_name), name)
+    except (ImportError, AttributeError) as err:
+        raise ValueError('unable to load {}: {}'.format(function, err))
+
+
+def _run(contents, functions):
+    """Apply the given functions to the charm in the given zip contents.
+
+    This is executed in the worker processes.
+    Return the resulting zip contents.
+    Raise a ValueError if any of the functions fail.
+    """
+    with tempfile.TemporaryDirectory() as path:
+        archive.extract(io.BytesIO(contents), path)
+        for function in functions:
+            call = _load(function)
+            try:
+                call(path)
+            except Exception as err:
+                raise ValueError('{} failed: {}'.format(function, err))
+        stream = io.BytesIO()
+        archive.write_zip(stream, archive.get_members(path))
+        return stream.getvalue()
+
+
+class WorkerPool:
+    """A pool of worker processes, started when first used.
+
+    The pool is started again if a worker exits unexpectedly.
+    """
+
+    def __init__(self, max_workers=settings.TRANSFORM_JOBS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def run(self, function, *args):
+        """Call the function with the given args in a worker process.
+
+        Return the function result.
+        Raise a ValueError if the worker exits unexpectedly.
+        """
+        with self._lock:
+            if self._executor is None:
+                # Do not fork the threads of the current process.
+                self._executor = futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            executor = self._executor
+        try:
+            return executor.submit(function, *args).result()
+        except futures.BrokenExecutor as err:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise ValueError('worker exited unexpectedly: {}'.format(err))
+
+
+# The worker processes shared by all the transforms run in the process.
+pool = WorkerPool()
+
+
+def apply(contents, transforms):
+    """Return the given charm zip contents once transformed.
+
+    Results are stored in a cache shared by all the plugin processes, keyed
+    by the contents hash and the transforms versions, so that each archive
+    is transformed only once.
+    Raise a ValueError if the charm cannot be transformed.
+    """
+    key = '{}:{}'.format(
+        hashlib.sha256(contents).hexdigest(), get_fingerprint(transforms))
+    transformed = cache.ArchiveCache(
+        os.path.join(settings.CACHE_DIR, 'transformed'))
+    return transformed.get(key, lambda: pool.run(
+        _run, contents, [i.function for i in transforms]))
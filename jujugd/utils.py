@@ -14,34 +14,337 @@
 
 import base64
 import http
+import io
+import json
 import logging
+import os
 import pipes
+import random
+import re
+import select
+import selectors
+import signal
+import socket
 import subprocess
+import threading
+import time
+import types
 from urllib import request
 
+from . import settings
 
-def call(command, *args):
+
+# Define the maximum length of an HTTP status line.
+_MAX_LINE = 65536
+# Match the status line of the interim response to "Expect: 100-continue".
+_continue_expression = re.compile(rb'^HTTP/\d\.\d 100\b')
+# Define the HTTP statuses for which the upload is retried.
+_RETRY_STATUSES = (502, 503, 504)
+
+
+# Match the JSON characters delimiting tokens, the separators between keys
+# and values and between items, and the rest of a string after its opening
+# quote.
+_json_delimiters = re.compile(r'["{}\[\],:]')
+_json_colon = re.compile(r'\s*:\s*')
+_json_separators = re.compile(r'[\s,]*')
+_json_string_tail = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+_json_decoder = json.JSONDecoder()
+# Define the characters which can follow a complete streamed item.
+_JSON_ITEM_ENDS = tuple(' \t\n\r,]}')
+
+
+# Define the size of the chunks read from the subprocesses output.
+_CALL_CHUNK_SIZE = 64 * 1024
+# Define the return code used when a subprocess times out, like timeout(1).
+TIMEOUT_RETCODE = 124
+
+
+def _kill(process):
+    """Terminate the given process together with all its children.
+
+    The process group is killed if it does not exit in time.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(settings.CALL_KILL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            pass
+        # Also kill the children still running in the group.
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def _communicate(process, deadline):
+    """Read the process output and error until the process exits.
+
+    Pipes are read in chunks as soon as data is available. Only the last
+    settings.CALL_MAX_ERROR bytes of the error output are kept.
+    Return the output and error bytes, or None if the deadline expires.
+    """
+    output, error = [], bytearray()
+
+    def add_error(chunk):
+        error.extend(chunk)
+        del error[:-settings.CALL_MAX_ERROR]
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, output.append)
+        selector.register(process.stderr, selectors.EVENT_READ, add_error)
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, _CALL_CHUNK_SIZE)
+                if chunk:
+                    key.data(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+    try:
+        process.wait(
+            None if deadline is None else max(deadline - time.monotonic(), 0))
+    except subprocess.TimeoutExpired:
+        return None
+    return b''.join(output), bytes(error)
+
+
+def call(command, *args, timeout=None):
     """Call a subprocess passing the given arguments.
 
-    Take the subcommand and its parameters as args.
+    Take the subcommand and its parameters as args. The subprocess runs in
+    its own process group, which is killed if the subprocess does not exit
+    in the given timeout seconds (settings.CALL_TIMEOUT by default).
 
     Return a tuple containing the subprocess return code, output and error.
+    The TIMEOUT_RETCODE return code is returned if the subprocess times out.
     """
+    if timeout is None:
+        timeout = settings.CALL_TIMEOUT
     pipe = subprocess.PIPE
     cmd = (command,) + args
     cmdline = ' '.join(map(pipes.quote, cmd))
     logging.debug('running the following: {}'.format(cmdline))
     try:
-        process = subprocess.Popen(cmd, stdout=pipe, stderr=pipe)
+        process = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=pipe, stderr=pipe,
+            start_new_session=True)
     except OSError as err:
         # A return code 127 is returned by the shell when the command is not
         # found in the PATH.
         return 127, '', '{}: {}'.format(command, err)
-    output, error = process.communicate()
-    retcode = process.poll()
+    with process:
+        try:
+            result = _communicate(process, time.monotonic() + timeout)
+        except BaseException:
+            _kill(process)
+            raise
+        if result is None:
+            _kill(process)
+            error = '{}: timed out after {} seconds'.format(cmdline, timeout)
+            logging.debug(error)
+            return TIMEOUT_RETCODE, '', error
+    output, error = result
+    retcode = process.returncode
     logging.debug('retcode: {} | output: {!r} | error: {!r}'.format(
         retcode, output, error))
-    return retcode, output.decode('utf-8'), error.decode('utf-8')
+    return retcode, output.decode('utf-8'), error.decode('utf-8', 'replace')
+
+
+class BytesStream(io.BytesIO):
+    """An in-memory file-like object also exposing its contents length."""
+
+    @property
+    def length(self):
+        """Return the length of the stream contents."""
+        with self.getbuffer() as view:
+            return view.nbytes
+
+
+class FileStream(io.FileIO):
+    """A file-like object reading the file at the given path.
+
+    The file contents length is also exposed, so that the file can be sent
+    in chunks rather than being read in memory.
+    """
+
+    @property
+    def length(self):
+        """Return the length of the file contents."""
+        return os.fstat(self.fileno()).st_size
+
+
+class JSONStreamDecoder:
+    """Decode JSON documents in chunks, streaming the items of a container.
+
+    The document is fed in chunks. The items of the array or object found at
+    the given path, a sequence of object keys (e.g. ["Response", "Deltas"]),
+    are decoded one at a time as soon as they are complete, and passed to the
+    callback: object members are passed as (key, value) pairs. This way large
+    documents are never decoded, or held in memory, as a whole. The rest of
+    the document is returned by close, with the streamed container empty.
+    """
+
+    def __init__(self, path, callback):
+        self.path = list(path)
+        self.callback = callback
+        self._buffer = ''
+        self._pos = 0
+        # The text of the document, except the streamed items.
+        self._skeleton = []
+        # The open containers, and the current key of each one (None for
+        # arrays, or for objects before their first key).
+        self._containers = []
+        self._keys = []
+        self._expect_key = False
+        # The closing character of the container being streamed, if any, the
+        # start of the item being decoded and the buffered text length
+        # required to decode it again.
+        self._streaming = None
+        self._item_start = None
+        self._retry_size = 0
+
+    def feed(self, text):
+        """Decode the given chunk of the document.
+
+        Raise a ValueError if a streamed item is not valid JSON.
+        """
+        start = self._pos if self._item_start is None else self._item_start
+        self._buffer = self._buffer[start:] + text
+        self._pos -= start
+        if self._item_start is not None:
+            self._item_start -= start
+        self._process()
+
+    def close(self):
+        """Return the decoded document, without the streamed items.
+
+        Raise a ValueError if the document is not complete or not valid.
+        """
+        self._retry_size = 0
+        self._process()
+        if (self._streaming is not None or self._containers or
+                self._pos < len(self._buffer)):
+            raise ValueError('incomplete JSON document')
+        return json.loads(''.join(self._skeleton))
+
+    def _process(self):
+        """Decode the buffered text as far as possible."""
+        while True:
+            if self._streaming is None:
+                scan = self._scan
+            elif self._item_start is None:
+                scan = self._scan_separators
+            else:
+                scan = self._scan_item
+            if not scan():
+                return
+
+    def _string_end(self, index):
+        """Return the end of the string starting at the given index.
+
+        Return None if the string is not complete yet.
+        """
+        match = _json_string_tail.match(self._buffer, index + 1)
+        return None if match is None else match.end()
+
+    def _scan(self):
+        """Scan the next token outside the streamed container.
+
+        Return False if more text is required.
+        """
+        buffer, pos = self._buffer, self._pos
+        match = _json_delimiters.search(buffer, pos)
+        if match is None:
+            self._skeleton.append(buffer[pos:])
+            self._pos = len(buffer)
+            return False
+        index = match.start()
+        char = buffer[index]
+        if char == '"':
+            end = self._string_end(index)
+            if end is None:
+                self._skeleton.append(buffer[pos:index])
+                self._pos = index
+                return False
+            self._skeleton.append(buffer[pos:end])
+            if self._expect_key:
+                self._keys[-1] = json.loads(buffer[index:end])
+                self._expect_key = False
+            self._pos = end
+            return True
+        self._skeleton.append(buffer[pos:index + 1])
+        self._pos = index + 1
+        if char in '{[':
+            if self._keys == self.path:
+                self._streaming = '}' if char == '{' else ']'
+                return True
+            self._containers.append(char)
+            self._keys.append(None)
+            self._expect_key = char == '{'
+        elif char in '}]':
+            if not self._containers:
+                raise ValueError('invalid JSON document')
+            self._containers.pop()
+            self._keys.pop()
+            self._expect_key = False
+        elif char == ',':
+            self._expect_key = self._containers[-1:] == ['{']
+        return True
+
+    def _scan_separators(self):
+        """Find the start of the next item in the streamed container.
+
+        Return False if more text is required.
+        """
+        index = _json_separators.match(self._buffer, self._pos).end()
+        self._pos = index
+        if index == len(self._buffer):
+            return False
+        if self._buffer[index] == self._streaming:
+            self._skeleton.append(self._streaming)
+            self._streaming = None
+            self._pos = index + 1
+        else:
+            self._item_start = index
+        return True
+
+    def _scan_item(self):
+        """Decode the current item, and pass it to the callback.
+
+        Return False if more text is required. Items not complete yet are
+        decoded again only once the text buffered for them doubled.
+        """
+        buffer, start = self._buffer, self._item_start
+        if len(buffer) - start < self._retry_size:
+            return False
+        try:
+            if self._streaming == '}':
+                key, end = _json_decoder.raw_decode(buffer, start)
+                match = _json_colon.match(buffer, end)
+                if match is None:
+                    raise ValueError('missing key separator')
+                value, end = _json_decoder.raw_decode(buffer, match.end())
+                item = key, value
+            else:
+                item, end = _json_decoder.raw_decode(buffer, start)
+        except ValueError:
+            self._retry_size = 2 * (len(buffer) - start)
+            return False
+        if buffer[end:end + 1] not in _JSON_ITEM_ENDS:
+            # Numbers may be truncated: wait for the next separator.
+            self._retry_size = len(buffer) - start + 1
+            return False
+        self._item_start = None
+        self._retry_size = 0
+        self._pos = end
+        self.callback(item)
+        return True
 
 
 def get_service_from_charm(charm_url):
@@ -49,8 +352,21 @@ def get_service_from_charm(charm_url):
     return charm_url.split('/')[1].rsplit('-', 1)[0]
 
 
-def urlget(url):
-    """Open the given remote URL.
+class ResponseError(IOError):
+    """An invalid HTTP response has been returned.
+
+    The response status and headers are stored in the exception.
+    """
+
+    def __init__(self, url, status, reason, headers):
+        msg = 'invalid response from {} ({}): {}'.format(url, status, reason)
+        super().__init__(msg)
+        self.status = status
+        self.headers = headers
+
+
+def urlget(url, headers=None):
+    """Open the given remote URL, optionally sending the given headers.
 
     Return the HTTP response file-like object.
 
@@ -59,21 +375,170 @@ def urlget(url):
     """
     logging.debug('http -> {}'.format(url))
     try:
-        response = request.urlopen(url)
+        if headers:
+            response = request.urlopen(request.Request(url, headers=headers))
+        else:
+            response = request.urlopen(url)
+    except request.HTTPError as err:
+        raise ResponseError(url, err.code, err.reason, err.headers)
     except request.URLError as err:
         raise IOError(err.reason)
     if response.status != 200:
-        msg = 'invalid response from {} ({}): {}'.format(
-            url, response.status, response.reason)
-        raise IOError(msg)
+        raise ResponseError(
+            url, response.status, response.reason, response.headers)
     logging.debug('http <- {} {}'.format(response.status, response.reason))
     return response
 
 
-def urlpost(host, port, path, stream, user, password):
+class ConnectionPool:
+    """A thread safe pool of persistent HTTPS connections.
+
+    Connections are keyed by host and port, and are reused by subsequent
+    requests to the same server.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port):
+        """Return an idle connection to the given host and port.
+
+        A new connection is created if no idle connections are available.
+        """
+        with self._lock:
+            idle = self._connections.get((host, port))
+            if idle:
+                return idle.pop()
+        return http.client.HTTPSConnection(host, port)
+
+    def release(self, host, port, connection):
+        """Return the given connection to the pool."""
+        with self._lock:
+            self._connections.setdefault((host, port), []).append(connection)
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for idle in connections.values():
+            for connection in idle:
+                connection.close()
+
+
+class _ReplayReader(io.RawIOBase):
+    """A raw stream returning the given data and then the fp contents."""
+
+    def __init__(self, data, fp):
+        self.data = data
+        self.fp = fp
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.data:
+            chunk, self.data = self.data[:len(buffer)], self.data[len(buffer):]
+        else:
+            chunk = self.fp.read1(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def _wait_for_continue(connection, timeout):
+    """Wait for the interim response to a request expecting 100-continue.
+
+    Return None if the server accepted the request headers or did not reply
+    in the given timeout seconds: in both cases the body must be sent.
+    Otherwise return the final response rejecting the request.
+    """
+    sock = connection.sock
+    # Data already decrypted by an SSL socket is not reported by select.
+    pending = getattr(sock, 'pending', None)
+    if not (pending and pending()):
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            return None
+    # A readable SSL socket does not imply that application data is
+    # available, e.g. when a session ticket is received: never block waiting
+    # for the status line.
+    original_timeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    fp = sock.makefile('rb')
+    try:
+        line = fp.readline(_MAX_LINE)
+        if _continue_expression.match(line):
+            # Skip the interim response headers.
+            http.client.parse_headers(fp)
+            fp.close()
+            return None
+    except socket.timeout:
+        logging.debug('no interim response received: sending the body')
+        return None
+    finally:
+        sock.settimeout(original_timeout)
+    # Let the response parse the status line already consumed.
+    reader = io.BufferedReader(_ReplayReader(line, fp))
+    response_sock = types.SimpleNamespace(makefile=lambda mode: reader)
+    response = http.client.HTTPResponse(response_sock, method='POST')
+    response.begin()
+    return response
+
+
+def _post(connection, path, body, headers):
+    """Send a POST request expecting 100-continue using the connection.
+
+    Return the response and whether the connection can be reused.
+    """
+    connection.putrequest('POST', path)
+    for name, value in headers.items():
+        connection.putheader(name, value)
+    connection.endheaders()
+    response = _wait_for_continue(
+        connection, settings.EXPECT_CONTINUE_TIMEOUT)
+    if response is not None:
+        # The request has been rejected before sending the body.
+        return response, False
+    connection.send(body)
+    return connection.getresponse(), True
+
+
+def _tell(stream):
+    """Return the current position of the stream, or None if not seekable."""
+    try:
+        if stream.seekable():
+            return stream.tell()
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def _get_backoff(attempt):
+    """Return the seconds to wait before the given retry attempt.
+
+    The delay grows exponentially and includes a random jitter, so that
+    clients failing together do not retry at the same time.
+    """
+    delay = min(
+        settings.UPLOAD_BACKOFF_MAX,
+        settings.UPLOAD_BACKOFF_BASE * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def urlpost(
+        host, port, path, stream, user, password, pool=None,
+        retries=settings.UPLOAD_RETRIES):
     """Post the given file-like object stream to the given URL.
 
     The user and password arguments are used for HTTP basic authentication.
+    If a ConnectionPool is provided, the connection is retrieved from the pool
+    and then kept alive for later reuse.
+
+    The request includes an "Expect: 100-continue" header, so that the body
+    is not sent if the server rejects the request, e.g. because credentials
+    are not valid. Connection failures and 502, 503 and 504 responses are
+    retried up to the given number of times, with an exponential backoff,
+    if the stream can be rewound to replay the upload.
 
     Return the response contents, status and reason.
     """
@@ -81,21 +546,53 @@ def urlpost(host, port, path, stream, user, password):
     headers = {
         'Content-Type': 'application/zip',
         'Authorization': 'Basic {}'.format(auth.decode('utf-8')),
+        'Expect': '100-continue',
     }
     if stream.length is None:
         # The content length is not available: the body must be a byte string.
         body = stream.read()
+        headers['Content-Length'] = len(body)
+        replayable, position = True, None
     else:
         # Having the content length, we can provide it directly in the headers.
         headers['Content-Length'] = stream.length
         body = stream
-    logging.debug('http -> {}:{}{} ({})'.format(host, port, path, headers))
-    # Establish the HTTPS connection and send the request.
-    connection = http.client.HTTPSConnection(host, port)
-    connection.request('POST', path, body, headers)
-    # Retrieve the server response.
-    response = connection.getresponse()
-    data = response.read().decode('utf-8')
-    logging.debug('http <- {} (status: {})'.format(data, response.status))
-    connection.close()
-    return data, response.status, response.reason
+        position = _tell(stream)
+        replayable = position is not None
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = _get_backoff(attempt)
+            msg = 'upload failed ({}): retrying in {:.1f} seconds'
+            logging.info(msg.format(error, delay))
+            time.sleep(delay)
+            if position is not None:
+                stream.seek(position)
+        logging.debug('http -> {}:{}{} ({})'.format(host, port, path, headers))
+        # Establish the HTTPS connection and send the request.
+        if pool is None:
+            connection = http.client.HTTPSConnection(host, port)
+        else:
+            connection = pool.acquire(host, port)
+        try:
+            response, reusable = _post(connection, path, body, headers)
+            # Retrieve the server response.
+            data = response.read().decode('utf-8')
+        except Exception as err:
+            connection.close()
+            if not isinstance(err, (OSError, http.client.HTTPException)):
+                raise
+            if not replayable or attempt == retries:
+                raise
+            error = err
+            continue
+        logging.debug('http <- {} (status: {})'.format(data, response.status))
+        if pool is None or not reusable or response.will_close:
+            connection.close()
+        else:
+            pool.release(host, port, connection)
+        retry = response.status in _RETRY_STATUSES
+        if retry and replayable and attempt < retries:
+            error = '{} {}'.format(response.status, response.reason)
+            continue
+        return data, response.status, response.reason